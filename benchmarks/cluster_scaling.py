@@ -0,0 +1,128 @@
+# Copyright 2016-2020 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-redis-consumer/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""
+Benchmark the throughput of a Redis Cluster with the number of queues.
+
+Each queue is consumed by its own process, so the aggregate number of
+no-op jobs consumed per second grows with the number of shards that the
+queues are spread across. Connects to the cluster configured with
+REDIS_HOST and REDIS_PORT.
+
+    python benchmarks/cluster_scaling.py --jobs 2000 --queues 1 2 4 8
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import timeit
+import uuid
+
+from redis_consumer import consumers
+from redis_consumer import redis
+from redis_consumer import settings
+
+
+class NoOpConsumer(consumers.Consumer):
+    """Finishes every job without doing any work."""
+
+    def _consume(self, redis_hash):
+        return self.final_status
+
+
+def get_client():
+    return redis.RedisClient(host=settings.REDIS_HOST,
+                             port=settings.REDIS_PORT,
+                             backoff=settings.REDIS_TIMEOUT,
+                             cluster=True)
+
+
+def enqueue(queue, num_jobs):
+    """Create `num_jobs` jobs in the slot of the queue."""
+    client = get_client()
+    consumer = NoOpConsumer(client, None, queue, name='benchmark')
+    hashes = ['{}:{}.tif:{}'.format(redis.hash_tag(queue), i,
+                                    uuid.uuid4().hex)
+              for i in range(num_jobs)]
+
+    pipe = client.pipeline(transaction=False)
+    for h in hashes:
+        pipe.hmset(h, {'status': 'new', 'input_file_name': 'x.tif'})
+    pipe.execute()
+    for h in hashes:
+        consumer.put_redis_hash(queue, h)
+    return hashes
+
+
+def consume(queue, num_jobs, start_event):
+    """Consume `num_jobs` jobs from the queue once all workers are ready."""
+    consumer = NoOpConsumer(get_client(), None, queue, name='benchmark')
+    start_event.wait()
+    for _ in range(num_jobs):
+        consumer.consume()
+
+
+def run_benchmark(num_queues, num_jobs):
+    """Consume `num_jobs` jobs from each queue, returning jobs per second."""
+    queues = ['benchmark-{}-{}'.format(i, uuid.uuid4().hex)
+              for i in range(num_queues)]
+    hashes = [h for q in queues for h in enqueue(q, num_jobs)]
+
+    start_event = multiprocessing.Event()
+    workers = [multiprocessing.Process(target=consume,
+                                       args=(q, num_jobs, start_event))
+               for q in queues]
+    for worker in workers:
+        worker.start()
+
+    start = timeit.default_timer()
+    start_event.set()
+    for worker in workers:
+        worker.join()
+    elapsed = timeit.default_timer() - start
+
+    client = get_client()
+    for h in hashes:
+        client.delete(h)
+    return num_queues * num_jobs / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--jobs', type=int, default=2000,
+                        help='Number of jobs to consume from each queue.')
+    parser.add_argument('--queues', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='Number of queues to consume at the same time.')
+    args = parser.parse_args()
+
+    for num_queues in args.queues:
+        rate = run_benchmark(num_queues, args.jobs)
+        print('{:>3} queues: {:.1f} jobs/second'.format(num_queues, rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# Copyright 2016-2020 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-redis-consumer/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""
+Measure how long a new consumer process takes to import each module.
+
+Every module is imported in a new Python process, so that nothing is
+cached by an earlier import. Reports the median import time of each module
+and the slow packages it imported. Exits with an error if a module takes
+longer than --max-seconds, to catch import time regressions.
+
+    python benchmarks/import_time.py --repeat 5 --max-seconds 2
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import subprocess
+import sys
+
+import numpy as np
+
+
+MODULES = (
+    'redis_consumer',
+    'redis_consumer.settings',
+    'redis_consumer.storage',
+    'redis_consumer.consumers',
+    'redis_consumer.processing',
+    'redis_consumer.tracking',
+)
+
+# packages that are slow to import, and only imported once they are used.
+SLOW_PACKAGES = (
+    'boto3',
+    'google.cloud.storage',
+    'deepcell_toolbox',
+    'deepcell_tracking',
+    'keras_preprocessing',
+)
+
+SCRIPT = '''
+import json, sys, timeit
+start = timeit.default_timer()
+import {module}
+seconds = timeit.default_timer() - start
+print(json.dumps({{'seconds': seconds, 'modules': list(sys.modules)}}))
+'''
+
+
+def time_import(module):
+    """Import the module in a new process.
+
+    Returns:
+        tuple: The import time in seconds, and the slow packages imported.
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-c', SCRIPT.format(module=module)])
+    result = json.loads(output.decode().splitlines()[-1])
+    slow = [p for p in SLOW_PACKAGES if p in result['modules']]
+    return result['seconds'], slow
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of times each module is imported.')
+    parser.add_argument('--max-seconds', type=float, default=None,
+                        help='Fail if a module takes longer to import.')
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    args = parser.parse_args()
+
+    too_slow = []
+    print('{:<28} {:>10}  {}'.format('module', 'median (s)', 'slow packages'))
+    for module in args.modules:
+        results = [time_import(module) for _ in range(args.repeat)]
+        seconds = np.median([r[0] for r in results])
+        print('{:<28} {:>10.3f}  {}'.format(
+            module, seconds, ', '.join(results[0][1])))
+        if args.max_seconds is not None and seconds > args.max_seconds:
+            too_slow.append(module)
+
+    if too_slow:
+        sys.exit('Imported in more than {} seconds: {}'.format(
+            args.max_seconds, ', '.join(too_slow)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+# Copyright 2016-2020 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-redis-consumer/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""
+Simulate the latency of small and large jobs with each QUEUE_POLICY.
+
+Jobs of two sizes arrive at random and are claimed by a single consumer
+from a real Redis instance (configured with REDIS_HOST and REDIS_PORT),
+using the same claim script as the consumers. The consumer's clock is
+simulated, so each job "takes" time proportional to its pixel count
+without actually sleeping. Reports the p50 and p99 latency of each
+policy, from arrival until the job is finished.
+
+    python benchmarks/job_ordering.py --jobs 2000 --load 0.9
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import random
+import uuid
+
+import numpy as np
+
+from redis_consumer import consumers
+from redis_consumer import redis
+from redis_consumer import settings
+from redis_consumer.consumers import base_consumer
+
+
+SIZES = {
+    'small': 128 * 128,
+    'large': 2048 * 2048,
+}
+
+PIXELS_PER_SECOND = 1e6
+
+
+class SimulatedClock(object):
+    """Replaces the `time` module used by the consumers."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def make_jobs(num_jobs, load, large_fraction):
+    """Returns (arrival time, size) of each job, arriving at random."""
+    mean_service = sum([
+        (1 - large_fraction) * SIZES['small'],
+        large_fraction * SIZES['large'],
+    ]) / PIXELS_PER_SECOND
+    rate = load / mean_service
+
+    jobs, arrival = [], 0.0
+    for _ in range(num_jobs):
+        arrival += random.expovariate(rate)
+        size = 'large' if random.random() < large_fraction else 'small'
+        jobs.append((arrival, size))
+    return jobs
+
+
+def simulate(client, policy, jobs):
+    """Consume all jobs with the given policy, returning their latencies."""
+    settings.QUEUE_POLICY = policy
+    clock = base_consumer.time = SimulatedClock()
+
+    queue = 'benchmark-{}-{}'.format(policy, uuid.uuid4().hex)
+    consumer = consumers.Consumer(client, None, queue, name='benchmark')
+
+    pending = list(jobs)
+    arrivals, sizes, latencies = {}, {}, {}
+    while pending or len(latencies) < len(jobs):
+        # enqueue every job that has arrived.
+        while pending and pending[0][0] <= clock.now:
+            arrival, size = pending.pop(0)
+            service_time = SIZES[size] / PIXELS_PER_SECOND
+            redis_hash = '{}:{}:{}'.format(queue, size, len(arrivals))
+            client.hmset(redis_hash, {
+                'status': 'new',
+                'cost': consumer.get_job_cost(SIZES[size]),
+                'deadline': arrival + 10 * service_time,
+            })
+            consumer.put_redis_hash(queue, redis_hash)
+            arrivals[redis_hash], sizes[redis_hash] = arrival, size
+
+        redis_hash = consumer.get_redis_hash()
+        if redis_hash is None:  # idle until the next job arrives.
+            clock.now = pending[0][0]
+            continue
+
+        clock.sleep(SIZES[sizes[redis_hash]] / PIXELS_PER_SECOND)
+        consumer._release_hash(redis_hash)
+        latencies[redis_hash] = clock.now - arrivals[redis_hash]
+
+    client.delete(*arrivals)
+    client.delete(queue, consumer.lease_queue, consumer.scheduled_queue)
+    return {h: (sizes[h], latencies[h]) for h in latencies}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--jobs', type=int, default=2000,
+                        help='Number of jobs to simulate with each policy.')
+    parser.add_argument('--load', type=float, default=0.9,
+                        help='Fraction of time the consumer is busy.')
+    parser.add_argument('--large-fraction', type=float, default=0.1,
+                        help='Fraction of jobs that are large.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    jobs = make_jobs(args.jobs, args.load, args.large_fraction)
+
+    client = redis.RedisClient(host=settings.REDIS_HOST,
+                               port=settings.REDIS_PORT,
+                               backoff=settings.REDIS_TIMEOUT)
+
+    print('{:>6} {:>8} {:>10} {:>10}'.format(
+        'policy', 'jobs', 'p50 (s)', 'p99 (s)'))
+    for policy in ('fifo', 'sjf', 'edf'):
+        results = simulate(client, policy, jobs)
+        for size in ('all', 'small', 'large'):
+            latency = [l for s, l in results.values() if size in ('all', s)]
+            print('{:>6} {:>8} {:>10.2f} {:>10.2f}'.format(
+                policy, size, np.percentile(latency, 50),
+                np.percentile(latency, 99)))
+
+
+if __name__ == '__main__':
+    main()
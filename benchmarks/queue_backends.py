@@ -0,0 +1,94 @@
+# Copyright 2016-2020 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-redis-consumer/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""
+Benchmark the throughput of the "list" and "stream" queue backends.
+
+Each backend consumes the same number of no-op jobs from a real Redis
+instance (configured with REDIS_HOST and REDIS_PORT) and reports the
+number of jobs consumed per second.
+
+    python benchmarks/queue_backends.py --jobs 5000
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import timeit
+import uuid
+
+from redis_consumer import consumers
+from redis_consumer import redis
+from redis_consumer import settings
+
+
+class NoOpConsumer(consumers.Consumer):
+    """Finishes every job without doing any work."""
+
+    def _consume(self, redis_hash):
+        return self.final_status
+
+
+def run_benchmark(client, backend, num_jobs):
+    """Enqueue and consume `num_jobs` jobs, returning jobs per second."""
+    queue = 'benchmark-{}-{}'.format(backend, uuid.uuid4().hex)
+    consumer = NoOpConsumer(client, None, queue, queue_backend=backend,
+                            name='benchmark')
+
+    hashes = ['{}:{}.tif:{}'.format(queue, i, uuid.uuid4().hex)
+              for i in range(num_jobs)]
+    for h in hashes:
+        client.hmset(h, {'status': 'new', 'input_file_name': 'x.tif'})
+        consumer.put_redis_hash(queue, h)
+
+    start = timeit.default_timer()
+    for _ in range(num_jobs):
+        consumer.consume()
+    elapsed = timeit.default_timer() - start
+
+    for h in hashes:
+        client.delete(h)
+    client.delete(queue, consumer.processing_queue, consumer.stream)
+    return num_jobs / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--jobs', type=int, default=1000,
+                        help='Number of jobs to consume with each backend.')
+    args = parser.parse_args()
+
+    client = redis.RedisClient(host=settings.REDIS_HOST,
+                               port=settings.REDIS_PORT,
+                               backoff=settings.REDIS_TIMEOUT)
+
+    for backend in ('list', 'stream'):
+        rate = run_benchmark(client, backend, args.jobs)
+        print('{:>8}: {:.1f} jobs/second'.format(backend, rate))
+
+
+if __name__ == '__main__':
+    main()
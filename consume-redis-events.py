@@ -73,15 +73,26 @@ def get_consumer(consumer_type, **kwargs):
     return consumer_cls(**kwargs)
 
 
-if __name__ == '__main__':
-    initialize_logger(settings.DEBUG)
+def create_consumer(name):
+    """Create the consumer of CONSUMER_TYPE with its own clients.
 
+    Args:
+        name (str): The name of the consumer.
+
+    Returns:
+        redis_consumer.consumers.Consumer: The new consumer.
+    """
     _logger = logging.getLogger(__file__)
 
     redis = redis_consumer.redis.RedisClient(
         host=settings.REDIS_HOST,
         port=settings.REDIS_PORT,
-        backoff=settings.REDIS_TIMEOUT)
+        backoff=settings.REDIS_TIMEOUT,
+        cluster=settings.REDIS_CLUSTER,
+        zone=settings.REDIS_ZONE,
+        replica_zones=settings.REDIS_REPLICA_ZONES,
+        eject_latency=settings.REDIS_EJECT_LATENCY,
+        eject_time=settings.REDIS_EJECT_TIME)
 
     storage_client = redis_consumer.storage.get_client(settings.CLOUD_PROVIDER)
 
@@ -91,7 +102,7 @@ if __name__ == '__main__':
         'queue': settings.QUEUE,
         'final_status': 'done',
         'failed_status': 'failed',
-        'name': settings.HOSTNAME,
+        'name': name,
         'output_dir': settings.OUTPUT_DIR,
     }
 
@@ -101,13 +112,73 @@ if __name__ == '__main__':
     consumer = get_consumer(settings.CONSUMER_TYPE, **consumer_kwargs)
 
     _logger.debug('Got `%s` consumer.', settings.CONSUMER_TYPE)
+    return consumer
+
+
+def run_consumer(worker_id=None, stop_event=None):
+    """Consume jobs until the stop event is set.
+
+    Args:
+        worker_id (int): The ID of the worker process, if running WORKERS.
+        stop_event (threading.Event): Stop after the current job once set.
+    """
+    _logger = logging.getLogger(__file__)
 
-    while True:
-        try:
-            consumer.consume()
-            gc.collect()
-        except Exception as err:  # pylint: disable=broad-except
-            _logger.critical('Fatal Error: %s: %s\n%s',
-                             type(err).__name__, err, traceback.format_exc())
+    name = settings.HOSTNAME
+    if worker_id is not None:
+        # each worker needs its own processing queue.
+        name = '{}-{}'.format(name, worker_id)
+
+    if stop_event is None:
+        stop_event = redis_consumer.workers.get_stop_event()
+
+    try:
+        consumer = None
+        staged = settings.STAGED_PIPELINE
+        if staged:
+            consumer = create_consumer(name)
+            if not consumer.get_stages():
+                # the StagedEngine would fail again after every restart.
+                _logger.warning('`%s` consumers do not support stages. '
+                                'Ignoring STAGED_PIPELINE.',
+                                settings.CONSUMER_TYPE)
+                staged = False
+
+        if staged:
+            # the stages of one consumer run many jobs at the same time.
+            engine = redis_consumer.pipeline.StagedEngine(
+                consumer, settings.STAGE_QUEUE_SIZE, settings.CPU_WORKERS)
+            engine.run(stop_event)
+        elif settings.CONCURRENCY > 1:
+            # each job in flight needs its own processing queue.
+            engine = redis_consumer.engine.AsyncEngine(
+                lambda slot: create_consumer('{}-{}'.format(name, slot)),
+                settings.CONCURRENCY, settings.CPU_WORKERS)
+            engine.run(stop_event)
+        else:
+            consumer = consumer or create_consumer(name)
+            while not stop_event.is_set():
+                consumer.consume()
+                gc.collect()
+    except Exception as err:  # pylint: disable=broad-except
+        _logger.critical('Fatal Error: %s: %s\n%s',
+                         type(err).__name__, err, traceback.format_exc())
+
+        sys.exit(1)
+
+    _logger.info('Consumer `%s` stopped.', name)
 
-            sys.exit(1)
+
+if __name__ == '__main__':
+    initialize_logger(settings.DEBUG)
+
+    if settings.METRICS_PORT:
+        # started before forking, so only the supervisor serves metrics.
+        redis_consumer.metrics.start_http_server(settings.METRICS_PORT)
+
+    if settings.WORKERS > 1:
+        supervisor = redis_consumer.workers.Supervisor(
+            run_consumer, settings.WORKERS)
+        supervisor.run()
+    else:
+        run_consumer()
@@ -28,13 +28,18 @@ from __future__ import division
 from __future__ import print_function
 
 from redis_consumer import consumers
+from redis_consumer import engine
 from redis_consumer import grpc_clients
+from redis_consumer import live_settings
+from redis_consumer import metrics
 from redis_consumer import pbs
+from redis_consumer import pipeline
 from redis_consumer import redis
 from redis_consumer import settings
 from redis_consumer import storage
-from redis_consumer import tracking
+from redis_consumer import tracing
 from redis_consumer import utils
+from redis_consumer import workers
 
 del absolute_import
 del division
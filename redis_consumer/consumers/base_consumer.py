@@ -29,10 +29,12 @@ from __future__ import division
 from __future__ import print_function
 
 import datetime
+import hashlib
 import json
 import logging
 import os
 import sys
+import threading
 import time
 import timeit
 import urllib
@@ -41,24 +43,525 @@ import zipfile
 
 import numpy as np
 import pytz
-
-from deepcell_toolbox.utils import tile_image, untile_image, resize
+import redis
 
 from redis_consumer.grpc_clients import PredictClient
+from redis_consumer.redis import hash_tag
+from redis_consumer import live_settings
 from redis_consumer import utils
+from redis_consumer import metrics
 from redis_consumer import settings
+from redis_consumer import tracing
+
+
+# Atomically claim a job from the work queue.
+# Up to 10 jobs whose lease expired and up to 10 jobs whose delayed retry
+# is due are first moved back to the work queue.
+# The claimed job gets a new fencing token and a lease that expires at
+# `lease_expiry`, and its timestamp is updated.
+# Jobs with an invalid `input_file_name` are failed and removed in place,
+# except for child jobs: they are claimed like any other job, so that the
+# consumer fails them and records them in their parent.
+# If there are lanes, the work queue is one of the lanes and the lane that
+# was served least recently is popped first.
+# With the "sjf" or "edf" policy, up to `window` popped jobs are moved to a
+# sorted set first, and the job with the lowest score is claimed:
+#   sjf: `cost` + aging_rate * time the job was scheduled
+#   edf: `deadline`, or the time the job was scheduled + default_deadline
+# Jobs left in the sorted set are claimed first whatever the policy, so
+# none are stranded when the policy is changed back to "fifo".
+# With the "fifo" policy, the oldest of the last `affinity_window` jobs of a
+# queue whose "model_name:model_version" is one of the given models is
+# popped instead of the oldest job. The oldest job is skipped at most
+# `max_skips` times.
+# Returns a flat list of the job hash followed by all of its fields.
+#
+# Job hashes and lanes are not declared in KEYS: they are only known once
+# they are popped. On Redis Cluster, they must be in the hash slot of the
+# work queue, i.e. contain its hash tag (e.g. "{predict}:<uuid>:<file>").
+# If a `slot_tag` is given, a popped job hash without that tag is never
+# read or written: it is moved to the rejected queue and returned alone.
+# Leased and delayed jobs were claimed before, so they are in the slot.
+#
+# KEYS: work queue, lease queue, delayed retry queue, lanes, scheduled queue,
+#       rejected queue
+# ARGV: updated_at, updated_by, failed_status, failed_reason, now,
+#       lease_expiry, policy, window, aging_rate, default_deadline,
+#       affinity_window, max_skips, number of models,
+#       number of valid extensions, slot_tag or "", *models,
+#       *valid_extensions, *invalid_extensions
+CLAIM_SCRIPT = """
+local now = tonumber(ARGV[5])
+local policy = ARGV[7]
+local affinity_window = tonumber(ARGV[11])
+local max_skips = tonumber(ARGV[12])
+local num_models = tonumber(ARGV[13])
+local num_valid = tonumber(ARGV[14])
+local slot_tag = ARGV[15]
+
+local models = {}
+for i = 16, 15 + num_models do
+    models[ARGV[i]] = true
+end
+local first_ext = 16 + num_models
+
+-- whether the key is hashed to the slot of the work queue.
+local function in_slot(key)
+    if slot_tag == '' then
+        return true
+    end
+    local first = string.find(key, '{', 1, true)
+    if first then
+        local last = string.find(key, '}', first + 1, true)
+        if last and last > first + 1 then
+            return string.sub(key, first + 1, last - 1) == slot_tag
+        end
+    end
+    return key == slot_tag
+end
+
+local function endswith(str, suffix)
+    return string.sub(str, -string.len(suffix)) == suffix
+end
+
+local function is_valid(fname)
+    local valid = num_valid == 0
+    for i = first_ext, first_ext + num_valid - 1 do
+        if endswith(fname, ARGV[i]) then
+            valid = true
+            break
+        end
+    end
+    for i = first_ext + num_valid, #ARGV do
+        if endswith(fname, ARGV[i]) then
+            return false
+        end
+    end
+    return valid
+end
+
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[5],
+                           'LIMIT', 0, 10)
+for _, key in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], key)
+    redis.call('HINCRBY', key, 'claim_token', 1)
+    redis.call('RPUSH', KEYS[1], key)
+end
+
+local due = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[5],
+                       'LIMIT', 0, 10)
+for _, key in ipairs(due) do
+    redis.call('ZREM', KEYS[3], key)
+    redis.call('RPUSH', KEYS[1], key)
+end
+
+local function pop_from(queue)
+    if policy ~= 'fifo' or affinity_window == 0 or num_models == 0 then
+        return redis.call('RPOP', queue)
+    end
+
+    -- the oldest job is the last one.
+    local jobs = redis.call('LRANGE', queue, -affinity_window, -1)
+    for i = #jobs, 1, -1 do
+        if not in_slot(jobs[i]) then
+            break
+        end
+        local name, version = unpack(
+            redis.call('HMGET', jobs[i], 'model_name', 'model_version'))
+        if models[(name or '') .. ':' .. (version or '')] then
+            if i == #jobs then
+                break
+            end
+            local skips = redis.call('HINCRBY', jobs[#jobs],
+                                     'affinity_skips', 1)
+            if skips > max_skips then
+                break
+            end
+            redis.call('LREM', queue, -1, jobs[i])
+            return jobs[i]
+        end
+    end
+    return redis.call('RPOP', queue)
+end
+
+local function pop()
+    if redis.call('ZCARD', KEYS[4]) == 0 then
+        return pop_from(KEYS[1])
+    end
+
+    if not redis.call('ZSCORE', KEYS[4], KEYS[1]) then
+        local first = redis.call('ZRANGE', KEYS[4], 0, 0, 'WITHSCORES')
+        redis.call('ZADD', KEYS[4], first[2], KEYS[1])
+    end
+
+    for _, lane in ipairs(redis.call('ZRANGE', KEYS[4], 0, -1)) do
+        local key = pop_from(lane)
+        if key then
+            local last = redis.call('ZREVRANGE', KEYS[4], 0, 0, 'WITHSCORES')
+            redis.call('ZADD', KEYS[4], tonumber(last[2]) + 1, lane)
+            return key
+        end
+        if lane ~= KEYS[1] then
+            redis.call('ZREM', KEYS[4], lane)
+        end
+    end
+
+    -- every lane is empty.
+    redis.call('DEL', KEYS[4])
+    return nil
+end
+
+local function next_job()
+    if policy == 'fifo' then
+        local job = redis.call('ZPOPMIN', KEYS[5])
+        return job[1] or pop()
+    end
+
+    for _ = 1, tonumber(ARGV[8]) do
+        local key = pop()
+        if not key then
+            break
+        end
+        -- a job hash in another slot is popped first, to be rejected.
+        local score = '-inf'
+        if in_slot(key) then
+            local cost, deadline = unpack(
+                redis.call('HMGET', key, 'cost', 'deadline'))
+            if policy == 'edf' then
+                score = tonumber(deadline) or now + tonumber(ARGV[10])
+            else
+                score = (tonumber(cost) or 0) + tonumber(ARGV[9]) * now
+            end
+        end
+        redis.call('ZADD', KEYS[5], score, key)
+    end
+
+    local job = redis.call('ZPOPMIN', KEYS[5])
+    return job[1]
+end
+
+while true do
+    local key = next_job()
+    if not key then
+        return nil
+    end
+
+    if not in_slot(key) then
+        redis.call('LPUSH', KEYS[6], key)
+        return {key}
+    end
+
+    local fname = redis.call('HGET', key, 'input_file_name')
+    if not fname then
+        fname = 'None'
+    end
+
+    if is_valid(string.lower(fname))
+            or redis.call('HEXISTS', key, 'parent') == 1 then
+        redis.call('HINCRBY', key, 'claim_token', 1)
+        redis.call('HMSET', key, 'updated_at', ARGV[1], 'updated_by', ARGV[2])
+        redis.call('ZADD', KEYS[2], ARGV[6], key)
+        local result = redis.call('HGETALL', key)
+        table.insert(result, 1, key)
+        return result
+    end
+
+    redis.call('HMSET', key, 'status', ARGV[3], 'reason', ARGV[4],
+               'updated_at', ARGV[1], 'updated_by', ARGV[2])
+end
+"""
+
+# Push a job onto a lane of the work queue.
+# A new lane is served next, but only once before the existing lanes.
+# KEYS: lane, lanes
+# ARGV: job hash
+LANE_PUSH_SCRIPT = """
+if not redis.call('ZSCORE', KEYS[2], KEYS[1]) then
+    local first = redis.call('ZRANGE', KEYS[2], 0, 0, 'WITHSCORES')
+    redis.call('ZADD', KEYS[2], first[2] or 0, KEYS[1])
+end
+return redis.call('LPUSH', KEYS[1], ARGV[1])
+"""
+
+# Renew the lease of a claimed job, if the fencing token is still valid.
+# KEYS: lease queue, job hash
+# ARGV: claim_token, lease_expiry
+RENEW_SCRIPT = """
+if redis.call('HGET', KEYS[2], 'claim_token') ~= ARGV[1] then
+    return 0
+end
+redis.call('ZADD', KEYS[1], 'XX', ARGV[2], KEYS[2])
+return 1
+"""
+
+# Release the lease of a claimed job, if the fencing token is still valid.
+# Unfinished jobs are pushed back to the work queue, or scheduled for a
+# delayed retry at the given time. An earlier retry that was scheduled
+# while the job was claimed is kept, and is dropped if the job is finished.
+# KEYS: lease queue, job hash, work queue, delayed retry queue
+# ARGV: claim_token, 1 to push the job back to the work queue or 0,
+#       time of the delayed retry or 0 to push back immediately
+RELEASE_SCRIPT = """
+if redis.call('HGET', KEYS[2], 'claim_token') ~= ARGV[1] then
+    return 0
+end
+redis.call('ZREM', KEYS[1], KEYS[2])
+if ARGV[2] == '1' and tonumber(ARGV[3]) > 0 then
+    redis.call('ZADD', KEYS[4], 'NX', ARGV[3], KEYS[2])
+    return 1
+end
+redis.call('ZREM', KEYS[4], KEYS[2])
+if ARGV[2] == '1' then
+    redis.call('LPUSH', KEYS[3], KEYS[2])
+end
+return 1
+"""
+
+# Renew the lease of a job claimed from a stream, if the fencing token is
+# still valid and the entry is still pending for this consumer.
+# Re-claiming the entry resets its idle time.
+# KEYS: stream, job hash
+# ARGV: claim_token, consumer group, consumer, entry ID
+STREAM_RENEW_SCRIPT = """
+if redis.call('HGET', KEYS[2], 'claim_token') ~= ARGV[1] then
+    return 0
+end
+local pending = redis.call('XPENDING', KEYS[1], ARGV[2],
+                           ARGV[4], ARGV[4], 1)
+if not pending[1] or pending[1][2] ~= ARGV[3] then
+    return 0
+end
+redis.call('XCLAIM', KEYS[1], ARGV[2], ARGV[3], 0, ARGV[4], 'JUSTID')
+return 1
+"""
+
+# Release a job claimed from a stream, if the fencing token is still valid.
+# The entry is acknowledged and deleted. Unfinished jobs are added back to
+# the stream, or scheduled for a delayed retry at the given time.
+# KEYS: stream, job hash, delayed retry queue
+# ARGV: claim_token, consumer group, entry ID,
+#       1 to add the job back to the stream or 0,
+#       time of the delayed retry or 0 to add it back immediately
+STREAM_RELEASE_SCRIPT = """
+if redis.call('HGET', KEYS[2], 'claim_token') ~= ARGV[1] then
+    return 0
+end
+redis.call('XACK', KEYS[1], ARGV[2], ARGV[3])
+redis.call('XDEL', KEYS[1], ARGV[3])
+if ARGV[4] == '1' and tonumber(ARGV[5]) > 0 then
+    redis.call('ZADD', KEYS[3], ARGV[5], KEYS[2])
+elseif ARGV[4] == '1' then
+    redis.call('XADD', KEYS[1], '*', 'hash', KEYS[2])
+end
+return 1
+"""
+
+# Move up to 10 jobs whose delayed retry is due to the stream.
+# KEYS: delayed retry queue, stream
+# ARGV: now
+PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                       'LIMIT', 0, 10)
+for _, key in ipairs(due) do
+    redis.call('ZREM', KEYS[1], key)
+    redis.call('XADD', KEYS[2], '*', 'hash', key)
+end
+return #due
+"""
+
+# Update fields of a claimed job, if the fencing token is still valid.
+# If a status stream is given, the status event is also published to the
+# channel of the job and added to the stream.
+# KEYS: job hash, [status stream]
+# ARGV: claim_token, number of fields and values, *fields_and_values,
+#       [channel, message, max stream length, *event_fields_and_values]
+FENCED_UPDATE_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'claim_token') ~= ARGV[1] then
+    return 0
+end
+local n = tonumber(ARGV[2])
+redis.call('HMSET', KEYS[1], unpack(ARGV, 3, 2 + n))
+if #KEYS > 1 then
+    local i = 3 + n
+    redis.call('PUBLISH', ARGV[i], ARGV[i + 1])
+    redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[i + 2], '*',
+               unpack(ARGV, i + 3))
+end
+return 1
+"""
+
+# Record that a child job has finished in its parent job.
+# The child is moved out of the parent's set of unfinished children and the
+# parent's counter is incremented, so each child is only counted once.
+# If the parent is waiting for its children, the child is pushed onto the
+# parent's event list. Otherwise, the parent is retried later and is moved
+# from its delayed retry queue to its work queue (or stream) as soon as all
+# of its children have finished. A parent that is still claimed is not in
+# its delayed retry queue yet, and is retried as soon as it is released.
+# There is no wake-up for a child that finished without being released by a
+# consumer, nor for a claimed parent of the stream backend (its lease is
+# not in the lease queue): those parents wait for their delayed retry,
+# which also recounts their children.
+# KEYS: unfinished children set, finished children set, parent hash,
+#       parent event list, [parent work queue, parent delayed retry queue,
+#       parent lease queue]
+# ARGV: child hash, counter field, queue backend
+CHILD_FINISHED_SCRIPT = """
+if redis.call('SMOVE', KEYS[1], KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HINCRBY', KEYS[3], ARGV[2], 1)
+
+if #KEYS < 5 then
+    redis.call('RPUSH', KEYS[4], ARGV[1])
+    return 1
+end
+
+local counts = redis.call('HMGET', KEYS[3], 'children:total',
+                          'children:done', 'children:failed')
+local total = tonumber(counts[1])
+local finished = (tonumber(counts[2]) or 0) + (tonumber(counts[3]) or 0)
+if total and finished >= total then
+    if redis.call('ZREM', KEYS[6], KEYS[3]) == 0 then
+        if redis.call('ZSCORE', KEYS[7], KEYS[3]) then
+            redis.call('ZADD', KEYS[6], 0, KEYS[3])
+        end
+    elseif ARGV[3] == 'stream' then
+        redis.call('XADD', KEYS[5], '*', 'hash', KEYS[3])
+    else
+        redis.call('LPUSH', KEYS[5], KEYS[3])
+    end
+end
+return 1
+"""
+
+# All keys of the result cache are in the same hash slot.
+RESULT_CACHE_PREFIX = hash_tag('result-cache')
+
+# Look up the cached result of a job, and mark it as recently used.
+# If there is none, lock the result so that only this job computes it.
+# Returns a flat list of the fields and values of the cached result,
+# 1 if the result was locked for the owner, or 0 if another job holds the lock.
+# KEYS: cached result, cache index, result lock
+# ARGV: result key, now, ttl, owner, lock time in milliseconds
+RESULT_CACHE_GET_SCRIPT = """
+local result = redis.call('HGETALL', KEYS[1])
+if #result > 0 then
+    redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    return result
+end
+redis.call('ZREM', KEYS[2], ARGV[1])
+
+local owner = redis.call('GET', KEYS[3])
+if owner and owner ~= ARGV[4] then
+    return 0
+end
+redis.call('SET', KEYS[3], ARGV[4], 'PX', ARGV[5])
+return 1
+"""
+
+# Cache the result of a job and evict the least recently used results,
+# keeping at most `size` results.
+# KEYS: cached result, cache index
+# ARGV: result key, now, ttl, size, cache prefix, *fields_and_values
+RESULT_CACHE_PUT_SCRIPT = """
+redis.call('HMSET', KEYS[1], unpack(ARGV, 6))
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+
+-- results unused for longer than the ttl have already expired.
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[2] - ARGV[3])
+local excess = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+if excess <= 0 then
+    return 0
+end
+for _, key in ipairs(redis.call('ZRANGE', KEYS[2], 0, excess - 1)) do
+    redis.call('DEL', ARGV[5] .. ':' .. key)
+end
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, excess - 1)
+return excess
+"""
+
+# Renew or release the lock on a result, if it is still held by the owner.
+# KEYS: result lock
+# ARGV: owner, lock time in milliseconds, or 0 to release the lock
+RESULT_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '0' then
+    return redis.call('DEL', KEYS[1])
+end
+return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+"""
+
+
+class LeaseExpiredError(Exception):
+    """The job was re-claimed by another consumer after its lease expired."""
+    pass
+
+
+class JobDeferredError(Exception):
+    """The job does not fit in memory, and is retried later or moved to
+    another work queue.
+
+    Args:
+        message (str): Why the job was deferred.
+        queue (str): Move the job to this work queue, if set.
+        delay (float): Otherwise, retry the job after this many seconds.
+    """
+
+    def __init__(self, message, queue=None, delay=0):
+        super(JobDeferredError, self).__init__(message)
+        self.queue = queue
+        self.delay = delay
 
 
 class Consumer(object):
     """Base class for all redis event consumer classes.
 
+    Jobs are claimed round-robin from the work queue and its lanes, so a
+    parent with many children cannot starve the other jobs in the queue.
+
+    Every claimed job holds a lease which is renewed by a heartbeat thread
+    while the job is being consumed. Jobs with expired leases are put back
+    into the work queue by the next consumer to claim a job, and a fencing
+    token prevents the previous owner from writing to the job.
+
     Args:
         redis_client: obj, Client class to communicate with redis
         storage_client: obj, Client to communicate with cloud storage buckets.
         queue: str, Name of queue to pop off work items.
         final_status: str, Update the status of redis event with this value.
+        queue_backend: str, The type of queue, one of "list" and "stream".
     """
 
+    # Only consume jobs whose `input_file_name` has one of these extensions.
+    # All extensions are valid if empty.
+    valid_file_extensions = ()
+
+    # Never consume jobs whose `input_file_name` has one of these extensions.
+    invalid_file_extensions = ()
+
+    # Estimated peak bytes used per value of the input image, to admit jobs
+    # within MEMORY_BUDGET. Jobs are always admitted if 0.
+    memory_per_value = 0
+
+    # bytes reserved by the admitted jobs of every consumer of this process.
+    _memory_lock = threading.Lock()
+    _memory_reserved = 0
+
+    # fields of the Job hash that change its result, besides the input file.
+    result_fields = (
+        'model_name',
+        'model_version',
+        'preprocess_function',
+        'postprocess_function',
+        'scale',
+        'label',
+    )
+
     def __init__(self,
                  redis_client,
                  storage_client,
@@ -66,7 +569,13 @@ class Consumer(object):
                  final_status='done',
                  failed_status='failed',
                  name=settings.HOSTNAME,
-                 output_dir=settings.OUTPUT_DIR):
+                 output_dir=settings.OUTPUT_DIR,
+                 queue_backend=settings.QUEUE_BACKEND):
+        queue_backend = str(queue_backend).lower()
+        if queue_backend not in {'list', 'stream'}:
+            raise ValueError('Invalid `queue_backend`: "{}"'.format(
+                queue_backend))
+
         self.redis = redis_client
         self.storage = storage_client
         self.queue = str(queue).lower()
@@ -76,60 +585,931 @@ class Consumer(object):
         self.failed_status = failed_status
         self.finished_statuses = {final_status, failed_status}
         self.logger = logging.getLogger(str(self.__class__.__name__))
+        # Deprecated per-consumer processing list, replaced by leases.
         self.processing_queue = 'processing-{queue}:{name}'.format(
             queue=self.queue, name=self.name)
+        self._processing_queue_purged = False
+        # Sorted set of all claimed jobs, scored by lease expiration time.
+        self.lease_queue = self.get_lease_queue_name(self.queue)
+        # unfinished jobs are retried once their score is in the past.
+        self.delayed_queue = self.get_delayed_queue_name(self.queue)
+        # the lanes of the work queue, scored by when they were last served.
+        self.lanes = self.get_lanes_name(self.queue)
+        # jobs ordered by QUEUE_POLICY, if it is not "fifo".
+        self.scheduled_queue = 'scheduled-{}'.format(hash_tag(self.queue))
+        # Job hashes outside the hash slot of the queue, on Redis Cluster.
+        self.rejected_queue = 'rejected-{}'.format(hash_tag(self.queue))
+        self._script_shas = {}
+        # hash values of the claimed jobs, as returned by the claim.
+        self._claimed_values = {}
+        # fencing tokens of the claimed jobs.
+        self._claim_tokens = {}
+        # "model_name:model_version" of the latest claimed jobs.
+        self._recent_models = []
+        # buffered updates of the claimed jobs and their last flush time.
+        self._pending_updates = {}
+        self._last_flush = {}
+        # updates are also flushed by the heartbeat threads.
+        self._updates_lock = threading.RLock()
+        # bytes reserved by each admitted job.
+        self._memory_reservations = {}
+        # (result key, owner) of each job computing a cacheable result.
+        self._result_locks = {}
+
+        # Redis Streams backend
+        self.queue_backend = queue_backend
+        self.stream = self.get_stream_name(self.queue)
+        self.stream_group = settings.STREAM_GROUP
+        self._stream_entries = {}  # claimed redis_hash -> stream entry ID
+        self._stream_group_exists = False
+
+    @classmethod
+    def get_stream_name(cls, queue):
+        """Returns the name of the Redis Stream for the given queue"""
+        return 'stream-{}'.format(hash_tag(queue))
+
+    @classmethod
+    def get_lease_queue_name(cls, queue):
+        """Returns the name of the sorted set of leases of the given queue"""
+        return 'leases-{}'.format(hash_tag(queue))
+
+    @classmethod
+    def get_delayed_queue_name(cls, queue):
+        """Returns the name of the delayed retry queue of the given queue"""
+        return 'delayed-{}'.format(hash_tag(queue))
+
+    @classmethod
+    def get_lanes_name(cls, queue):
+        """Returns the name of the sorted set of lanes of the given queue"""
+        return 'lanes-{}'.format(hash_tag(queue))
+
+    @classmethod
+    def get_cached_result_name(cls, result_key):
+        """Returns the name of the Redis hash of a cached result"""
+        return '{}:{}'.format(RESULT_CACHE_PREFIX, result_key)
+
+    @classmethod
+    def get_result_lock_name(cls, result_key):
+        """Returns the name of the lock on a result being computed"""
+        return '{}:lock:{}'.format(RESULT_CACHE_PREFIX, result_key)
+
+    @classmethod
+    def get_lane_name(cls, queue, lane):
+        """Returns the name of a lane of the given queue"""
+        return 'lane-{}:{}'.format(hash_tag(queue), lane)
+
+    @classmethod
+    def get_children_key(cls, redis_hash, state=None):
+        """Returns the name of the Redis set with the children of the hash.
+
+        Args:
+            redis_hash (str): The parent Job hash.
+            state (str): None for the unfinished children,
+                "done" or "failed" for the finished children.
+
+        Returns:
+            str: The name of the set.
+        """
+        key = '{}:children'.format(redis_hash)
+        if state is not None:
+            key = '{}:{}'.format(key, state)
+        return key
+
+    @classmethod
+    def get_events_key(cls, redis_hash):
+        """Returns the name of the Redis list of finished children."""
+        return '{}:events'.format(redis_hash)
+
+    @classmethod
+    def get_status_channel(cls, redis_hash):
+        """Returns the name of the channel of status events of the hash."""
+        return '{}:status'.format(redis_hash)
+
+    def get_status_stream_name(self, redis_hash):
+        """Returns the name of the Redis Stream of status events.
+
+        Redis Cluster has a status stream in the slot of each queue,
+        so that it can be updated together with the job hash.
+        """
+        if getattr(self.redis, 'is_cluster', False):
+            return '{}-{}'.format(settings.STATUS_STREAM, hash_tag(redis_hash))
+        return settings.STATUS_STREAM
+
+    def _get_status_event(self, redis_hash, data):
+        """Get the status event of an update, if any.
 
-    def _put_back_hash(self, redis_hash):
-        """Put the hash back into the work queue"""
-        key = self.redis.rpoplpush(self.processing_queue, self.queue)
-        if key is None:
-            self.logger.error('RPOPLPUSH got None (%s is empty), key %s was '
-                              'removed somehow. Weird!',
-                              self.processing_queue, redis_hash)
-        elif key != redis_hash:
-            self.logger.error('Whoops! RPOPLPUSH sent key %s to %s instead of '
-                              '%s. Trying to put it back again.',
-                              key, self.queue, redis_hash)
-            self._put_back_hash(redis_hash)
+        Args:
+            redis_hash (str): The updated hash.
+            data (dict): The updated fields and values.
+
+        Returns:
+            dict: The status event, or None if the status and progress of
+                the hash are not updated or status events are disabled.
+        """
+        if not settings.STATUS_EVENTS_ENABLED:
+            return None
+        if 'status' not in data and 'progress' not in data:
+            return None
+
+        event = {'hash': redis_hash}
+        for field in ('status', 'progress', 'updated_at'):
+            if field in data:
+                event[field] = data[field]
+        return event
+
+    def _update_hash(self, redis_hash, data):
+        """Write the fields of an unclaimed hash and its status event
+        in a single round trip.
+
+        Args:
+            redis_hash (str): The hash to update.
+            data (dict): The fields and values to write.
+        """
+        event = self._get_status_event(redis_hash, data)
+        if event is None:
+            self.redis.hmset(redis_hash, data)
+            return
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hmset(redis_hash, data)
+        pipe.publish(self.get_status_channel(redis_hash), json.dumps(event))
+        pipe.xadd(self.get_status_stream_name(redis_hash), event,
+                  maxlen=settings.STATUS_STREAM_MAXLEN, approximate=True)
+        pipe.execute()
+
+    def _notify_parent(self, parent, redis_hash, status, parent_queue=None):
+        """Record the finished child hash in its parent hash.
+
+        A parent without a work queue is waiting for its children and gets
+        each finished child pushed onto its event list. A parent with a work
+        queue is retried as soon as all children have finished.
+
+        Args:
+            parent (str): The parent Job hash.
+            redis_hash (str): The finished child Job hash.
+            status (str): The finished status of the child.
+            parent_queue (str): The work queue of a retried parent.
+
+        Returns:
+            bool: Whether the child was counted, i.e. it was unfinished.
+        """
+        state = 'done' if status == self.final_status else 'failed'
+        keys = [
+            self.get_children_key(parent),
+            self.get_children_key(parent, state),
+            parent,
+            self.get_events_key(parent),
+        ]
+        if parent_queue:
+            delayed_queue = self.get_delayed_queue_name(parent_queue)
+            lease_queue = self.get_lease_queue_name(parent_queue)
+            if self.queue_backend == 'stream':
+                parent_queue = self.get_stream_name(parent_queue)
+            keys.extend([parent_queue, delayed_queue, lease_queue])
+
+        args = [redis_hash, 'children:{}'.format(state), self.queue_backend]
+        counted = self._run_script(CHILD_FINISHED_SCRIPT, keys, args)
+        if not counted:
+            self.logger.warning('Key `%s` is not an unfinished child of '
+                                'parent key `%s`.', redis_hash, parent)
+        return bool(counted)
+
+    def _run_script(self, script, keys, args):
+        """Run the Lua script, loading it into Redis if necessary.
+
+        Args:
+            script (str): The Lua script.
+            keys (list): The keys used by the script.
+            args (list): The arguments of the script.
+
+        Returns:
+            The return value of the script.
+        """
+        sha = self._script_shas.get(script)
+        if sha is not None:
+            try:
+                return self.redis.evalsha(sha, len(keys), *(keys + args))
+            except redis.exceptions.NoScriptError:
+                self.logger.debug('Script %s is not cached by Redis.', sha)
+
+        sha = self.redis.script_load(script)
+        self._script_shas[script] = sha
+        return self.redis.evalsha(sha, len(keys), *(keys + args))
+
+    def put_redis_hash(self, queue, redis_hash, lane=None):
+        """Push a new Job hash onto the given work queue.
+
+        Args:
+            queue (str): The name of the work queue.
+            redis_hash (str): The Job hash to add to the queue.
+            lane (str): Push the hash onto this lane of the work queue,
+                if FAIR_SHARE_ENABLED. Not supported by Redis Streams.
+
+        Raises:
+            ValueError: On Redis Cluster, the hash is not in the hash slot
+                of the work queue.
+        """
+        if not self.is_in_queue_slot(redis_hash, queue):
+            raise ValueError('Key `{}` must contain the hash tag `{}` of '
+                             'queue `{}` on Redis Cluster.'.format(
+                                 redis_hash, hash_tag(queue), queue))
+
+        if self.queue_backend == 'stream':
+            self.redis.xadd(self.get_stream_name(queue), {'hash': redis_hash})
+        elif lane and settings.FAIR_SHARE_ENABLED:
+            keys = [self.get_lane_name(queue, lane), self.get_lanes_name(queue)]
+            self._run_script(LANE_PUSH_SCRIPT, keys, [redis_hash])
         else:
-            pass  # success
+            self.redis.lpush(queue, redis_hash)
 
-    def get_redis_hash(self):
-        """Pop off an item from the Job queue.
+    def _create_stream_group(self):
+        """Create the consumer group of the stream if it does not exist."""
+        if self._stream_group_exists:
+            return
 
-        If a Job hash is invalid it will be failed and removed from the queue.
+        try:
+            self.redis.xgroup_create(self.stream, self.stream_group,
+                                     id='0', mkstream=True)
+            self.logger.info('Created consumer group `%s` for stream `%s`.',
+                             self.stream_group, self.stream)
+        except redis.exceptions.ResponseError as err:
+            if 'BUSYGROUP' not in str(err):
+                raise err
+        self._stream_group_exists = True
+
+    def _ack_stream_entry(self, redis_hash):
+        """Acknowledge and delete the stream entry of the claimed hash."""
+        entry_id = self._stream_entries.pop(redis_hash, None)
+        if entry_id is None:
+            self.logger.error('Could not find the stream entry of key %s.',
+                              redis_hash)
+            return
+        self.redis.xack(self.stream, self.stream_group, entry_id)
+        self.redis.xdel(self.stream, entry_id)
+
+    def _release_hash(self, redis_hash, put_back=False, delay=0):
+        """Release the claim on the hash, optionally putting it back.
+
+        Args:
+            redis_hash (str): The claimed Job hash.
+            put_back (bool): Whether to push the hash back to the work queue.
+            delay (float): Put the hash back after this many seconds.
+
+        Raises:
+            LeaseExpiredError: The hash was re-claimed by another consumer.
+        """
+        token = self._claim_tokens.pop(redis_hash, None) or ''
+        self._last_flush.pop(redis_hash, None)
+        retry_at = time.time() + delay if delay > 0 else 0
+
+        if self.queue_backend == 'stream':
+            entry_id = self._stream_entries.pop(redis_hash, None)
+            if entry_id is None:
+                self.logger.error('Could not find the stream entry of key '
+                                  '%s.', redis_hash)
+                return
+            released = self._run_script(
+                STREAM_RELEASE_SCRIPT,
+                [self.stream, redis_hash, self.delayed_queue],
+                [token, self.stream_group, entry_id, int(put_back), retry_at])
+        else:
+            released = self._run_script(
+                RELEASE_SCRIPT,
+                [self.lease_queue, redis_hash, self.queue, self.delayed_queue],
+                [token, int(put_back), retry_at])
+
+        if not released:
+            raise LeaseExpiredError('Key {} was claimed by another consumer '
+                                    'before it was released.'.format(
+                                        redis_hash))
+
+    def _put_back_hash(self, redis_hash, delay=0):
+        """Put the hash back into the work queue, optionally after a delay"""
+        self._release_hash(redis_hash, put_back=True, delay=delay)
+
+    def get_retry_delay(self, redis_hash):  # pylint: disable=unused-argument
+        """Returns the number of seconds to wait before retrying the
+        unfinished hash.
+
+        Args:
+            redis_hash (str): The unfinished Job hash.
+
+        Returns:
+            float: The number of seconds to wait.
+        """
+        return settings.DO_NOTHING_TIMEOUT
+
+    def _get_lease_expiry(self):
+        """Returns the expiration time of a lease starting now."""
+        return time.time() + settings.LEASE_TIME
+
+    def renew_lease(self, redis_hash):
+        """Extend the lease on a claimed hash by LEASE_TIME seconds.
+
+        Args:
+            redis_hash (str): The claimed Job hash.
+
+        Returns:
+            bool: Whether the lease is still held by this consumer.
+        """
+        token = self._claim_tokens.get(redis_hash)
+        if token is None:
+            return False
+
+        if self.queue_backend == 'stream':
+            entry_id = self._stream_entries.get(redis_hash)
+            if entry_id is None:
+                return False
+            renewed = self._run_script(
+                STREAM_RENEW_SCRIPT, [self.stream, redis_hash],
+                [token, self.stream_group, self.name, entry_id])
+            return bool(renewed)
+
+        renewed = self._run_script(
+            RENEW_SCRIPT, [self.lease_queue, redis_hash],
+            [token, self._get_lease_expiry()])
+        return bool(renewed)
+
+    def _heartbeat(self, redis_hash, stop_event):
+        """Renew the lease on the hash until the stop_event is set.
+
+        Buffered updates of the hash are also written once
+        STATUS_UPDATE_INTERVAL has passed, even during long stages.
+        """
+        lease_interval = settings.LEASE_TIME / 3
+        interval = lease_interval
+        if settings.STATUS_UPDATE_INTERVAL > 0:
+            interval = min(interval, settings.STATUS_UPDATE_INTERVAL)
+
+        last_renewal = timeit.default_timer()
+        while not stop_event.wait(interval):
+            try:
+                self._flush_stale_updates(redis_hash)
+                if timeit.default_timer() - last_renewal < lease_interval:
+                    continue
+                last_renewal = timeit.default_timer()
+                if not self.renew_lease(redis_hash):
+                    self.logger.warning('Lost the lease on key %s.',
+                                        redis_hash)
+                    return
+                self._renew_result_lock(redis_hash)
+            except LeaseExpiredError as err:
+                self.logger.warning('Lost the lease on key %s: %s',
+                                    redis_hash, err)
+                return
+            except Exception as err:  # pylint: disable=broad-except
+                self.logger.error('Failed to renew the lease on key %s due '
+                                  'to %s: %s', redis_hash,
+                                  type(err).__name__, err)
+
+    def _start_heartbeat(self, redis_hash):
+        """Start renewing the lease on the hash in a background thread.
+
+        Returns:
+            threading.Event: Set the event to stop the heartbeat.
+        """
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self._heartbeat,
+                                  args=(redis_hash, stop_event))
+        thread.daemon = True
+        thread.start()
+        return stop_event
+
+    def _claim_redis_hash(self):
+        """Run the claim script.
+
+        Returns:
+            list: The claimed hash followed by its fields and values,
+                or None if the queue is empty.
+        """
+        args = [
+            self.get_current_timestamp(),
+            self.name,
+            self.failed_status,
+            'Invalid filetype for "{}" job.'.format(self.queue),
+            time.time(),
+            self._get_lease_expiry(),
+            settings.QUEUE_POLICY,
+            settings.SCHEDULE_WINDOW,
+            settings.AGING_RATE,
+            settings.DEFAULT_DEADLINE,
+            settings.AFFINITY_WINDOW,
+            settings.AFFINITY_MAX_SKIPS,
+            len(self._recent_models),
+            len(self.valid_file_extensions),
+            self._get_slot_tag(),
+        ]
+        args.extend(self._recent_models)
+        args.extend(self.valid_file_extensions)
+        args.extend(self.invalid_file_extensions)
+        keys = [
+            self.queue,
+            self.lease_queue,
+            self.delayed_queue,
+            self.lanes,
+            self.scheduled_queue,
+            self.rejected_queue,
+        ]
+        return self._run_script(CLAIM_SCRIPT, keys, args)
+
+    def _get_slot_tag(self):
+        """Returns the hash tag of the work queue without its braces,
+        which the claim script requires in every Job hash on Redis Cluster,
+        or an empty string if any Job hash can be claimed."""
+        if not getattr(self.redis, 'is_cluster', False):
+            return ''
+        return hash_tag(self.queue)[1:-1]
+
+    def is_in_queue_slot(self, redis_hash, queue):
+        """Returns True if the hash is in the hash slot of the work queue.
+
+        The scripts of a queue also read and write Job hashes that are not
+        declared as keys, so on Redis Cluster each Job hash must contain the
+        hash tag of its work queue, e.g. ``{predict}:<uuid>:<file>``.
+        Any Job hash is in the slot of any queue otherwise.
+
+        Args:
+            redis_hash (str): The Job hash.
+            queue (str): The name of the work queue.
+
+        Returns:
+            bool: Whether the hash can be used with the keys of the queue.
+        """
+        if not getattr(self.redis, 'is_cluster', False):
+            return True
+        return hash_tag(redis_hash) == hash_tag(queue)
+
+    def _reject_hash(self, redis_hash):
+        """Log a Job hash that was moved to the rejected queue."""
+        self.logger.error('Moved key `%s` to `%s`: on Redis Cluster, Job '
+                          'hashes of queue `%s` must contain its hash tag, '
+                          'e.g. `%s:<uuid>:<file>`.', redis_hash,
+                          self.rejected_queue, self.queue,
+                          hash_tag(self.queue))
+
+    def _claim_stream_entry(self):
+        """Claim a single entry from the stream.
+
+        Entries that have been idle in another consumer's pending list for
+        longer than LEASE_TIME are recovered first.
+        Otherwise, block until a new entry is delivered.
+
+        Returns:
+            tuple: The entry ID and the Job hash, or (None, None).
+        """
+        self._create_stream_group()
+
+        # move the due delayed retries to the stream.
+        self._run_script(PROMOTE_SCRIPT, [self.delayed_queue, self.stream],
+                         [time.time()])
+
+        # recover entries stranded by any consumer in the group.
+        # XAUTOCLAIM is not wrapped by older redis-py clients.
+        response = self.redis.execute_command(
+            'XAUTOCLAIM', self.stream, self.stream_group, self.name,
+            int(settings.LEASE_TIME * 1000), '0-0', 'COUNT', 1)
+
+        for entry_id, fields in response[1]:
+            if not fields:  # entry was deleted, just clear it.
+                self.redis.xack(self.stream, self.stream_group, entry_id)
+                continue
+            if not isinstance(fields, dict):
+                fields = dict(zip(fields[::2], fields[1::2]))
+            self.logger.info('Recovered stranded key `%s` from stream `%s`.',
+                             fields.get('hash'), self.stream)
+            return entry_id, fields.get('hash')
+
+        block = int(settings.EMPTY_QUEUE_TIMEOUT * 1000)
+        response = self.redis.xreadgroup(
+            self.stream_group, self.name, {self.stream: '>'},
+            count=1, block=block if block > 0 else None)
+
+        for _, entries in response or []:
+            for entry_id, fields in entries:
+                return entry_id, fields.get('hash')
+
+        return None, None
+
+    def _get_stream_hash(self):
+        """Claim a valid Job hash from the stream.
 
         Returns:
             str: A valid Redish Job hash, or None if one cannot be found.
         """
         while True:
+            entry_id, redis_hash = self._claim_stream_entry()
 
-            if self.redis.llen(self.queue) == 0:
+            if entry_id is None:
                 return None
 
-            redis_hash = self.redis.rpoplpush(self.queue, self.processing_queue)
-
-            # if queue is empty, return None
-            if redis_hash is None:
-                return redis_hash
+            self._stream_entries[redis_hash] = entry_id
 
-            self.update_key(redis_hash)  # update timestamp that it was touched
+            if not self.is_in_queue_slot(redis_hash, self.queue):
+                self._ack_stream_entry(redis_hash)
+                self.redis.lpush(self.rejected_queue, redis_hash)
+                self._reject_hash(redis_hash)
+                continue
 
-            # if hash is found and valid, return the hash
-            if self.is_valid_hash(redis_hash):
+            hvals = self.redis.hgetall(redis_hash)
+            # invalid children are failed by claim_job, with their parent.
+            if (self.is_valid_file_name(hvals.get('input_file_name'))
+                    or hvals.get('parent')):
+                token = str(self.redis.hincrby(redis_hash, 'claim_token', 1))
+                self._claim_tokens[redis_hash] = token
+                stamps = {}
+                self.update_key(redis_hash, stamps)  # adds updated_* stamps
+                hvals.update(stamps)
+                hvals['claim_token'] = token
+                self._claimed_values[redis_hash] = hvals
                 return redis_hash
 
             # hash is invalid. it should not be in this queue.
             self.logger.warning('Found invalid hash in %s: `%s` with '
-                                'hvals: %s', self.queue, redis_hash,
-                                self.redis.hgetall(redis_hash))
-            # self._put_back_hash(redis_hash)
-            self.redis.lrem(self.processing_queue, 1, redis_hash)
-            # Update redis with failed status
+                                'hvals: %s', self.stream, redis_hash, hvals)
+            self._ack_stream_entry(redis_hash)
+            self.update_key(redis_hash, {
+                'status': self.failed_status,
+                'reason': 'Invalid filetype for "{}" job.'.format(self.queue),
+            })
+
+    def _fail_invalid_child(self, job):
+        """Fail a claimed child job with an invalid file name.
+
+        Unlike other invalid jobs, which are failed in place when they are
+        claimed, a child job is released like a failed job so that its
+        parent does not wait for it.
+
+        Args:
+            job (dict): The state of the claimed job.
+        """
+        redis_hash = job['redis_hash']
+        self.logger.warning('Found invalid child hash in %s: `%s`.',
+                            self.queue, redis_hash)
+        try:
             self.update_key(redis_hash, {
                 'status': self.failed_status,
                 'reason': 'Invalid filetype for "{}" job.'.format(self.queue),
             })
+        except LeaseExpiredError as err:
+            self._abandon_job(job, err)
+        else:
+            self.finish_job(job, self.failed_status)
+
+    def get_job_cost(self, num_pixels, model_name=None):
+        """Estimate the cost of a job, used to order jobs by QUEUE_POLICY.
+
+        Args:
+            num_pixels (int): The number of pixels in the input image.
+            model_name (str): The name or name:version of the model.
+
+        Returns:
+            float: The estimated cost of the job.
+        """
+        model_name = str(model_name or '').split(':')[0]
+        factor = settings.MODEL_COST_FACTORS.get(model_name, 1)
+        return num_pixels * factor
+
+    @classmethod
+    def get_input_shape(cls, hvals):
+        """Returns the shape of the input image recorded in the Job hash.
+
+        Args:
+            hvals (dict): The values of the Job hash.
+
+        Returns:
+            tuple: The shape of the input image, or None if it is unknown.
+        """
+        shape = hvals.get('input_shape')
+        if not shape:
+            return None
+        return tuple(int(x) for x in shape.split(','))
+
+    def estimate_memory(self, shape, model_name=None):
+        """Estimate the peak memory used to consume an input image.
+
+        Args:
+            shape (tuple): The shape of the input image.
+            model_name (str): The name or name:version of the model.
+
+        Returns:
+            int: The estimated peak memory, in bytes.
+        """
+        model_name = str(model_name or '').split(':')[0]
+        factor = settings.MODEL_MEMORY_FACTORS.get(
+            model_name, self.memory_per_value)
+        return int(np.prod(shape) * factor)
+
+    def admit_job(self, redis_hash, shape, model_name=None):
+        """Reserve the estimated peak memory of the job within MEMORY_BUDGET.
+
+        The memory is reserved until the job is released.
+
+        Args:
+            redis_hash (str): The claimed Job hash.
+            shape (tuple): The shape of the input image. The job is admitted
+                if it is None.
+            model_name (str): The name or name:version of the model.
+
+        Raises:
+            JobDeferredError: The job does not fit next to the other jobs
+                of this process, or is moved to LARGE_MEMORY_QUEUE.
+            MemoryError: The job does not fit in MEMORY_BUDGET on its own.
+        """
+        budget = settings.MEMORY_BUDGET * 1024 * 1024
+        if not budget or shape is None:
+            return
+
+        estimate = self.estimate_memory(shape, model_name)
+        self.logger.debug('Key %s with shape %s needs about %s MB.',
+                          redis_hash, shape, estimate // 1024 // 1024)
+        if estimate > budget:
+            reason = 'Job needs about {} MB, more than the {} MB of ' \
+                     'MEMORY_BUDGET.'.format(estimate // 1024 // 1024,
+                                             settings.MEMORY_BUDGET)
+            queue = settings.LARGE_MEMORY_QUEUE
+            if queue and queue != self.queue:
+                if self.is_in_queue_slot(redis_hash, queue):
+                    raise JobDeferredError(reason, queue=queue)
+                self.logger.warning('Key %s cannot be moved to queue `%s` '
+                                    'in another hash slot.', redis_hash, queue)
+            raise MemoryError(reason)
+
+        with self._memory_lock:
+            reserved = Consumer._memory_reserved
+            # a single job is always admitted, even if other jobs use memory.
+            if reserved and reserved + estimate > budget:
+                raise JobDeferredError(
+                    'Job needs about {} MB, but only {} MB are free.'.format(
+                        estimate // 1024 // 1024,
+                        (budget - reserved) // 1024 // 1024),
+                    delay=self.get_retry_delay(redis_hash))
+            Consumer._memory_reserved += estimate
+        self._memory_reservations[redis_hash] = estimate
+        metrics.MEMORY_RESERVED.inc(estimate)
+
+    def admit_input_file(self, redis_hash, fname, model_name=None):
+        """Admit the job with the shape in the header of its input file.
+
+        Call before loading the input file. The shape is recorded in the
+        hash, so that retries are admitted before downloading the file.
+
+        Args:
+            redis_hash (str): The claimed Job hash.
+            fname (str): The downloaded input file.
+            model_name (str): The name or name:version of the model.
+        """
+        if not settings.MEMORY_BUDGET:
+            return
+
+        try:
+            shape = utils.get_image_shape(fname)
+        except Exception as err:  # pylint: disable=broad-except
+            self.logger.warning('Could not read the shape of `%s`, the job '
+                                'is admitted without an estimate: %s',
+                                fname, err)
+            return
+
+        self.update_key(redis_hash, {
+            'input_shape': ','.join(str(int(x)) for x in shape),
+        })
+        self.admit_job(redis_hash, shape, model_name)
+
+    def _release_memory(self, redis_hash):
+        """Release the memory reserved by the job, if any."""
+        estimate = self._memory_reservations.pop(redis_hash, 0)
+        if estimate:
+            with self._memory_lock:
+                Consumer._memory_reserved -= estimate
+            metrics.MEMORY_RESERVED.dec(estimate)
+
+    def get_download_workspace(self, filepath):
+        """Returns a Workspace with room for a file to download.
+
+        The size of the file is only requested if workspaces may be created
+        on a tmpfs. Archives are extracted next to the download and their
+        extracted size is unknown, so they are downloaded to disk.
+
+        Args:
+            filepath (str): The key of the file in the storage bucket.
+
+        Returns:
+            utils.Workspace: The temporary workspace.
+        """
+        size = None
+        is_archive = str(filepath).lower().endswith('.zip')
+        if settings.WORKSPACE_TMPFS and not is_archive:
+            size = self.storage.get_size(filepath)
+        return utils.get_tempdir(size=size)
+
+    def get_result_params(self, hvals):
+        """Returns everything besides the input file that changes the result
+        of the job.
+
+        Args:
+            hvals (dict): The values of the Job hash.
+
+        Returns:
+            list: The parameters of the job, as strings.
+        """
+        params = [self.__class__.__name__]
+        params.extend(str(hvals.get(f, '')) for f in self.result_fields)
+        return params
+
+    def get_result_key(self, fname, hvals):
+        """Returns the key of the result of the job in the result cache.
+
+        Args:
+            fname (str): The downloaded input file.
+            hvals (dict): The values of the Job hash.
+
+        Returns:
+            str: The digest of the input file and the parameters of the job.
+        """
+        params = [utils.get_file_digest(fname)]
+        params.extend(self.get_result_params(hvals))
+        return hashlib.sha256('\n'.join(params).encode('utf-8')).hexdigest()
+
+    def get_cached_result(self, redis_hash, result_key):
+        """Returns the cached result of an identical job.
+
+        If there is none, only this job computes the result. It is cached
+        with cache_result, and identical jobs are retried until then.
+
+        Args:
+            redis_hash (str): The claimed Job hash.
+            result_key (str): The key of the result, from get_result_key.
+
+        Returns:
+            dict: The cached values of the Job hash, or None if this job
+                computes the result.
+
+        Raises:
+            JobDeferredError: An identical job is computing the result.
+        """
+        if not settings.RESULT_CACHE_ENABLED:
+            return None
+
+        # claim tokens are only unique per hash.
+        owner = '{}:{}'.format(redis_hash, self._claim_tokens.get(redis_hash))
+        keys = [
+            self.get_cached_result_name(result_key),
+            '{}:index'.format(RESULT_CACHE_PREFIX),
+            self.get_result_lock_name(result_key),
+        ]
+        args = [
+            result_key,
+            time.time(),
+            settings.RESULT_CACHE_TTL,
+            owner,
+            settings.LEASE_TIME * 1000,
+        ]
+        result = self._run_script(RESULT_CACHE_GET_SCRIPT, keys, args)
+
+        if isinstance(result, list):
+            metrics.RESULT_CACHE_REQUESTS.labels(self.queue, 'hit').inc()
+            self.logger.debug('Found cached result %s for key %s.',
+                              result_key, redis_hash)
+            return dict(zip(result[::2], result[1::2]))
+
+        if not result:
+            metrics.RESULT_CACHE_REQUESTS.labels(self.queue, 'wait').inc()
+            raise JobDeferredError(
+                'An identical job is in progress.',
+                delay=self.get_retry_delay(redis_hash))
+
+        metrics.RESULT_CACHE_REQUESTS.labels(self.queue, 'miss').inc()
+        self._result_locks[redis_hash] = (result_key, owner)
+        return None
+
+    def cache_result(self, redis_hash, values):
+        """Cache the result computed by the job, if it was locked by
+        get_cached_result.
+
+        Args:
+            redis_hash (str): The claimed Job hash.
+            values (dict): The values of the Job hash that make up the result.
+        """
+        if redis_hash not in self._result_locks:
+            return
+
+        result_key, _ = self._result_locks[redis_hash]
+        keys = [
+            self.get_cached_result_name(result_key),
+            '{}:index'.format(RESULT_CACHE_PREFIX),
+        ]
+        args = [
+            result_key,
+            time.time(),
+            settings.RESULT_CACHE_TTL,
+            settings.RESULT_CACHE_SIZE,
+            RESULT_CACHE_PREFIX,
+        ]
+        for k, v in values.items():
+            args.extend([k, v])
+
+        evicted = self._run_script(RESULT_CACHE_PUT_SCRIPT, keys, args)
+        if evicted:
+            self.logger.debug('Evicted %s cached results.', evicted)
+
+    def _use_cached_result(self, redis_hash, result, start):
+        """Finish the job with the cached result of an identical job.
+
+        Args:
+            redis_hash (str): The claimed Job hash.
+            result (dict): The cached result, from get_cached_result.
+            start (float): When the job was started.
+
+        Returns:
+            str: The final status of the job.
+        """
+        values = dict(result)
+        values.update({
+            'status': self.final_status,
+            'cached': 1,
+            'total_jobs': 1,
+            'total_time': timeit.default_timer() - start,
+            'finished_at': self.get_current_timestamp(),
+        })
+        self.update_key(redis_hash, values)
+        return self.final_status
+
+    def _renew_result_lock(self, redis_hash):
+        """Extend the lock on the result computed by the job, if any."""
+        if redis_hash in self._result_locks:
+            result_key, owner = self._result_locks[redis_hash]
+            self._run_script(RESULT_LOCK_SCRIPT,
+                             [self.get_result_lock_name(result_key)],
+                             [owner, settings.LEASE_TIME * 1000])
+
+    def _release_result_lock(self, redis_hash):
+        """Let identical jobs use the cached result, or compute it if the
+        job did not finish."""
+        if redis_hash in self._result_locks:
+            result_key, owner = self._result_locks.pop(redis_hash)
+            self._run_script(RESULT_LOCK_SCRIPT,
+                             [self.get_result_lock_name(result_key)],
+                             [owner, 0])
+
+    def get_redis_hash(self):
+        """Pop off an item from the Job queue.
+
+        The item is claimed atomically by a Lua script in a single round trip,
+        which also puts back any jobs whose lease has expired.
+        If a Job hash is invalid it will be failed and removed from the queue.
+
+        Returns:
+            str: A valid Redish Job hash, or None if one cannot be found.
+        """
+        if self.queue_backend == 'stream':
+            return self._get_stream_hash()
+
+        result = self._claim_redis_hash()
+        while result and len(result) == 1:
+            self._reject_hash(result[0])
+            result = self._claim_redis_hash()
+
+        # if queue is empty, return None
+        if not result:
+            return None
+
+        redis_hash = result[0]
+        hvals = dict(zip(result[1::2], result[2::2]))
+        self._claimed_values[redis_hash] = hvals
+        self._claim_tokens[redis_hash] = hvals.get('claim_token')
+        self._add_recent_model(hvals)
+        return redis_hash
+
+    def _add_recent_model(self, hvals):
+        """Prefer jobs for the model of the claimed job in the next claims.
+
+        Args:
+            hvals (dict): The values of the claimed Job hash.
+        """
+        if not hvals.get('model_name'):
+            return
+        model = '{}:{}'.format(hvals.get('model_name'),
+                               hvals.get('model_version', ''))
+        if model in self._recent_models:
+            self._recent_models.remove(model)
+        self._recent_models.insert(0, model)
+        del self._recent_models[settings.AFFINITY_MODELS:]
+
+    def get_redis_values(self, redis_hash):
+        """Get all values of the Job hash.
+
+        Uses the values returned when the job was claimed if available,
+        otherwise the values are read from Redis.
+
+        Args:
+            redis_hash (str): The Job hash.
+
+        Returns:
+            dict: All fields and values of the Job hash.
+        """
+        hvals = self._claimed_values.pop(redis_hash, None)
+        if hvals is None:
+            hvals = self.redis.hgetall(redis_hash)
+        return hvals
 
     def _handle_error(self, err, redis_hash):
         """Update redis with failure information, and log errors.
@@ -146,16 +1526,39 @@ class Consumer(object):
         self.logger.error('Failed to process redis key %s due to %s: %s',
                           redis_hash, type(err).__name__, err)
 
-    def is_valid_hash(self, redis_hash):  # pylint: disable=unused-argument
+    def is_valid_file_name(self, fname):
+        """Returns True if the file extension is valid for the consumer."""
+        fname = str(fname).lower()
+        if any(fname.endswith(e) for e in self.invalid_file_extensions):
+            return False
+        if not self.valid_file_extensions:
+            return True
+        return any(fname.endswith(e) for e in self.valid_file_extensions)
+
+    def is_valid_hash(self, redis_hash):
         """Returns True if the consumer should work on the item"""
-        return True
+        if not self.valid_file_extensions and not self.invalid_file_extensions:
+            return True
+
+        if redis_hash is None:
+            return False
+
+        fname = self.redis.hget(redis_hash, 'input_file_name')
+        return self.is_valid_file_name(fname)
 
     def get_current_timestamp(self):
         """Helper function, returns ISO formatted UTC timestamp"""
         return datetime.datetime.now(pytz.UTC).isoformat()
 
     def purge_processing_queue(self):
-        """Move all items from the processing queue to the work queue"""
+        """Move all items from the processing queue to the work queue.
+
+        Processing queues are no longer used since claims are tracked with
+        leases, but may still hold keys stranded by an older consumer.
+        """
+        if self.queue_backend == 'stream':
+            return  # stranded entries are recovered with XAUTOCLAIM.
+
         queue_has_items = True
         while queue_has_items:
             key = self.redis.rpoplpush(self.processing_queue, self.queue)
@@ -168,10 +1571,24 @@ class Consumer(object):
     def update_key(self, redis_hash, data=None):
         """Update the hash with `data` and updated_by & updated_at stamps.
 
+        Updates to a hash claimed by this consumer are buffered and merged,
+        and written at most every STATUS_UPDATE_INTERVAL seconds, by the
+        next update or by the heartbeat of the hash.
+        The first update and any finished status are written immediately.
+        Buffered updates are only applied if the claim has not been taken
+        over by another consumer.
+
+        If STATUS_EVENTS_ENABLED, every written change of the `status` or
+        `progress` is also published to the status channel of the hash and
+        added to the status stream, in the same round trip.
+
         Args:
             redis_hash (str): The hash that will be updated
             status (str): The new status value
             data (dict): Optional data to include in the hmset call
+
+        Raises:
+            LeaseExpiredError: The hash was re-claimed by another consumer.
         """
         if data is not None and not isinstance(data, dict):
             raise ValueError('`data` must be a dictionary, got {}.'.format(
@@ -182,77 +1599,345 @@ class Consumer(object):
             'updated_at': self.get_current_timestamp(),
             'updated_by': self.name,
         })
-        self.redis.hmset(redis_hash, data)
+
+        if redis_hash not in self._claim_tokens:
+            self._update_hash(redis_hash, data)
+            return
+
+        with self._updates_lock:
+            self._pending_updates.setdefault(redis_hash, {}).update(data)
+
+            last_flush = self._last_flush.get(redis_hash)
+            if (last_flush is None or
+                    data.get('status') in self.finished_statuses or
+                    timeit.default_timer() - last_flush >=
+                    settings.STATUS_UPDATE_INTERVAL):
+                self.flush_updates(redis_hash)
+
+    def _flush_stale_updates(self, redis_hash):
+        """Write the buffered updates of the claimed hash, if they were
+        buffered for longer than STATUS_UPDATE_INTERVAL seconds."""
+        with self._updates_lock:
+            last_flush = self._last_flush.get(redis_hash)
+            if (redis_hash in self._pending_updates and
+                    last_flush is not None and
+                    timeit.default_timer() - last_flush >=
+                    settings.STATUS_UPDATE_INTERVAL):
+                self.flush_updates(redis_hash)
+
+    def flush_updates(self, redis_hash):
+        """Write all buffered updates of the claimed hash to Redis.
+
+        Args:
+            redis_hash (str): The claimed hash.
+
+        Raises:
+            LeaseExpiredError: The hash was re-claimed by another consumer.
+        """
+        with self._updates_lock:
+            data = self._pending_updates.pop(redis_hash, None)
+            self._last_flush[redis_hash] = timeit.default_timer()
+            if data:
+                self._write_updates(redis_hash, data)
+
+    def _write_updates(self, redis_hash, data):
+        """Write the updates of the claimed hash, if it is still claimed."""
+        keys = [redis_hash]
+        args = [self._claim_tokens.get(redis_hash) or '', 2 * len(data)]
+        for k, v in data.items():
+            args.extend([k, v])
+
+        event = self._get_status_event(redis_hash, data)
+        if event is not None:
+            keys.append(self.get_status_stream_name(redis_hash))
+            args.extend([
+                self.get_status_channel(redis_hash),
+                json.dumps(event),
+                settings.STATUS_STREAM_MAXLEN,
+            ])
+            for k, v in event.items():
+                args.extend([k, v])
+
+        if not self._run_script(FENCED_UPDATE_SCRIPT, keys, args):
+            raise LeaseExpiredError('Key {} was claimed by another consumer.'
+                                    ' Refusing to update {}.'.format(
+                                        redis_hash, list(data)))
 
     def _consume(self, redis_hash):
         """Consume the Redis Job. All Consumers must implement this function"""
         raise NotImplementedError
 
-    def consume(self):
-        """Find a redis key and process it"""
-        start = timeit.default_timer()
+    def get_stages(self):
+        """Returns the stages of a job, to consume many jobs at the same time
+        with a pipeline.StagedEngine.
+
+        Returns:
+            list: The pipeline.Stages of a job, or None if not supported.
+        """
+        return None
+
+    def claim_job(self):
+        """Claim a job from the work queue and start renewing its lease.
+
+        Returns:
+            dict: The state of the claimed job, or None if there is no job.
+        """
+        # new tuning parameters are applied before claiming a job, but are
+        # also used by the other jobs in flight with a concurrent engine.
+        live_settings.refresh(self.redis)
 
-        # Purge the processing queue in case of stranded keys
-        self.purge_processing_queue()
+        if not self._processing_queue_purged:
+            # Purge the processing queue in case of stranded keys
+            self.purge_processing_queue()
+            self._processing_queue_purged = True
 
+        start_time = time.time()
+        start = timeit.default_timer()
         redis_hash = self.get_redis_hash()
+        claim_time = timeit.default_timer() - start
+        metrics.CLAIM_SECONDS.labels(self.queue).observe(claim_time)
 
-        if redis_hash is not None:  # popped something off the queue
-            try:
-                status = self._consume(redis_hash)
-            except Exception as err:  # pylint: disable=broad-except
-                # log the error and update redis with details
-                self._handle_error(err, redis_hash)
-                status = self.failed_status
+        if redis_hash is None:
+            if self.queue_backend == 'stream':
+                # XREADGROUP has already blocked for EMPTY_QUEUE_TIMEOUT.
+                self.logger.debug('Stream `%s` is empty.', self.stream)
+            else:  # queue is empty
+                self.logger.debug('Queue `%s` is empty. Waiting for %s '
+                                  'seconds.', self.queue,
+                                  settings.EMPTY_QUEUE_TIMEOUT)
+                time.sleep(settings.EMPTY_QUEUE_TIMEOUT)
+            return None
+
+        metrics.JOBS_IN_FLIGHT.labels(self.queue).inc()
+        claimed_values = self._claimed_values.get(redis_hash, {})
+
+        # continue the trace of the parent job, if any.
+        span = tracing.start_span(
+            'job', traceparent=claimed_values.get('traceparent'),
+            start_time=start_time, queue=self.queue, redis_hash=redis_hash,
+            consumer=self.name)
+        tracing.record_span('claim', claim_time, parent=span)
+        if span.trace_id is not None:
+            # written with the first update of the job.
+            self._pending_updates.setdefault(redis_hash, {}).update({
+                'trace_id': span.trace_id,
+            })
 
-            if status == self.final_status:
-                required_fields = [
-                    'model_name',
-                    'model_version',
-                    'preprocess_function',
-                    'postprocess_function',
-                ]
-                result = self.redis.hmget(redis_hash, *required_fields)
-                hvals = dict(zip(required_fields, result))
-                self.logger.debug('Consumed key %s (model %s:%s, '
-                                  'preprocessing: %s, postprocessing: %s) '
-                                  '(%s retries) in %s seconds.',
-                                  redis_hash, hvals.get('model_name'),
-                                  hvals.get('model_version'),
-                                  hvals.get('preprocess_function'),
-                                  hvals.get('postprocess_function'),
-                                  0, timeit.default_timer() - start)
+        job = {
+            'redis_hash': redis_hash,
+            'parent': claimed_values.get('parent'),
+            'parent_queue': claimed_values.get('parent_queue'),
+            'start': timeit.default_timer(),
+            'stop_heartbeat': self._start_heartbeat(redis_hash),
+            'span': span,
+            'in_flight': True,
+        }
 
-            if status in self.finished_statuses:
-                # this key is done. remove the key from the processing queue.
-                self.redis.lrem(self.processing_queue, 1, redis_hash)
+        if job['parent'] and not self.is_valid_file_name(
+                claimed_values.get('input_file_name')):
+            self._fail_invalid_child(job)
+            return None
 
-            else:
-                # this key is not done yet.
-                # remove it from processing and push it back to the work queue.
-                self._put_back_hash(redis_hash)
-                time.sleep(settings.DO_NOTHING_TIMEOUT)
+        return job
 
-        else:  # queue is empty
-            self.logger.debug('Queue `%s` is empty. Waiting for %s seconds.',
-                              self.queue, settings.EMPTY_QUEUE_TIMEOUT)
-            time.sleep(settings.EMPTY_QUEUE_TIMEOUT)
+    def _end_job(self, job, status):
+        """Stop the heartbeat of the job and record its metrics, once.
+
+        Args:
+            job (dict): The state of the claimed job.
+            status (str): The status of the job, for the metrics.
+        """
+        job['stop_heartbeat'].set()
+        if job.pop('in_flight', False):
+            self._claimed_values.pop(job['redis_hash'], None)
+            self._release_memory(job['redis_hash'])
+            self._release_result_lock(job['redis_hash'])
+            metrics.JOBS_IN_FLIGHT.labels(self.queue).dec()
+            metrics.JOB_SECONDS.labels(self.queue, status).observe(
+                timeit.default_timer() - job['start'])
+            job['span'].set_attribute('status', status)
+            job['span'].end()
+
+    def finish_job(self, job, status):
+        """Release the claimed job once it has been consumed.
+
+        Finished jobs are released, and unfinished jobs are retried later.
+
+        Args:
+            job (dict): The state of the claimed job.
+            status (str): The status of the job after it was consumed.
+        """
+        try:
+            with tracing.use_span(job['span']), tracing.span('release'):
+                self._release_job(job, status)
+        except LeaseExpiredError as err:
+            self._abandon_job(job, err)
+        finally:
+            self._end_job(job, status)
+
+    def _release_job(self, job, status):
+        """Write the buffered updates and release the lease of the job."""
+        redis_hash = job['redis_hash']
+        self.flush_updates(redis_hash)
+
+        if status == self.final_status:
+            required_fields = [
+                'model_name',
+                'model_version',
+                'preprocess_function',
+                'postprocess_function',
+            ]
+            result = self.redis.hmget(redis_hash, *required_fields)
+            hvals = dict(zip(required_fields, result))
+            self.logger.debug('Consumed key %s (model %s:%s, '
+                              'preprocessing: %s, postprocessing: %s) '
+                              '(%s retries) in %s seconds.',
+                              redis_hash, hvals.get('model_name'),
+                              hvals.get('model_version'),
+                              hvals.get('preprocess_function'),
+                              hvals.get('postprocess_function'),
+                              0, timeit.default_timer() - job['start'])
+
+        if status in self.finished_statuses:
+            if job['parent']:
+                self._notify_parent(job['parent'], redis_hash, status,
+                                    job['parent_queue'])
+            # this key is done. release the lease on the key.
+            self._release_hash(redis_hash)
+
+        else:
+            # this key is not done yet. release the lease and
+            # schedule a retry instead of spinning on the key.
+            self._put_back_hash(
+                redis_hash, delay=self.get_retry_delay(redis_hash))
+
+    def fail_job(self, job, err):
+        """Fail the claimed job with the error, and release it.
+
+        Args:
+            job (dict): The state of the claimed job.
+            err (Exception): The error raised while consuming the job.
+        """
+        if isinstance(err, JobDeferredError):
+            self._defer_job(job, err)
+            return
+
+        try:
+            if isinstance(err, LeaseExpiredError):
+                raise err
+            # log the error and update redis with details
+            self._handle_error(err, job['redis_hash'])
+        except LeaseExpiredError as lease_err:
+            self._abandon_job(job, lease_err)
+        else:
+            self.finish_job(job, self.failed_status)
+
+    def _defer_job(self, job, err):
+        """Retry the job later, or move it to another work queue."""
+        redis_hash = job['redis_hash']
+        self.logger.info('Deferred key %s: %s', redis_hash, err)
+        try:
+            with tracing.use_span(job['span']), tracing.span('release'):
+                self.flush_updates(redis_hash)
+                if err.queue:
+                    self.put_redis_hash(err.queue, redis_hash)
+                    self._release_hash(redis_hash)
+                else:
+                    self._put_back_hash(redis_hash, delay=err.delay)
+        except LeaseExpiredError as lease_err:
+            self._abandon_job(job, lease_err)
+        finally:
+            self._end_job(job, 'deferred')
+
+    def _abandon_job(self, job, err):
+        """Forget the job after another consumer claimed it."""
+        redis_hash = job['redis_hash']
+        # another consumer owns the key now, leave it alone.
+        self._claim_tokens.pop(redis_hash, None)
+        self._pending_updates.pop(redis_hash, None)
+        self._last_flush.pop(redis_hash, None)
+        self.logger.warning('Stopped consuming key %s: %s', redis_hash, err)
+        self._end_job(job, 'abandoned')
+
+    def consume(self):
+        """Find a redis key and process it"""
+        job = self.claim_job()
+        if job is None:
+            return
+
+        try:
+            try:
+                with tracing.use_span(job['span']):
+                    status = self._consume(job['redis_hash'])
+            except Exception as err:  # pylint: disable=broad-except
+                self.fail_job(job, err)
+            else:
+                self.finish_job(job, status)
+        finally:
+            # only if finishing the job raised an error.
+            self._end_job(job, 'error')
 
 
 class TensorFlowServingConsumer(Consumer):
     """Adds tf-serving basic functionality for predict calls"""
 
+    # the float32 image, its tiles, the float64 model outputs, their
+    # batches, the untiled outputs and the label image are alive at once.
+    memory_per_value = 128
+
     def __init__(self,
                  redis_client,
                  storage_client,
                  queue,
                  **kwargs):
-        # Create some attributes only used during consume()
-        self._redis_hash = None
-        self._redis_values = dict()
+        # Create some attributes only used during consume().
+        # Each thread has its own, as a StagedEngine runs many jobs at once.
+        self._job_context = threading.local()
+        # runs the processing functions, if set by the AsyncEngine
+        # or the StagedEngine.
+        self.cpu_executor = None
         super(TensorFlowServingConsumer, self).__init__(
             redis_client, storage_client, queue, **kwargs)
 
+    @property
+    def _redis_hash(self):
+        """The Job hash consumed by this thread."""
+        return getattr(self._job_context, 'redis_hash', None)
+
+    @_redis_hash.setter
+    def _redis_hash(self, value):
+        self._job_context.redis_hash = value
+
+    @_redis_hash.deleter
+    def _redis_hash(self):
+        self._job_context.redis_hash = None
+
+    @property
+    def _redis_values(self):
+        """The values of the Job hash consumed by this thread."""
+        return getattr(self._job_context, 'redis_values', {})
+
+    @_redis_values.setter
+    def _redis_values(self, value):
+        self._job_context.redis_values = value
+
+    @_redis_values.deleter
+    def _redis_values(self):
+        self._job_context.redis_values = {}
+
+    @property
+    def _rawshape(self):
+        """The shape of the rescaled image consumed by this thread."""
+        return getattr(self._job_context, 'rawshape', None)
+
+    @_rawshape.setter
+    def _rawshape(self, value):
+        self._job_context.rawshape = value
+
+    @_rawshape.deleter
+    def _rawshape(self):
+        self._job_context.rawshape = None
+
     def _consume(self, redis_hash):
         raise NotImplementedError
 
@@ -420,7 +2105,7 @@ class TensorFlowServingConsumer(Consumer):
                            model_input_name='image',
                            model_dtype='DT_FLOAT',
                            untile=True,
-                           stride_ratio=0.75):
+                           stride_ratio=None):
         """Use tile_image to tile image for the model and untile the results.
 
         Args:
@@ -432,6 +2117,7 @@ class TensorFlowServingConsumer(Consumer):
             model_input_name (str): name of the model's input array.
             untile (bool): untiles results back to image shape if True.
             stride_ratio (float): amount to overlap between tiles, (0, 1].
+                Defaults to STRIDE_RATIO.
 
         Returns:
             numpy.array: untiled results from the model.
@@ -445,10 +2131,17 @@ class TensorFlowServingConsumer(Consumer):
 
         batch_size = int(settings.TF_MAX_BATCH_SIZE // ratio)
 
-        tiles, tiles_info = tile_image(
-            np.expand_dims(image, axis=0),
-            model_input_shape=input_shape,
-            stride_ratio=stride_ratio)
+        # deepcell_toolbox is slow to import, only load it to tile images.
+        from deepcell_toolbox.utils import tile_image, untile_image
+
+        if stride_ratio is None:
+            stride_ratio = settings.STRIDE_RATIO
+
+        with tracing.span('tile_image', shape=str(image.shape)):
+            tiles, tiles_info = tile_image(
+                np.expand_dims(image, axis=0),
+                model_input_shape=input_shape,
+                stride_ratio=stride_ratio)
 
         self.logger.debug('Tiling image of shape %s into shape %s.',
                           image.shape, tiles.shape)
@@ -458,10 +2151,11 @@ class TensorFlowServingConsumer(Consumer):
         results = []
         for t in range(0, tiles.shape[0], batch_size):
             batch = tiles[t:t + batch_size]
-            output = self.grpc_image(
-                batch, model_name, model_version, model_shape,
-                in_tensor_name=model_input_name,
-                in_tensor_dtype=model_dtype)
+            with tracing.span('tile_batch', first_tile=t, size=len(batch)):
+                output = self.grpc_image(
+                    batch, model_name, model_version, model_shape,
+                    in_tensor_name=model_input_name,
+                    in_tensor_dtype=model_dtype)
 
             if not isinstance(output, list):
                 output = [output]
@@ -475,8 +2169,10 @@ class TensorFlowServingConsumer(Consumer):
         if not untile:
             image = results
         else:
-            image = [untile_image(r, tiles_info, model_input_shape=input_shape)
-                     for r in results]
+            with tracing.span('untile_image'):
+                image = [untile_image(r, tiles_info,
+                                      model_input_shape=input_shape)
+                         for r in results]
 
         image = image[0] if len(image) == 1 else image
         return image
@@ -631,6 +2327,8 @@ class TensorFlowServingConsumer(Consumer):
     def _get_processing_function(self, process_type, function_name):
         """Based on the function category and name, return the function.
 
+        Functions given by their dotted path are imported on first use.
+
         Args:
             process_type (str): "pre" or "post" processing
             function_name (str): Name processing function, must exist in
@@ -650,7 +2348,10 @@ class TensorFlowServingConsumer(Consumer):
         if name not in settings.PROCESSING_FUNCTIONS[cat]:
             raise ValueError('"%s" is not a valid %s-processing function'
                              % (name, cat))
-        return settings.PROCESSING_FUNCTIONS[cat][name]
+        func = settings.PROCESSING_FUNCTIONS[cat][name]
+        if isinstance(func, str):
+            func = utils.import_string(func)
+        return func
 
     def process(self, image, key, process_type):
         """Apply the pre- or post-processing function to the image data.
@@ -672,11 +2373,18 @@ class TensorFlowServingConsumer(Consumer):
         if key == 'retinanet-semantic':
             # image[:-1] is targeted at a two semantic head panoptic model
             # TODO This may need to be modified and generalized in the future
-            results = f(image[:-1])
+            args = (image[:-1],)
         elif key == 'retinanet':
-            results = f(image, self._rawshape[0], self._rawshape[1])
+            args = (image, self._rawshape[0], self._rawshape[1])
         else:
-            results = f(image)
+            args = (image,)
+
+        with tracing.span('{}process'.format(process_type), function=key):
+            if self.cpu_executor is None:
+                results = f(*args)
+            else:
+                # limit the number of jobs processing at the same time.
+                results = self.cpu_executor.submit(f, *args).result()
 
         if not isinstance(results, list) and results.shape[0] == 1:
             results = np.squeeze(results, axis=0)
@@ -731,14 +2439,16 @@ class TensorFlowServingConsumer(Consumer):
         return post
 
     def save_output(self, image, redis_hash, save_name, output_shape=None):
-        with utils.get_tempdir() as tempdir:
+        if not isinstance(image, list):
+            image = [image]
+
+        # the images are saved once, and zipped once.
+        size = 2 * sum(im.nbytes for im in image)
+        with utils.get_tempdir(size=size) as tempdir:
             # Save each result channel as an image file
             subdir = os.path.dirname(save_name.replace(tempdir, ''))
             name = os.path.splitext(os.path.basename(save_name))[0]
 
-            if not isinstance(image, list):
-                image = [image]
-
             # Rescale image to original size before sending back to user
             outpaths = []
             added_batch = False
@@ -748,6 +2458,7 @@ class TensorFlowServingConsumer(Consumer):
                         added_batch = True
                         im = np.expand_dims(im, axis=0)  # add batch for resize
                     self.logger.info('Resizing image of shape %s to %s', im.shape, output_shape)
+                    from deepcell_toolbox.utils import resize  # slow to import
                     im = resize(im, output_shape, labeled_image=True)
                     if added_batch:
                         im = im[0]
@@ -772,6 +2483,8 @@ class TensorFlowServingConsumer(Consumer):
 class ZipFileConsumer(Consumer):
     """Consumes zip files and uploads the results"""
 
+    valid_file_extensions = ('.zip',)
+
     def __init__(self,
                  redis_client,
                  storage_client,
@@ -780,26 +2493,43 @@ class ZipFileConsumer(Consumer):
         # zip files go in a new queue
         zip_queue = '{}-zip'.format(queue)
         self.child_queue = queue
+        # number of unfinished children of each waiting key.
+        self._remaining_children = {}
         super(ZipFileConsumer, self).__init__(
             redis_client, storage_client, zip_queue, **kwargs)
 
-    def is_valid_hash(self, redis_hash):
-        if redis_hash is None:
-            return False
+    def get_retry_delay(self, redis_hash):
+        """Wait longer for keys with more unfinished children.
 
-        fname = str(self.redis.hget(redis_hash, 'input_file_name'))
-        return fname.lower().endswith('.zip')
+        The last child to finish retries the key immediately, so the delay
+        is only a fallback. It is the only wake-up of a key if a child
+        finished without being released by a consumer (e.g. it was failed
+        in place by an older consumer, or its hash was deleted), or if the
+        last child finished while the key was claimed from a stream. Such a
+        key waits at most MAX_RETRY_DELAY before its children are recounted.
+        """
+        remaining = self._remaining_children.pop(redis_hash, 1)
+        delay = settings.DO_NOTHING_TIMEOUT * max(remaining, 1)
+        return min(delay, settings.MAX_RETRY_DELAY)
 
     def _upload_archived_images(self, hvalues, redis_hash):
         """Extract all image files and upload them to storage and redis"""
         all_hashes = set()
         archive_uuid = uuid.uuid4().hex
-        with utils.get_tempdir() as tempdir:
-            fname = self.storage.download(hvalues.get('input_file_name'), tempdir)
+        children_key = self.get_children_key(redis_hash)
+        input_file_name = hvalues.get('input_file_name')
+        with self.get_download_workspace(input_file_name) as tempdir:
+            fname = self.storage.download(input_file_name, tempdir)
             image_files = utils.get_image_files_from_dir(fname, tempdir)
             for i, imfile in enumerate(image_files):
 
                 clean_imfile = settings._strip(imfile.replace(tempdir, ''))
+                try:
+                    shape = utils.get_image_shape(imfile)
+                except Exception as err:  # pylint: disable=broad-except
+                    self.logger.warning('Could not estimate the cost of `%s`'
+                                        ': %s', clean_imfile, err)
+                    shape = None
                 # Save each result channel as an image file
                 subdir = os.path.join(archive_uuid, os.path.dirname(clean_imfile))
                 dest, _ = self.storage.upload(imfile, subdir=subdir)
@@ -807,69 +2537,135 @@ class ZipFileConsumer(Consumer):
                 os.remove(imfile)  # remove the file to save some memory
 
                 new_hash = '{prefix}:{file}:{hash}'.format(
-                    prefix=self.child_queue,
+                    prefix=hash_tag(self.child_queue),
                     file=clean_imfile,
                     hash=uuid.uuid4().hex)
 
                 current_timestamp = self.get_current_timestamp()
                 new_hvals = dict()
                 new_hvals.update(hvalues)
-                new_hvals['input_file_name'] = dest
-                new_hvals['original_name'] = clean_imfile
-                new_hvals['status'] = 'new'
-                new_hvals['identity_upload'] = self.name
-                new_hvals['created_at'] = current_timestamp
-                new_hvals['updated_at'] = current_timestamp
 
                 # remove unnecessary/confusing keys (maybe from getting restarted)
                 bad_keys = [
                     'children',
+                    'children:total',
                     'children:done',
                     'children:failed',
+                    'cost',
+                    'input_shape',
+                    'affinity_skips',
                     'identity_started',
+                    'claim_token',
+                    'trace_id',
+                    'traceparent',
                 ]
                 for k in bad_keys:
                     if k in new_hvals:
                         del new_hvals[k]
 
+                new_hvals['input_file_name'] = dest
+                new_hvals['original_name'] = clean_imfile
+                new_hvals['status'] = 'new'
+                new_hvals['identity_upload'] = self.name
+                new_hvals['created_at'] = current_timestamp
+                new_hvals['updated_at'] = current_timestamp
+                new_hvals['parent'] = redis_hash
+                new_hvals['parent_queue'] = self.queue
+                if shape is not None:
+                    new_hvals['input_shape'] = ','.join(str(x) for x in shape)
+                    new_hvals['cost'] = self.get_job_cost(
+                        int(np.prod(shape)), hvalues.get('model_name'))
+
+                # the child continues the trace of this job.
+                traceparent = tracing.get_traceparent()
+                if traceparent:
+                    new_hvals['traceparent'] = traceparent
+
                 self.redis.hmset(new_hash, new_hvals)
-                self.redis.lpush(self.child_queue, new_hash)
+                # the child must be in the set before it can finish.
+                self.redis.sadd(children_key, new_hash)
+                # each zip file gets its own lane in the child queue.
+                self.put_redis_hash(self.child_queue, new_hash, lane=redis_hash)
                 self.logger.debug('Added new hash %s: `%s`', i + 1, new_hash)
                 self.update_key(redis_hash)
                 all_hashes.add(new_hash)
         return all_hashes
 
-    def _get_output_file_name(self, key):
-        fname = None
-        retries = 3
-        for _ in range(retries):
-            # sometimes this field is missing, gotta get the truth!
-            fname = self.redis._redis_master.hget(key, 'output_file_name')
-            if fname is None:
-                ttl = self.redis.ttl(key)
-
-                if ttl == -2:
-                    raise ValueError('Key `%s` does not exist' % key)
-
-                if ttl != -1:
-                    self.logger.warning('Key `%s` has a TTL of %s.'
-                                        'Why has it been expired already?',
-                                        key, ttl)
-                else:
-                    self.logger.warning('Key `%s` exists with TTL %s but has'
-                                        ' no output_file_name', key, ttl)
+    def _recount_children(self, redis_hash):
+        """Count the finished children that did not record themselves.
+
+        Only CHILDREN_RECOUNT_SIZE random unfinished children are checked,
+        so each retry of the key costs a bounded number of round trips.
+        A child whose hash no longer exists is counted as failed.
+
+        Args:
+            redis_hash (str): The waiting Job hash.
+
+        Returns:
+            int: The number of children that were counted.
+        """
+        children = self.redis.srandmember(self.get_children_key(redis_hash),
+                                          settings.CHILDREN_RECOUNT_SIZE)
+        if not children:
+            return 0
+
+        pipe = self.redis.pipeline(transaction=False)
+        for child in children:
+            pipe.hget(child, 'status')
+        statuses = pipe.execute()
+
+        counted = 0
+        for child, status in zip(children, statuses):
+            if status is None:
+                status = self.failed_status
+            if status in self.finished_statuses:
+                self.logger.warning('Child key `%s` of key `%s` finished '
+                                    'without being counted.',
+                                    child, redis_hash)
+                counted += self._notify_parent(redis_hash, child, status,
+                                               self.queue)
+        return counted
+
+    def _reset_children(self, redis_hash):
+        """Forget all children of a previous attempt at the hash."""
+        self.redis.delete(
+            self.get_children_key(redis_hash),
+            self.get_children_key(redis_hash, 'done'),
+            self.get_children_key(redis_hash, 'failed'))
+        self.redis.hdel(redis_hash, 'children:done', 'children:failed')
 
-                self.redis._update_masters_and_slaves()
-                time.sleep(settings.GRPC_BACKOFF)
+    def _get_output_file_name(self, key):
+        # The child was written by another consumer, so read-your-writes
+        # does not apply. Read from the master, which is always up to date.
+        fname = self.redis._redis_master.hget(key, 'output_file_name')
+        if fname is None:
+            ttl = self.redis._redis_master.ttl(key)
+
+            if ttl == -2:
+                raise ValueError('Key `%s` does not exist' % key)
+
+            if ttl != -1:
+                self.logger.warning('Key `%s` has a TTL of %s.'
+                                    'Why has it been expired already?',
+                                    key, ttl)
             else:
-                break
-        else:
-            raise ValueError('Key %s had no value for output_file_name'
-                             ' %s times in a row.' % (key, retries))
+                self.logger.warning('Key `%s` exists with TTL %s but has'
+                                    ' no output_file_name', key, ttl)
+
+            raise ValueError('Key %s had no value for output_file_name.' % key)
         return fname
 
-    def _upload_finished_children(self, finished_children, redis_hash):
-        # saved_files = set()
+    def _upload_finished_children(self, output_files, redis_hash):
+        """Zip up the results of all finished children and upload the zip.
+
+        Args:
+            output_files (dict): The output_file_name of each finished child.
+                Missing values are read from Redis.
+            redis_hash (str): The parent Job hash.
+
+        Returns:
+            tuple: The path and URL of the uploaded zip file.
+        """
         with utils.get_tempdir() as tempdir:
             filename = '{}.zip'.format(uuid.uuid4().hex)
 
@@ -883,11 +2679,12 @@ class ZipFileConsumer(Consumer):
             with zipfile.ZipFile(zip_path, 'w', **zip_kwargs) as zf:
 
                 # process each successfully completed key
-                for key in finished_children:
+                for key, fname in output_files.items():
                     if not key:
                         continue
 
-                    fname = self._get_output_file_name(key)
+                    if fname is None:
+                        fname = self._get_output_file_name(key)
 
                     local_fname = self.storage.download(fname, tempdir)
 
@@ -915,12 +2712,19 @@ class ZipFileConsumer(Consumer):
             self.logger.debug('Uploaded output to: `%s`', url)
             return path, url
 
-    def _parse_failures(self, failed_children):
+    def _parse_failures(self, failed_reasons):
+        """URL-encode the reason of each failed child.
+
+        Args:
+            failed_reasons (dict): The reason each child failed.
+
+        Returns:
+            str: The URL-encoded failures.
+        """
         failed_hashes = {}
-        for key in failed_children:
+        for key, reason in failed_reasons.items():
             if not key:
                 continue
-            reason = self.redis.hget(key, 'reason')
             # one of the hashes failed to process
             self.logger.error('Child key `%s` failed: %s', key, reason)
             failed_hashes[key] = reason
@@ -938,7 +2742,7 @@ class ZipFileConsumer(Consumer):
 
         return url_encode(failed_hashes)
 
-    def _cleanup(self, redis_hash, children, done, failed):
+    def _cleanup(self, redis_hash, total):
         start = timeit.default_timer()
         # get summary data for all finished children
         summary_fields = [
@@ -952,19 +2756,39 @@ class ZipFileConsumer(Consumer):
             'predict_retries',
         ]
 
-        summaries = dict()
+        children_keys = [
+            self.get_children_key(redis_hash),
+            self.get_children_key(redis_hash, 'done'),
+            self.get_children_key(redis_hash, 'failed'),
+        ]
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.smembers(children_keys[1])
+        pipe.smembers(children_keys[2])
+        done, failed = [list(members) for members in pipe.execute()]
+
+        # read the results of all finished children in one round trip.
+        pipe = self.redis.pipeline(transaction=False)
         for d in done:
+            pipe.hmget(d, 'output_file_name', *summary_fields)
+        for f in failed:
+            pipe.hget(f, 'reason')
+        results = pipe.execute()
+
+        output_files = {}
+        summaries = dict()
+        for d, result in zip(done, results):
+            output_files[d] = result[0]
             # TODO: stale data may still be Null, causing missing results.
-            results = self.redis.hmget(d, *summary_fields)
-            for field, result in zip(summary_fields, results):
+            for field, value in zip(summary_fields, result[1:]):
                 try:
                     if field not in summaries:
-                        summaries[field] = [float(result)]
+                        summaries[field] = [float(value)]
                     else:
-                        summaries[field].append(float(result))
+                        summaries[field].append(float(value))
                 except:  # pylint: disable=bare-except
                     self.logger.warning('Summary field `%s` is not a '
-                                        'float: %s', field, result)
+                                        'float: %s', field, value)
 
         # array as joined string
         for k in summaries:
@@ -972,9 +2796,9 @@ class ZipFileConsumer(Consumer):
             # summaries[k] = sum(summaries[k]) / len(summaries[k])
 
         output_file_name, output_url = self._upload_finished_children(
-            done, redis_hash)
+            output_files, redis_hash)
 
-        failures = self._parse_failures(failed)
+        failures = self._parse_failures(dict(zip(failed, results[len(done):])))
 
         t = timeit.default_timer() - start
 
@@ -983,7 +2807,7 @@ class ZipFileConsumer(Consumer):
             'finished_at': self.get_current_timestamp(),
             'output_url': output_url,
             'failures': failures,
-            'total_jobs': len(children),
+            'total_jobs': total,
             'cleanup_time': t,
             'output_file_name': output_file_name
         })
@@ -992,16 +2816,18 @@ class ZipFileConsumer(Consumer):
         self.update_key(redis_hash, summaries)
 
         expire_time = settings.EXPIRE_TIME
-        for key in children:
-            self.redis.expire(key, expire_time)
+        pipe = self.redis.pipeline(transaction=False)
+        for key in done + failed + children_keys:
+            pipe.expire(key, expire_time)
+        pipe.execute()
 
         self.logger.debug('All %s child keys will be expiring in %s '
-                          'seconds.', len(children), expire_time)
+                          'seconds.', len(done) + len(failed), expire_time)
         self.logger.debug('Cleaned up results in %s seconds.', t)
 
     def _consume(self, redis_hash):
         start = timeit.default_timer()
-        hvals = self.redis.hgetall(redis_hash)
+        hvals = self.get_redis_values(redis_hash)
         status = hvals.get('status')
 
         if status in self.finished_statuses:
@@ -1012,60 +2838,60 @@ class ZipFileConsumer(Consumer):
         self.logger.debug('Found hash to process `%s` with status `%s`.',
                           redis_hash, hvals.get('status'))
 
-        key_separator = ','  # char to separate child keys in Redis
-
         self.update_key(redis_hash)  # refresh timestamp
+        retried = status == 'waiting'
 
         if status == 'new':
             # download the zip file, upload the contents, and enter into Redis
+            self._reset_children(redis_hash)
             all_hashes = self._upload_archived_images(hvals, redis_hash)
             self.logger.info('Uploaded %s child keys for key `%s`. Waiting for'
                              ' ImageConsumers.', len(all_hashes), redis_hash)
 
             # Now all images have been uploaded with new redis hashes
-            # Update Redis with child keys and put item back in queue
-            next_status = 'waiting'
+            # Update Redis with child keys and wait for the children.
+            status = 'waiting'
             self.update_key(redis_hash, {
-                'status': next_status,
-                'children': key_separator.join(all_hashes),
+                'status': status,
+                'children:total': len(all_hashes),
                 'children_upload_time': timeit.default_timer() - start,
                 'progress': 0
             })
-            return next_status
+            # children that finished before the total was written
+            # did not wake the parent, so count them now.
+            self.flush_updates(redis_hash)
+            fields = ['children:total', 'children:done', 'children:failed']
+            counts = self.redis.hmget(redis_hash, *fields)
+            hvals = {k: v for k, v in zip(fields, counts) if v is not None}
 
         if status == 'waiting':
             # this key was previously processed by a ZipConsumer
-            # check to see which child keys have already been processed
-            children = set(hvals.get('children', '').split(key_separator))
-            done = set(hvals.get('children:done', '').split(key_separator))
-            failed = set(hvals.get('children:failed', '').split(key_separator))
-
-            # get keys that have not yet reached a completed status
-            remaining_children = children - done - failed
-            for child in remaining_children:
-                child_status = self.redis.hget(child, 'status')
-                if child_status == self.failed_status:
-                    failed.add(child)
-                elif child_status == self.final_status:
-                    done.add(child)
-
-            remaining_children = children - done - failed
-            progress = (len(done) + len(failed)) / len(children)
+            # the children count themselves as done or failed when finished.
+            total = int(hvals.get('children:total', 0))
+            finished = (int(hvals.get('children:done', 0)) +
+                        int(hvals.get('children:failed', 0)))
+
+            remaining_children = total - finished
+            if remaining_children > 0 and retried:
+                # a safety net, in case no child woke this key up.
+                finished += self._recount_children(redis_hash)
+                remaining_children = total - finished
+            progress = finished / total if total else 1
 
             self.logger.info('Key `%s` has %s children waiting for processing',
-                             redis_hash, len(remaining_children))
+                             redis_hash, remaining_children)
 
-            # if there are no remaining children, update status to cleanup
             self.update_key(redis_hash, {
-                'children:done': key_separator.join(d for d in done if d),
-                'children:failed': key_separator.join(f for f in failed if f),
                 'progress': min(100, max(0, round(progress * 100)))
             })
 
-            if not remaining_children:
-                self._cleanup(redis_hash, children, done, failed)
+            # if there are no remaining children, update status to cleanup
+            if remaining_children <= 0:
+                self._cleanup(redis_hash, total)
                 return self.final_status
 
+            # the last child puts this key back in the queue.
+            self._remaining_children[redis_hash] = remaining_children
             return status
 
         self.logger.error('Found strange status for key `%s`: %s.',
@@ -28,18 +28,28 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import concurrent.futures
 import itertools
 import json
 import time
 
+import fakeredis
 import numpy as np
 
 import pytest
 
 from redis_consumer import consumers
 from redis_consumer import settings
+from redis_consumer.consumers import base_consumer
+from redis_consumer.redis import hash_tag
 
 from redis_consumer.testing_utils import Bunch, DummyStorage, redis_client
+from redis_consumer.testing_utils import CountingRedisClient
+
+
+# Redis round trips of each consumed zip file, and of each of its children.
+ZIP_JOB_ROUND_TRIPS = 18
+ZIP_CHILD_ROUND_TRIPS = 3
 
 
 class TestConsumer(object):
@@ -57,23 +67,519 @@ class TestConsumer(object):
         redis_client.lpush(queue_name, item)
         # is_valid_hash returns True by default
         assert consumer.get_redis_hash() == item
-        assert redis_client.llen(consumer.processing_queue) == 1
-        assert redis_client.lpop(consumer.processing_queue) == item
+        assert redis_client.zcard(consumer.lease_queue) == 1
+        assert redis_client.zscore(consumer.lease_queue, item) > time.time()
+        assert redis_client.hget(item, 'claim_token') == '1'
+        consumer._release_hash(item)
+        assert redis_client.zcard(consumer.lease_queue) == 0
         # queue should be empty, get None again
         assert consumer.get_redis_hash() is None
 
         # test invalid hash is failed and removed from queue
-        mocker.patch.object(consumer, 'is_valid_hash', return_value=False)
+        consumer.invalid_file_extensions = ('.zip',)
+        redis_client.hset('invalid', 'input_file_name', 'file.ZIP')
         redis_client.lpush(queue_name, 'invalid')
         assert consumer.get_redis_hash() is None  # invalid hash, returns None
-        # invalid has was removed from the processing queue
-        assert redis_client.llen(consumer.processing_queue) == 0
+        # invalid hash was not leased
+        assert redis_client.zcard(consumer.lease_queue) == 0
         # invalid hash was not returend to the work queue
         assert redis_client.llen(consumer.queue) == 0
+        assert redis_client.hget('invalid', 'status') == consumer.failed_status
+
+        # test invalid hashes are skipped and the valid hash is claimed
+        consumer.valid_file_extensions = ('.tif', '.tiff')
+        hvals = {'input_file_name': 'file.tiff', 'status': 'new'}
+        redis_client.hmset('valid', hvals)
+        redis_client.hset('invalid', 'input_file_name', 'file.png')
+        redis_client.lpush(queue_name, 'invalid', 'valid')
+        assert consumer.get_redis_hash() == 'valid'
+        assert redis_client.zrange(consumer.lease_queue, 0, -1) == ['valid']
+        assert redis_client.llen(consumer.queue) == 0
+
+        # the claimed values are returned by the claim script
+        spy = mocker.spy(redis_client, 'hgetall')
+        claimed = consumer.get_redis_values('valid')
+        assert spy.call_count == 0
+        assert claimed == redis_client.hgetall('valid')
+        assert claimed['updated_by'] == consumer.name
+        # claimed values are only used once.
+        consumer.get_redis_values('valid')
+        assert spy.call_count == 2
+
+        # test the script is reloaded if Redis no longer has it cached
+        consumer._release_hash('valid')
+        redis_client.script_flush()
+        redis_client.lpush(queue_name, 'valid')
+        assert consumer.get_redis_hash() == 'valid'
+
+        # the values of every claimed job are kept until they are used
+        redis_client.hmset('other', hvals)
+        redis_client.lpush(queue_name, 'other')
+        assert consumer.get_redis_hash() == 'other'
+        spy.reset_mock()
+        assert consumer.get_redis_values('valid')['status'] == 'new'
+        assert consumer.get_redis_values('other')['status'] == 'new'
+        assert spy.call_count == 0
+
+    def test_leases(self, mocker, redis_client):
+        mocker.patch.object(settings, 'LEASE_TIME', 60)
+        queue_name = 'q'
+        item = 'item to process'
+        consumer = consumers.Consumer(redis_client, None, queue_name)
+        zombie = consumers.Consumer(redis_client, None, queue_name,
+                                    name='zombie')
 
-        # test llen returns 1 but item is gone by the time the pop happens
-        mocker.patch.object(redis_client, 'llen', lambda x: 1)
+        # the lease is renewed by the heartbeat
+        redis_client.lpush(queue_name, item)
+        assert zombie.get_redis_hash() == item
+        expiry = redis_client.zscore(zombie.lease_queue, item)
+        mocker.patch('time.time', lambda: expiry)
+        assert zombie.renew_lease(item)
+        assert redis_client.zscore(zombie.lease_queue, item) == expiry + 60
+        assert not zombie.renew_lease('unclaimed hash')
+
+        # expired leases are put back and claimed by another consumer
+        mocker.patch('time.time', lambda: expiry + 61)
+        assert consumer.get_redis_hash() == item
+        assert redis_client.zcard(consumer.lease_queue) == 1
+        assert redis_client.hget(item, 'claim_token') == '3'
+
+        # the zombie consumer cannot write to the re-claimed hash
+        assert not zombie.renew_lease(item)
+        with pytest.raises(consumers.base_consumer.LeaseExpiredError):
+            zombie.update_key(item, {'status': 'done'})
+        with pytest.raises(consumers.base_consumer.LeaseExpiredError):
+            zombie._release_hash(item)
+        assert redis_client.hget(item, 'status') is None
+        assert redis_client.zcard(consumer.lease_queue) == 1
+
+        # the current owner can still write and release the hash
+        consumer.update_key(item, {'status': 'done'})
+        assert redis_client.hget(item, 'status') == 'done'
+        consumer._release_hash(item)
+        assert redis_client.zcard(consumer.lease_queue) == 0
+
+        # the zombie stops consuming without failing or putting back the hash
+        redis_client.lpush(queue_name, item)
+        zombie_hash = zombie.get_redis_hash()
+
+        def steal(redis_hash):
+            redis_client.hincrby(redis_hash, 'claim_token', 1)
+            zombie.update_key(redis_hash, {'status': 'stolen'})
+
+        mocker.patch.object(zombie, 'get_redis_hash', lambda: zombie_hash)
+        mocker.patch.object(zombie, '_consume', steal)
+        spy = mocker.spy(zombie, '_handle_error')
+        zombie.consume()
+        spy.assert_not_called()
+        assert redis_client.hget(item, 'status') == 'done'
+        assert redis_client.llen(zombie.queue) == 0
+
+    def test_get_redis_hash_stream(self, mocker, redis_client):
+        mocker.patch.object(settings, 'EMPTY_QUEUE_TIMEOUT', 0)
+        mocker.patch.object(settings, 'LEASE_TIME', 0)
+        queue_name = 'q'
+        consumer = consumers.Consumer(redis_client, None, queue_name,
+                                      queue_backend='stream')
+
+        # test emtpy stream
+        assert consumer.get_redis_hash() is None
+
+        # test valid items are claimed and acknowledged when finished.
+        item = 'item to process'
+        consumer.put_redis_hash(queue_name, item)
+        assert redis_client.xlen(consumer.stream) == 1
+        assert consumer.get_redis_hash() == item
+        assert item in consumer._stream_entries
+        assert consumer.get_redis_values(item)['updated_by'] == consumer.name
+        consumer._ack_stream_entry(item)
+        assert redis_client.xlen(consumer.stream) == 0
+        assert consumer.get_redis_hash() is None
+
+        # test invalid hash is failed and removed from the stream
+        consumer.invalid_file_extensions = ('.zip',)
+        redis_client.hset('invalid', 'input_file_name', 'file.ZIP')
+        consumer.put_redis_hash(queue_name, 'invalid')
         assert consumer.get_redis_hash() is None
+        assert redis_client.xlen(consumer.stream) == 0
+        assert redis_client.hget('invalid', 'status') == consumer.failed_status
+
+        # test entries stranded by another consumer are recovered
+        other = consumers.Consumer(redis_client, None, queue_name,
+                                   queue_backend='stream', name='other')
+        consumer.put_redis_hash(queue_name, item)
+        assert other.get_redis_hash() == item
+        assert consumer.get_redis_hash() == item
+        # the other consumer can neither renew nor release the entry.
+        assert not other.renew_lease(item)
+        with pytest.raises(consumers.base_consumer.LeaseExpiredError):
+            other._put_back_hash(item)
+        assert redis_client.xlen(consumer.stream) == 1
+        assert consumer.renew_lease(item)
+        consumer._release_hash(item)
+        assert redis_client.xlen(consumer.stream) == 0
+        assert redis_client.xpending(
+            consumer.stream, consumer.stream_group)['pending'] == 0
+
+        # the lease is lost once the entry is pending for another consumer.
+        consumer.put_redis_hash(queue_name, item)
+        assert consumer.get_redis_hash() == item
+        redis_client.xclaim(consumer.stream, consumer.stream_group, 'other',
+                            0, [consumer._stream_entries[item]])
+        assert not consumer.renew_lease(item)
+        consumer._release_hash(item)
+
+        # test unfinished items are put back at the end of the stream
+        consumer.put_redis_hash(queue_name, item)
+        assert consumer.get_redis_hash() == item
+        consumer._put_back_hash(item)
+        assert redis_client.xlen(consumer.stream) == 1
+        assert consumer.get_redis_hash() == item
+
+        # test delayed items are moved to the stream when due
+        consumer._put_back_hash(item, delay=100)
+        assert redis_client.xlen(consumer.stream) == 0
+        redis_client.zadd(consumer.delayed_queue, {item: time.time() - 1})
+        assert consumer.get_redis_hash() == item
+
+        # job hashes without the hash tag of the queue, on Redis Cluster
+        mocker.patch.object(redis_client, 'is_cluster', True, create=True)
+        consumer._release_hash(item)
+        redis_client.xadd(consumer.stream, {'hash': item})
+        assert consumer.get_redis_hash() is None
+        assert redis_client.xlen(consumer.stream) == 0
+        assert redis_client.lrange(consumer.rejected_queue, 0, -1) == [item]
+
+        with pytest.raises(ValueError):
+            consumers.Consumer(redis_client, None, queue_name,
+                               queue_backend='invalid')
+
+    def test_get_redis_hash_lanes(self, mocker, redis_client):
+        mocker.patch.object(settings, 'FAIR_SHARE_ENABLED', True)
+        queue_name = 'q'
+        consumer = consumers.Consumer(redis_client, None, queue_name)
+
+        # two parents flood the queue before a single job is added
+        for parent in ('a', 'b'):
+            for i in range(3):
+                consumer.put_redis_hash(queue_name, '{}{}'.format(parent, i),
+                                        lane=parent)
+        consumer.put_redis_hash(queue_name, 'single')
+        assert redis_client.llen(consumer.queue) == 1
+
+        claimed = [consumer.get_redis_hash() for _ in range(8)]
+        assert claimed[-1] is None
+        # each lane is served in turn, including the work queue
+        assert set(claimed[:3]) == {'a0', 'b0', 'single'}
+        assert set(claimed[3:5]) == {'a1', 'b1'}
+        assert set(claimed[5:7]) == {'a2', 'b2'}
+        # all lanes are removed once they are empty
+        assert not redis_client.exists(consumer.lanes)
+
+        # a new lane does not jump ahead of the existing lanes
+        consumer.put_redis_hash(queue_name, 'a3', lane='a')
+        consumer.put_redis_hash(queue_name, 'a4', lane='a')
+        assert consumer.get_redis_hash() == 'a3'
+        consumer.put_redis_hash(queue_name, 'c0', lane='c')
+        consumer.put_redis_hash(queue_name, 'c1', lane='c')
+        consumer.put_redis_hash(queue_name, 'single')
+        claimed = [consumer.get_redis_hash() for _ in range(4)]
+        assert claimed[:2] == ['c0', 'single']
+        assert set(claimed[2:]) == {'a4', 'c1'}
+
+        # lanes are not used if disabled
+        mocker.patch.object(settings, 'FAIR_SHARE_ENABLED', False)
+        consumer.put_redis_hash(queue_name, 'd0', lane='d')
+        assert redis_client.lrange(consumer.queue, 0, -1) == ['d0']
+
+    def test_script_keys_hash_slot(self, mocker, redis_client):
+        mocker.patch.object(settings, 'FAIR_SHARE_ENABLED', True)
+        consumer = consumers.Consumer(redis_client, None, 'predict')
+        spy = mocker.spy(consumer, '_run_script')
+
+        consumer.put_redis_hash('predict', 'predict:x.tif', lane='parent')
+        consumer.put_redis_hash('predict', 'predict-zip:{y}.zip:x.tif',
+                                lane='predict-zip:{y}.zip')
+        assert consumer.get_redis_hash() == 'predict:x.tif'
+
+        # the keys of each script are in the hash slot of the queue
+        scripts = {base_consumer.CLAIM_SCRIPT, base_consumer.LANE_PUSH_SCRIPT}
+        calls = [c for c in spy.call_args_list if c[0][0] in scripts]
+        assert len(calls) == 3
+        for call in calls:
+            keys = call[0][1]
+            assert {hash_tag(k) for k in keys} == {'{predict}'}, keys
+
+    @pytest.mark.parametrize('policy', ['fifo', 'sjf'])
+    def test_get_redis_hash_cluster(self, mocker, redis_client, policy):
+        mocker.patch.object(settings, 'QUEUE_POLICY', policy)
+        mocker.patch.object(settings, 'AFFINITY_WINDOW', 5)
+        mocker.patch.object(redis_client, 'is_cluster', True, create=True)
+        consumer = consumers.Consumer(redis_client, None, 'predict')
+        consumer._recent_models = ['model:1']
+
+        # job hashes without the hash tag of the queue are never read
+        hvals = {'model_name': 'model', 'model_version': '1'}
+        redis_client.hmset('predict:x.tif', hvals)
+        redis_client.hmset('{predict}:y.tif', hvals)
+        redis_client.lpush('predict', 'predict:x.tif', '{predict}:y.tif')
+        assert consumer.get_redis_hash() == '{predict}:y.tif'
+        assert redis_client.lrange(consumer.rejected_queue, 0, -1) == [
+            'predict:x.tif']
+        assert redis_client.hgetall('predict:x.tif') == hvals
+
+        # and cannot be queued
+        with pytest.raises(ValueError):
+            consumer.put_redis_hash('predict', 'predict:x.tif')
+        consumer.put_redis_hash('{predict}-large', '{predict}:y.tif')
+
+        # any job hash is claimed without Redis Cluster
+        mocker.patch.object(redis_client, 'is_cluster', False)
+        redis_client.lpush('predict', 'predict:x.tif')
+        assert consumer.get_redis_hash() == 'predict:x.tif'
+
+    def test_get_redis_hash_policies(self, mocker, redis_client):
+        queue_name = 'q'
+        consumer = consumers.Consumer(redis_client, None, queue_name)
+        now = time.time()
+        jobs = {
+            'large': {'cost': 4000000, 'deadline': now + 10},
+            'small': {'cost': 16000, 'deadline': now + 20},
+            'none': {},
+        }
+        for key, fields in jobs.items():
+            redis_client.hmset(key, dict(fields, status='new'))
+
+        def claim_all():
+            redis_client.lpush(consumer.queue, 'large', 'small', 'none')
+            claimed = [consumer.get_redis_hash() for _ in range(len(jobs))]
+            for key in claimed:
+                consumer._release_hash(key)
+            return claimed
+
+        assert claim_all() == ['large', 'small', 'none']
+
+        mocker.patch.object(settings, 'QUEUE_POLICY', 'sjf')
+        assert claim_all() == ['none', 'small', 'large']
+
+        mocker.patch.object(settings, 'QUEUE_POLICY', 'edf')
+        assert claim_all() == ['large', 'small', 'none']
+
+        # large jobs that have waited long enough are not starved
+        mocker.patch.object(settings, 'QUEUE_POLICY', 'sjf')
+        mocker.patch.object(settings, 'SCHEDULE_WINDOW', 1)
+        mocker.patch.object(settings, 'AGING_RATE', 1000000)
+        # "large" was scheduled 10 seconds ago.
+        redis_client.zadd(consumer.scheduled_queue, {
+            'large': jobs['large']['cost'] + 1000000 * (now - 10)})
+        redis_client.lpush(consumer.queue, 'small')
+        assert consumer.get_redis_hash() == 'large'
+        consumer._release_hash('large')
+
+        # "small" is still scheduled after switching back to fifo
+        mocker.patch.object(settings, 'QUEUE_POLICY', 'fifo')
+        redis_client.lpush(consumer.queue, 'large', 'none')
+        claimed = [consumer.get_redis_hash() for _ in range(len(jobs))]
+        assert claimed == ['small', 'large', 'none']
+        assert redis_client.zcard(consumer.scheduled_queue) == 0
+
+    def test_get_redis_hash_affinity(self, mocker, redis_client):
+        mocker.patch.object(settings, 'AFFINITY_WINDOW', 3)
+        mocker.patch.object(settings, 'AFFINITY_MODELS', 1)
+        mocker.patch.object(settings, 'AFFINITY_MAX_SKIPS', 1)
+        consumer = consumers.Consumer(redis_client, None, 'q')
+
+        models = {
+            'hot0': 'hot', 'hot1': 'hot', 'hot2': 'hot', 'hot3': 'hot',
+            'cold0': 'cold', 'cold1': 'cold',
+        }
+        for key, model in models.items():
+            redis_client.hmset(key, {'model_name': model, 'model_version': 1})
+
+        # oldest jobs are on the right
+        redis_client.lpush(consumer.queue, 'hot0', 'cold0', 'hot1',
+                           'hot2', 'cold1', 'hot3')
+
+        claimed = [consumer.get_redis_hash() for _ in range(len(models))]
+        # no model was claimed before, so hot0 is first. hot1 is claimed
+        # instead of cold0, but cold0 is only skipped once.
+        assert claimed == ['hot0', 'hot1', 'cold0', 'cold1', 'hot2', 'hot3']
+        assert consumer._recent_models == ['hot:1']
+
+        # affinity is disabled by default
+        mocker.patch.object(settings, 'AFFINITY_WINDOW', 0)
+        redis_client.lpush(consumer.queue, 'cold0', 'hot0')
+        assert consumer.get_redis_hash() == 'cold0'
+
+    def test_get_job_cost(self, mocker):
+        consumer = consumers.Consumer(None, None, 'q')
+        mocker.patch.object(settings, 'MODEL_COST_FACTORS', {'Multiplex': 4})
+        assert consumer.get_job_cost(100) == 100
+        assert consumer.get_job_cost(100, 'Nuclear:1') == 100
+        assert consumer.get_job_cost(100, 'Multiplex:2') == 400
+
+    def test_estimate_memory(self, mocker):
+        consumer = consumers.Consumer(None, None, 'q')
+        mocker.patch.object(settings, 'MODEL_MEMORY_FACTORS', {'Multiplex': 4})
+        mocker.patch.object(consumer, 'memory_per_value', 2)
+        assert consumer.get_input_shape({}) is None
+        assert consumer.get_input_shape({'input_shape': '10,5'}) == (10, 5)
+        assert consumer.estimate_memory((10, 5)) == 100
+        assert consumer.estimate_memory((10, 5), 'Nuclear:1') == 100
+        assert consumer.estimate_memory((10, 5), 'Multiplex:2') == 200
+
+    def test_admit_job(self, mocker):
+        mocker.patch.object(settings, 'MEMORY_BUDGET', 1)
+        mocker.patch.object(settings, 'LARGE_MEMORY_QUEUE', '')
+        consumer = consumers.Consumer(None, None, 'q')
+        other = consumers.Consumer(None, None, 'q')
+        mocker.patch.object(consumer, 'memory_per_value', 1)
+        mocker.patch.object(other, 'memory_per_value', 1)
+        half = (512, 1024)
+
+        # jobs are admitted if admission is disabled or the shape is unknown
+        consumer.admit_job('hash', None)
+        mocker.patch.object(settings, 'MEMORY_BUDGET', 0)
+        consumer.admit_job('hash', (1024, 1024, 2))
+        assert not consumer._memory_reservations
+        mocker.patch.object(settings, 'MEMORY_BUDGET', 1)
+
+        # jobs that never fit fail, unless there is a large memory queue
+        with pytest.raises(MemoryError):
+            consumer.admit_job('hash', (1024, 1024, 2))
+        mocker.patch.object(settings, 'LARGE_MEMORY_QUEUE', 'big')
+        with pytest.raises(base_consumer.JobDeferredError) as err:
+            consumer.admit_job('hash', (1024, 1024, 2))
+        assert err.value.queue == 'big'
+
+        # on Redis Cluster, only if the queue is in the slot of the job
+        consumer.redis = Bunch(is_cluster=True)
+        with pytest.raises(MemoryError):
+            consumer.admit_job('{q}:hash', (1024, 1024, 2))
+        mocker.patch.object(settings, 'LARGE_MEMORY_QUEUE', '{q}-big')
+        with pytest.raises(base_consumer.JobDeferredError) as err:
+            consumer.admit_job('{q}:hash', (1024, 1024, 2))
+        assert err.value.queue == '{q}-big'
+        consumer.redis = None
+
+        # jobs are deferred while the memory is reserved by other jobs
+        consumer.admit_job('hash1', half)
+        other.admit_job('hash2', half)
+        with pytest.raises(base_consumer.JobDeferredError) as err:
+            other.admit_job('hash3', (1, 1))
+        assert err.value.queue is None
+        assert err.value.delay == settings.DO_NOTHING_TIMEOUT
+
+        # the memory is released with the job
+        other._release_memory('hash2')
+        other.admit_job('hash3', (1, 1))
+        other._release_memory('hash3')
+        consumer._release_memory('hash1')
+        assert base_consumer.Consumer._memory_reserved == 0
+
+    def test_get_download_workspace(self, tmpdir, mocker):
+        storage = DummyStorage()
+        storage.get_size = mocker.Mock(return_value=60)
+        consumer = consumers.Consumer(None, storage, 'q')
+        tmpfs = str(tmpdir)
+
+        # the size is only needed if there is a tmpfs
+        with consumer.get_download_workspace('file.tif') as tempdir:
+            assert not tempdir.startswith(tmpfs)
+        assert not storage.get_size.called
+
+        # downloads reserve the size of the file on the tmpfs
+        mocker.patch.object(settings, 'WORKSPACE_TMPFS', tmpfs)
+        mocker.patch.object(settings, 'WORKSPACE_TMPFS_BUDGET', 1)
+        mocker.patch('shutil.disk_usage', lambda _: mocker.Mock(used=0))
+        with consumer.get_download_workspace('file.tif') as tempdir:
+            assert tempdir.startswith(tmpfs)
+        storage.get_size.assert_called_once_with('file.tif')
+
+        # files that do not fit, or whose size is unknown, use the disk
+        storage.get_size.return_value = 2 * 1024 * 1024
+        with consumer.get_download_workspace('file.tif') as tempdir:
+            assert not tempdir.startswith(tmpfs)
+        storage.get_size.return_value = None
+        with consumer.get_download_workspace('file.tif') as tempdir:
+            assert not tempdir.startswith(tmpfs)
+
+        # archives are extracted next to the download
+        storage.get_size.reset_mock()
+        with consumer.get_download_workspace('file.ZIP') as tempdir:
+            assert not tempdir.startswith(tmpfs)
+        assert not storage.get_size.called
+
+    def test_result_cache(self, mocker, redis_client):
+        mocker.patch.object(settings, 'RESULT_CACHE_ENABLED', True)
+        mocker.patch.object(settings, 'RESULT_CACHE_SIZE', 2)
+        mocker.patch.object(base_consumer.time, 'time',
+                            side_effect=itertools.count(time.time()))
+        consumer = consumers.Consumer(redis_client, None, 'q')
+        other = consumers.Consumer(redis_client, None, 'q')
+        result = {'output_url': 'url', 'output_file_name': 'output.zip'}
+
+        # the parameters of the job change its key
+        hvals = {'model_name': 'model', 'model_version': '1'}
+        mocker.patch('redis_consumer.utils.get_file_digest', lambda _: 'x')
+        key = consumer.get_result_key('file.tif', hvals)
+        assert key == other.get_result_key('file.tif', dict(hvals))
+        hvals['model_version'] = '2'
+        assert key != consumer.get_result_key('file.tif', hvals)
+
+        # only the first identical job computes the result
+        assert consumer.get_cached_result('hash1', 'key1') is None
+        with pytest.raises(base_consumer.JobDeferredError) as err:
+            other.get_cached_result('hash2', 'key1')
+        assert err.value.delay == settings.DO_NOTHING_TIMEOUT
+        consumer._renew_result_lock('hash1')
+        consumer.cache_result('hash1', result)
+        consumer._release_result_lock('hash1')
+        assert not consumer._result_locks
+
+        # the other jobs use the cached result
+        assert other.get_cached_result('hash2', 'key1') == result
+        assert not other._result_locks
+        name = consumer.get_cached_result_name('key1')
+        assert 0 < redis_client.ttl(name) <= settings.RESULT_CACHE_TTL
+
+        # the result is computed again if the job did not finish
+        assert consumer.get_cached_result('hash3', 'key2') is None
+        consumer._release_result_lock('hash3')
+        assert other.get_cached_result('hash4', 'key2') is None
+        other.cache_result('hash4', result)
+        other._release_result_lock('hash4')
+
+        # the least recently used result is evicted
+        assert consumer.get_cached_result('hash5', 'key1') == result
+        assert consumer.get_cached_result('hash6', 'key3') is None
+        consumer.cache_result('hash6', result)
+        consumer._release_result_lock('hash6')
+        assert not redis_client.exists(consumer.get_cached_result_name('key2'))
+        assert redis_client.exists(consumer.get_cached_result_name('key1'))
+
+        # distinct claimed jobs do not share the lock
+        for redis_hash in ('job1', 'job2'):
+            redis_client.lpush(consumer.queue, redis_hash)
+            assert consumer.get_redis_hash() == redis_hash
+        assert redis_client.hget('job1', 'claim_token') == \
+            redis_client.hget('job2', 'claim_token')
+        assert consumer.get_cached_result('job1', 'key4') is None
+        with pytest.raises(base_consumer.JobDeferredError):
+            consumer.get_cached_result('job2', 'key4')
+        # a job can not release the lock of another job
+        consumer._result_locks['job2'] = consumer._result_locks['job1'][0], \
+            'job2:{}'.format(consumer._claim_tokens['job2'])
+        consumer._release_result_lock('job2')
+        with pytest.raises(base_consumer.JobDeferredError):
+            other.get_cached_result('job3', 'key4')
+        consumer._release_result_lock('job1')
+        assert other.get_cached_result('job3', 'key4') is None
+
+        # results are not cached if the cache is disabled
+        mocker.patch.object(settings, 'RESULT_CACHE_ENABLED', False)
+        assert consumer.get_cached_result('hash7', 'key1') is None
+        assert not consumer._result_locks
 
     def test_purge_processing_queue(self, redis_client):
         queue_name = 'q'
@@ -104,6 +610,121 @@ class TestConsumer(object):
         with pytest.raises(ValueError):
             consumer.update_key('redis-hash', 'data')
 
+    def test_update_key_buffered(self, mocker, redis_client):
+        mocker.patch.object(settings, 'STATUS_UPDATE_INTERVAL', 100)
+        consumer = consumers.Consumer(redis_client, None, 'q')
+        key = 'redis-hash'
+        redis_client.lpush(consumer.queue, key)
+        assert consumer.get_redis_hash() == key
+
+        spy = mocker.spy(consumer, '_run_script')
+
+        # the first update is written immediately
+        consumer.update_key(key, {'status': 'started'})
+        assert redis_client.hget(key, 'status') == 'started'
+
+        # later updates are merged until the interval is over
+        consumer.update_key(key, {'status': 'predicting'})
+        consumer.update_key(key, {'prediction_time': 1})
+        assert redis_client.hget(key, 'status') == 'started'
+        assert spy.call_count == 1
+
+        # finished statuses are written immediately with all pending updates
+        consumer.update_key(key, {'status': consumer.final_status})
+        assert spy.call_count == 2
+        assert redis_client.hget(key, 'status') == consumer.final_status
+        assert redis_client.hget(key, 'prediction_time') == '1'
+
+        # updates are written once the interval is over
+        mocker.patch.object(settings, 'STATUS_UPDATE_INTERVAL', 0)
+        consumer.update_key(key, {'status': 'another status'})
+        assert redis_client.hget(key, 'status') == 'another status'
+
+        # pending updates are flushed explicitly
+        mocker.patch.object(settings, 'STATUS_UPDATE_INTERVAL', 100)
+        consumer.update_key(key, {'progress': 50})
+        assert redis_client.hget(key, 'progress') is None
+        consumer.flush_updates(key)
+        assert redis_client.hget(key, 'progress') == '50'
+
+    def test_update_key_heartbeat(self, mocker, redis_client):
+        mocker.patch.object(settings, 'STATUS_UPDATE_INTERVAL', 0.05)
+        consumer = consumers.Consumer(redis_client, None, 'q')
+        key = 'redis-hash'
+        redis_client.lpush(consumer.queue, key)
+        assert consumer.get_redis_hash() == key
+        renew = mocker.spy(consumer, 'renew_lease')
+
+        consumer.update_key(key, {'status': 'started'})
+        consumer.update_key(key, {'status': 'predicting'})
+        assert redis_client.hget(key, 'status') == 'started'
+
+        # the heartbeat writes the status buffered before a long stage
+        stop_event = consumer._start_heartbeat(key)
+        try:
+            for _ in range(100):
+                if redis_client.hget(key, 'status') == 'predicting':
+                    break
+                time.sleep(0.01)
+            assert redis_client.hget(key, 'status') == 'predicting'
+        finally:
+            stop_event.set()
+        # the lease is still renewed every LEASE_TIME / 3 seconds
+        assert not renew.called
+
+    def test_update_key_status_events(self, mocker, redis_client):
+        mocker.patch.object(settings, 'STATUS_UPDATE_INTERVAL', 100)
+        mocker.patch.object(settings, 'STATUS_EVENTS_ENABLED', True)
+        mocker.patch.object(settings, 'STATUS_STREAM_MAXLEN', 2)
+        consumer = consumers.Consumer(redis_client, None, 'q')
+        stream = consumer.get_status_stream_name('redis-hash')
+        assert stream == settings.STATUS_STREAM
+
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(consumer.get_status_channel('redis-hash'))
+        pubsub.get_message()
+
+        # updates without a status or progress are not published
+        consumer.update_key('redis-hash', {'field': 'value'})
+        assert pubsub.get_message() is None
+        assert redis_client.xlen(stream) == 0
+
+        # unclaimed hashes are updated in a single pipeline
+        spy = mocker.spy(redis_client, 'pipeline')
+        consumer.update_key('redis-hash', {'status': 'new'})
+        spy.assert_called_once_with(transaction=False)
+        event = json.loads(pubsub.get_message()['data'])
+        assert event['hash'] == 'redis-hash'
+        assert event['status'] == 'new'
+        _, fields = redis_client.xrange(stream)[-1]
+        assert fields['hash'] == 'redis-hash'
+        assert fields['status'] == 'new'
+
+        # claimed hashes publish their status with the fenced update
+        redis_client.lpush(consumer.queue, 'redis-hash')
+        assert consumer.get_redis_hash() == 'redis-hash'
+        consumer.update_key('redis-hash', {'status': 'started'})
+        consumer.update_key('redis-hash', {'progress': 50})
+        assert json.loads(pubsub.get_message()['data'])['status'] == 'started'
+        assert pubsub.get_message() is None
+
+        consumer.flush_updates('redis-hash')
+        event = json.loads(pubsub.get_message()['data'])
+        assert event['progress'] == 50
+        _, fields = redis_client.xrange(stream)[-1]
+        assert fields['progress'] == '50'
+        assert spy.call_count == 1
+
+        # the stream is bounded
+        for i in range(200):
+            consumer.update_key('other-hash', {'progress': i})
+        assert redis_client.xlen(stream) < 200
+
+        # each slot has its own stream in a Redis Cluster
+        mocker.patch.object(consumer.redis, 'is_cluster', True, create=True)
+        assert consumer.get_status_stream_name('{q}:x') == '{}-{{q}}'.format(
+            settings.STATUS_STREAM)
+
     def test_handle_error(self, redis_client):
         consumer = consumers.Consumer(redis_client, None, 'q')
         err = Exception('test exception')
@@ -118,28 +739,34 @@ class TestConsumer(object):
     def test__put_back_hash(self, redis_client):
         queue_name = 'q'
 
-        # test emtpy queue
+        # test unclaimed hash
         consumer = consumers.Consumer(redis_client, None, queue_name)
-        consumer._put_back_hash('DNE')  # should be None, shows warning
+        with pytest.raises(consumers.base_consumer.LeaseExpiredError):
+            consumer._put_back_hash('DNE')
 
-        # put back the proper item
-        item = 'redis_hash1'
-        redis_client.lpush(consumer.processing_queue, item)
-        consumer = consumers.Consumer(redis_client, None, queue_name)
-        consumer._put_back_hash(item)
-        assert redis_client.llen(consumer.processing_queue) == 0
-        assert redis_client.llen(consumer.queue) == 1
-        assert redis_client.lpop(consumer.queue) == item
-
-        # put back the wrong item
-        other = 'otherhash'
-        redis_client.lpush(consumer.processing_queue, other, item)
-        consumer = consumers.Consumer(redis_client, None, queue_name)
+        # put back the claimed item behind the other items
+        item, other = 'redis_hash1', 'otherhash'
+        redis_client.lpush(consumer.queue, item, other)
+        assert consumer.get_redis_hash() == item
         consumer._put_back_hash(item)
-        assert redis_client.llen(consumer.processing_queue) == 0
+        assert redis_client.zcard(consumer.lease_queue) == 0
         assert redis_client.llen(consumer.queue) == 2
-        assert redis_client.lpop(consumer.queue) == item
-        assert redis_client.lpop(consumer.queue) == other
+        assert redis_client.rpop(consumer.queue) == other
+        assert redis_client.rpop(consumer.queue) == item
+
+        # put back the claimed item after a delay
+        redis_client.lpush(consumer.queue, item)
+        assert consumer.get_redis_hash() == item
+        consumer._put_back_hash(item, delay=100)
+        assert redis_client.llen(consumer.queue) == 0
+        assert redis_client.zscore(consumer.delayed_queue, item) > time.time()
+        assert consumer.get_redis_hash() is None
+
+        # due items are claimed first
+        redis_client.lpush(consumer.queue, other)
+        redis_client.zadd(consumer.delayed_queue, {item: time.time() - 1})
+        assert consumer.get_redis_hash() == item
+        assert redis_client.zcard(consumer.delayed_queue) == 0
 
     def test_consume(self, mocker, redis_client):
         mocker.patch.object(settings, 'EMPTY_QUEUE_TIMEOUT', 0)
@@ -185,21 +812,48 @@ class TestConsumer(object):
         spy.assert_called_once_with(err, keys[i])
         i += 1
 
-        # status is in progress calls sleep
+        # status is in progress schedules a retry
         mocker.patch.object(consumer, '_consume', in_progress)
         spy = mocker.spy(consumer, '_put_back_hash')
         consumer.consume()
-        spy.assert_called_with(keys[i])
+        spy.assert_called_with(keys[i], delay=settings.DO_NOTHING_TIMEOUT)
+        assert redis_client.zscore(consumer.delayed_queue, keys[i]) > 0
+        i += 1
+
+        # deferred jobs are retried later, or moved to another queue
+        def defer(*_, **__):
+            raise base_consumer.JobDeferredError('deferred', delay=100)
+
+        def move(*_, **__):
+            raise base_consumer.JobDeferredError('moved', queue='big')
+
+        mocker.patch.object(consumer, '_consume', defer)
+        consumer.consume()
+        assert redis_client.zscore(consumer.delayed_queue, keys[i]) > 0
+        assert redis_client.hget(keys[i], 'status') is None
+        i += 1
+
+        mocker.patch.object(consumer, '_consume', move)
+        consumer.consume()
+        assert redis_client.lrange('big', 0, -1) == [keys[i]]
+        assert redis_client.zscore(consumer.lease_queue, keys[i]) is None
+        assert redis_client.hget(keys[i], 'status') is None
         i += 1
 
-        # failed and done statuses call lrem
-        spy = mocker.spy(redis_client, 'lrem')
+        # failed and done statuses release the lease
+        spy = mocker.spy(consumer, '_release_hash')
         for status in (finish, fail):
             mocker.patch.object(consumer, '_consume', status)
             consumer.consume()
-            spy.assert_called_with(consumer.processing_queue, 1, keys[i])
+            spy.assert_called_with(keys[i])
+            assert redis_client.zscore(consumer.lease_queue, keys[i]) is None
             i += 1
 
+        # the processing queue is only purged on the first call
+        spy = mocker.spy(consumer, 'purge_processing_queue')
+        consumer.consume()
+        spy.assert_not_called()
+
     def test__consume(self):
         with np.testing.assert_raises(NotImplementedError):
             consumer = consumers.Consumer(None, None, 'q')
@@ -384,7 +1038,8 @@ class TestTensorFlowServingConsumer(object):
     def test__get_processing_function(self, mocker, redis_client):
         mocker.patch.object(settings, 'PROCESSING_FUNCTIONS', {
             'valid': {
-                'valid': lambda x: True
+                'valid': lambda x: True,
+                'path': 'redis_consumer.settings._identity',
             }
         })
 
@@ -395,6 +1050,10 @@ class TestTensorFlowServingConsumer(object):
         y = consumer._get_processing_function('vAlId', 'VaLiD')
         assert x == y
 
+        # functions are imported by their dotted path
+        x = consumer._get_processing_function('valid', 'path')
+        assert x is settings._identity
+
         with pytest.raises(ValueError):
             consumer._get_processing_function('invalid', 'valid')
 
@@ -435,6 +1094,14 @@ class TestTensorFlowServingConsumer(object):
         output = consumer.process(img, 'retinanet', 'valid')
         np.testing.assert_equal(img[0], output)
 
+        # processing functions run in the CPU executor, if any
+        consumer.cpu_executor = concurrent.futures.ThreadPoolExecutor(1)
+        spy = mocker.spy(consumer.cpu_executor, 'submit')
+        output = consumer.process(img, 'valid', 'valid')
+        np.testing.assert_equal(img[0], output)
+        spy.assert_called_once()
+        consumer.cpu_executor.shutdown()
+
     def test_get_image_scale(self, mocker, redis_client):
         stg = DummyStorage()
         consumer = consumers.TensorFlowServingConsumer(redis_client, stg, 'q')
@@ -490,17 +1157,28 @@ class TestZipFileConsumer(object):
         redis_hash = 'predict:redis_hash:f.zip'
         hsh = consumer._upload_archived_images(hvalues, redis_hash)
         assert len(hsh) == N
+        children_key = consumer.get_children_key(redis_hash)
+        assert redis_client.smembers(children_key) == hsh
+        for h in hsh:
+            assert redis_client.hget(h, 'parent') == redis_hash
 
     def test__upload_finished_children(self, mocker, redis_client):
-        finished_children = ['predict:1.tiff', 'predict:2.zip', '']
+        finished_children = {
+            'predict:1.tiff': None,
+            'predict:2.zip': 'predict:2.zip',
+            '': None,
+        }
         N = 3
         storage = DummyStorage(num=N)
         consumer = consumers.ZipFileConsumer(redis_client, storage, 'predict')
-        mocker.patch.object(consumer, '_get_output_file_name', lambda x: x)
+        spy = mocker.patch.object(consumer, '_get_output_file_name',
+                                  side_effect=lambda x: x)
 
         path, url = consumer._upload_finished_children(
             finished_children, 'predict:redis_hash:f.zip')
         assert path and url
+        # only missing output files are read from redis
+        spy.assert_called_once_with('predict:1.tiff')
 
     def test__get_output_file_name(self, mocker, redis_client):
         # TODO: bad coverage
@@ -543,18 +1221,14 @@ class TestZipFileConsumer(object):
 
         keys = [str(x) for x in range(4)]
         consumer = consumers.ZipFileConsumer(redis_client, storage, 'predict')
-        for key in keys:
-            redis_client.lpush(consumer.queue, key)
-            redis_client.hset(key, 'reason', 'reason{}'.format(key))
+        failed_reasons = {k: 'reason{}'.format(k) for k in keys}
 
-        spy = mocker.spy(redis_client, 'hget')
-        parsed = consumer._parse_failures(keys)
-        spy.assert_called_with(keys[-1], 'reason')
+        parsed = consumer._parse_failures(failed_reasons)
         for key in keys:
             assert '{0}=reason{0}'.format(key) in parsed
 
         # no failures
-        failed_children = ['']
+        failed_children = {'': None}
         parsed = consumer._parse_failures(failed_children)
         assert parsed == ''
 
@@ -573,16 +1247,25 @@ class TestZipFileConsumer(object):
 
         for item in done:
             redis_client.hset(item, 'total_time', 1)  # summary field
+            redis_client.sadd(consumer.get_children_key(redis_hash, 'done'),
+                              item)
         for item in failed:
             redis_client.hset(item, 'reason', 1)  # summary field
+            redis_client.sadd(consumer.get_children_key(redis_hash, 'failed'),
+                              item)
 
         children = done + failed
 
-        consumer._cleanup(redis_hash, children, done, failed)
+        spy = mocker.spy(redis_client, 'pipeline')
+        consumer._cleanup(redis_hash, len(children))
 
         assert redis_client.hget(redis_hash, 'total_jobs') == str(len(children))
+        assert redis_client.hget(redis_hash, 'total_time') == ','.join(
+            ['1.0'] * N)
         for key in children:
             assert redis_client.ttl(key) > 0  # all keys are expired
+        # the number of round trips does not depend on the number of children
+        assert spy.call_count == 3
 
     def test__consume(self, mocker, redis_client):
         N = 3
@@ -609,30 +1292,264 @@ class TestZipFileConsumer(object):
         redis_client.hset(test_hash, 'status', 'new')
         result = consumer._consume(test_hash)
         assert result == 'waiting'
-        assert redis_client.hget(test_hash, 'children') == ','.join(children)
+        assert redis_client.hget(test_hash, 'children:total') == str(len(children))
 
         # test `status` = "waiting"
         status = 'waiting'
         test_hash += 1
-        children = ['done', 'failed', 'waiting', 'move-to-done']
-        child_statuses = ['done', 'failed', 'waiting', 'done']
-        data = {'status': status, 'children': ','.join(children)}
+        data = {
+            'status': status,
+            'children:total': 4,
+            'children:done': 2,
+            'children:failed': 1,
+        }
         redis_client.hmset(test_hash, data)
-        for child, child_status in zip(children, child_statuses):
-            redis_client.hset(child, 'status', child_status)
 
+        hget = mocker.spy(redis_client, 'hget')
         result = consumer._consume(test_hash)
         assert result == status
-        hvals = redis_client.hgetall(test_hash)
-        done_children = set(hvals.get('children:done', '').split(','))
-        assert done_children == {'done', 'move-to-done'}
-        assert hvals.get('children:failed') == 'failed'
+        # the status of each child is never read
+        hget.assert_not_called()
+        assert redis_client.hget(test_hash, 'progress') == '75'
 
-        # set the "waiting" child to "done"
-        redis_client.hset('waiting', 'status', consumer.final_status)
+        # the last child is done
+        redis_client.hincrby(test_hash, 'children:done', 1)
         result = consumer._consume(test_hash)
         assert result == consumer.final_status
-        hvals = redis_client.hgetall(test_hash)
-        done_children = set(hvals.get('children:done', '').split(','))
-        assert done_children == {'done', 'move-to-done', 'waiting'}
-        assert hvals.get('children:failed') == 'failed'
+        assert redis_client.hget(test_hash, 'progress') == '100'
+
+    def test_child_notifies_parent(self, mocker, redis_client):
+        storage = DummyStorage(num=3)
+        zip_consumer = consumers.ZipFileConsumer(redis_client, storage, 'q')
+        parent = 'q-zip:parent.zip'
+        redis_client.hmset(parent, {'status': 'waiting', 'children:total': 3})
+
+        statuses = {
+            'q:done.tif': 'done',
+            'q:failed.tif': 'failed',
+            'q:waiting.tif': 'waiting',
+        }
+        children_key = zip_consumer.get_children_key(parent)
+        for child in statuses:
+            redis_client.hmset(child, {
+                'parent': parent,
+                'input_file_name': child,
+                'status': 'new',
+            })
+            redis_client.sadd(children_key, child)
+            redis_client.lpush('q', child)
+
+        consumer = consumers.Consumer(redis_client, storage, 'q')
+        mocker.patch.object(settings, 'DO_NOTHING_TIMEOUT', 0)
+        mocker.patch.object(consumer, '_consume',
+                            lambda h: statuses[h])
+        for _ in statuses:
+            consumer.consume()
+
+        assert redis_client.hget(parent, 'children:done') == '1'
+        assert redis_client.hget(parent, 'children:failed') == '1'
+        assert redis_client.smembers(children_key) == {'q:waiting.tif'}
+        assert redis_client.smembers(
+            zip_consumer.get_children_key(parent, 'done')) == {'q:done.tif'}
+
+        # children are only counted once
+        consumer._notify_parent(parent, 'q:done.tif', 'done')
+        assert redis_client.hget(parent, 'children:done') == '1'
+
+        # a parent without a queue gets an event for each finished child
+        events = redis_client.lrange(consumer.get_events_key(parent), 0, -1)
+        assert events == ['q:done.tif', 'q:failed.tif']
+
+        # the parent is not done yet
+        assert zip_consumer._consume(parent) == 'waiting'
+
+    def test_waiting_parent_retry(self, mocker, redis_client):
+        storage = DummyStorage(num=3)
+        mocker.patch.object(settings, 'DO_NOTHING_TIMEOUT', 10)
+        mocker.patch.object(settings, 'MAX_RETRY_DELAY', 15)
+        consumer = consumers.ZipFileConsumer(redis_client, storage, 'q')
+        child_consumer = consumers.Consumer(redis_client, storage, 'q')
+        mocker.patch.object(child_consumer, '_consume',
+                            lambda h: child_consumer.final_status)
+        mocker.patch.object(consumer, '_cleanup')
+
+        # a child finishes before the parent is done uploading all children
+        upload = consumer._upload_archived_images
+
+        def upload_children(hvals, redis_hash):
+            hashes = upload(hvals, redis_hash)
+            child_consumer.consume()
+            return hashes
+
+        mocker.patch.object(consumer, '_upload_archived_images',
+                            upload_children)
+
+        parent = 'q-zip:parent.zip'
+        redis_client.hmset(parent, {
+            'status': 'new',
+            'input_file_name': 'parent.zip',
+        })
+        redis_client.lpush(consumer.queue, parent)
+
+        now = time.time()
+        consumer.consume()
+        # the parent is retried later, with a delay capped by MAX_RETRY_DELAY
+        assert redis_client.hget(parent, 'status') == 'waiting'
+        assert redis_client.hget(parent, 'children:done') == '1'
+        assert redis_client.llen(consumer.queue) == 0
+        retry_at = redis_client.zscore(consumer.delayed_queue, parent)
+        assert now + 15 <= retry_at < now + 20
+
+        # the last child puts the parent back immediately
+        child_consumer.consume()
+        assert redis_client.llen(consumer.queue) == 0
+        child_consumer.consume()
+        assert redis_client.lrange(consumer.queue, 0, -1) == [parent]
+        assert redis_client.zcard(consumer.delayed_queue) == 0
+
+        consumer.consume()
+        assert redis_client.hget(parent, 'progress') == '100'
+        consumer._cleanup.assert_called_once_with(parent, 3)
+
+    @pytest.mark.parametrize('queue_backend', ['list', 'stream'])
+    def test_invalid_child_notifies_parent(self, mocker, redis_client,
+                                           queue_backend):
+        mocker.patch.object(settings, 'EMPTY_QUEUE_TIMEOUT', 0.01)
+        consumer = consumers.Consumer(redis_client, None, 'q',
+                                      queue_backend=queue_backend)
+        consumer.invalid_file_extensions = ('.zip',)
+        mocker.patch.object(consumer, '_consume',
+                            lambda h: consumer.final_status)
+
+        parent = 'q-zip:parent.zip'
+        redis_client.hmset(parent, {'status': 'waiting', 'children:total': 2})
+        redis_client.zadd(consumer.get_delayed_queue_name('q-zip'),
+                          {parent: time.time() + 60})
+        for child in ('q:child.tif', 'q:child.zip'):
+            redis_client.hmset(child, {
+                'parent': parent,
+                'parent_queue': 'q-zip',
+                'input_file_name': child,
+                'status': 'new',
+            })
+            redis_client.sadd(consumer.get_children_key(parent), child)
+            consumer.put_redis_hash('q', child)
+
+        consumer.consume()
+        consumer.consume()
+
+        # the invalid child is failed and counted by its parent
+        assert redis_client.hget('q:child.zip', 'status') == 'failed'
+        assert redis_client.hget(parent, 'children:done') == '1'
+        assert redis_client.hget(parent, 'children:failed') == '1'
+        assert redis_client.scard(consumer.get_children_key(parent)) == 0
+        assert redis_client.zcard(consumer.lease_queue) == 0
+
+        # the parent is retried as soon as both children are finished
+        if queue_backend == 'stream':
+            entries = redis_client.xrange(consumer.get_stream_name('q-zip'))
+            assert [fields for _, fields in entries] == [{'hash': parent}]
+        else:
+            assert redis_client.lrange('q-zip', 0, -1) == [parent]
+
+    def test_waiting_parent_recount(self, mocker, redis_client):
+        mocker.patch.object(settings, 'CHILDREN_RECOUNT_SIZE', 10)
+        consumer = consumers.ZipFileConsumer(redis_client, None, 'q')
+        mocker.patch.object(consumer, '_cleanup')
+
+        parent = 'q-zip:parent.zip'
+        redis_client.hmset(parent, {
+            'status': 'waiting',
+            'input_file_name': 'parent.zip',
+            'children:total': 4,
+            'children:done': 1,
+        })
+        # a child failed in place, a child that is still running
+        # and a child whose hash was deleted.
+        redis_client.hmset('q:failed.tif', {'status': 'failed'})
+        redis_client.hmset('q:new.tif', {'status': 'new'})
+        redis_client.sadd(consumer.get_children_key(parent),
+                          'q:failed.tif', 'q:new.tif', 'q:deleted.tif')
+
+        redis_client.lpush(consumer.queue, parent)
+        consumer.consume()
+        assert redis_client.hget(parent, 'children:failed') == '2'
+        assert redis_client.smembers(
+            consumer.get_children_key(parent)) == {'q:new.tif'}
+        assert redis_client.hget(parent, 'progress') == '75'
+        assert redis_client.hget(parent, 'status') == 'waiting'
+
+        # the last child finished without waking up its parent
+        redis_client.hset('q:new.tif', 'status', 'done')
+        redis_client.zadd(consumer.delayed_queue, {parent: 0})
+        consumer.consume()
+        assert redis_client.hget(parent, 'children:done') == '2'
+        assert redis_client.hget(parent, 'progress') == '100'
+        consumer._cleanup.assert_called_once_with(parent, 4)
+        assert redis_client.zcard(consumer.delayed_queue) == 0
+
+    def test_waiting_parent_claimed(self, mocker, redis_client):
+        mocker.patch.object(settings, 'DO_NOTHING_TIMEOUT', 10)
+        consumer = consumers.Consumer(redis_client, None, 'q-zip')
+        child_consumer = consumers.Consumer(redis_client, None, 'q')
+        parent, child = 'q-zip:parent.zip', 'q:child.tif'
+        redis_client.hmset(parent, {'children:total': 1})
+        redis_client.sadd(child_consumer.get_children_key(parent), child)
+
+        # the last child finishes while the parent is still claimed
+        redis_client.lpush(consumer.queue, parent)
+        assert consumer.get_redis_hash() == parent
+        child_consumer._notify_parent(parent, child, 'done', consumer.queue)
+        assert redis_client.llen(consumer.queue) == 0
+
+        # the parent is queued once, as soon as it is released
+        consumer._put_back_hash(parent, delay=10)
+        assert redis_client.zscore(consumer.delayed_queue, parent) == 0
+        assert consumer.get_redis_hash() == parent
+        assert redis_client.llen(consumer.queue) == 0
+        assert redis_client.zcard(consumer.delayed_queue) == 0
+
+        # a finished parent is not retried
+        redis_client.zadd(consumer.delayed_queue, {parent: 0})
+        consumer._release_hash(parent)
+        assert redis_client.zcard(consumer.delayed_queue) == 0
+
+    @pytest.mark.parametrize('num_children', [3, 6])
+    def test_consume_redis_budget(self, mocker, num_children):
+        # child consumers use another connection to the same server.
+        server = fakeredis.FakeServer()
+        redis_client = CountingRedisClient(server)
+        redis_client.counter.name_scripts(base_consumer)
+        child_client = fakeredis.FakeStrictRedis(
+            server=server, decode_responses='utf8')
+
+        storage = DummyStorage(num=num_children)
+        consumer = consumers.ZipFileConsumer(redis_client, storage, 'q')
+        child_consumer = consumers.Consumer(child_client, storage, 'q')
+
+        def finish_child(redis_hash):
+            child_client.hset(redis_hash, 'output_file_name', 'child.tif')
+            return child_consumer.final_status
+
+        mocker.patch.object(child_consumer, '_consume', finish_child)
+
+        for i in range(2):
+            parent = 'q-zip:{}:parent.zip'.format(i)
+            redis_client.hmset(parent, {
+                'status': 'new',
+                'input_file_name': 'parent.zip',
+            })
+            redis_client.lpush(consumer.queue, parent)
+            # the first zip file also loads the scripts.
+            redis_client.counter.reset_counts()
+
+            # upload the children, wait for them and upload their results.
+            consumer.consume()
+            for _ in range(num_children):
+                child_consumer.consume()
+            consumer.consume()
+
+        budget = ZIP_JOB_ROUND_TRIPS + ZIP_CHILD_ROUND_TRIPS * num_children
+        redis_client.counter.assert_round_trips(
+            budget, 'A zip file with {} children'.format(num_children))
+        assert redis_client.hget(parent, 'status') == consumer.final_status
@@ -34,6 +34,8 @@ import timeit
 import numpy as np
 
 from redis_consumer.consumers import TensorFlowServingConsumer
+from redis_consumer import metrics
+from redis_consumer import pipeline
 from redis_consumer import utils
 from redis_consumer import settings
 
@@ -41,12 +43,7 @@ from redis_consumer import settings
 class ImageFileConsumer(TensorFlowServingConsumer):
     """Consumes image files and uploads the results"""
 
-    def is_valid_hash(self, redis_hash):
-        if redis_hash is None:
-            return False
-
-        fname = str(self.redis.hget(redis_hash, 'input_file_name'))
-        return not fname.lower().endswith('.zip')
+    invalid_file_extensions = ('.zip',)
 
     def detect_scale(self, image):
         """Send the image to the SCALE_DETECT_MODEL to detect the relative
@@ -110,53 +107,129 @@ class ImageFileConsumer(TensorFlowServingConsumer):
                           detected, timeit.default_timer() - start)
         return detected
 
-    def _consume(self, redis_hash):
-        start = timeit.default_timer()
-        hvals = self.redis.hgetall(redis_hash)
-        # hold on to the redis hash/values for logging purposes
-        self._redis_hash = redis_hash
-        self._redis_values = hvals
+    def get_result_params(self, hvals):
+        """The detected label and scale also depend on the detection models"""
+        params = super(ImageFileConsumer, self).get_result_params(hvals)
+        if settings.LABEL_DETECT_ENABLED:
+            params.append(settings.LABEL_DETECT_MODEL)
+        if settings.SCALE_DETECT_ENABLED:
+            params.append(settings.SCALE_DETECT_MODEL)
+        return params
+
+    def get_stages(self):
+        """Returns the stages of a job, to consume many jobs at the same time
+        with a pipeline.StagedEngine.
+
+        Returns:
+            list: The pipeline.Stages of a job.
+        """
+        workers = settings.STAGE_WORKERS
+        return [
+            pipeline.Stage('download', self._download,
+                           workers.get('download', 1)),
+            pipeline.Stage('preprocess', self._preprocess,
+                           workers.get('preprocess', 1), 'pre-processing'),
+            pipeline.Stage('predict', self._predict,
+                           workers.get('predict', 1), 'predicting'),
+            pipeline.Stage('postprocess', self._postprocess,
+                           workers.get('postprocess', 1), 'post-processing'),
+            pipeline.Stage('upload', self._upload,
+                           workers.get('upload', 1), 'saving-results'),
+        ]
+
+    def _use_job(self, job):
+        """Hold on to the redis hash/values of the job for this thread."""
+        self._redis_hash = job['redis_hash']
+        self._redis_values = job['hvals']
+        self._rawshape = job.get('rawshape')
+
+    def _finish_from_cache(self, job, result_key):
+        """Finish the job with the cached result of an identical job, if any.
+
+        Returns:
+            bool: Whether the job was finished.
+        """
+        result = self.get_cached_result(job['redis_hash'], result_key)
+        if result is None:
+            return False
+        job['status'] = self._use_cached_result(
+            job['redis_hash'], result, job['start'])
+        job['done'] = True
+        return True
+
+    def _download(self, job):
+        redis_hash = job['redis_hash']
+        hvals = self.get_redis_values(redis_hash)
+        job['hvals'] = hvals
+        job['model'] = metrics.get_model_label(hvals.get('model_name'),
+                                               hvals.get('model_version'))
+        self._use_job(job)
 
         if hvals.get('status') in self.finished_statuses:
             self.logger.warning('Found completed hash `%s` with status %s.',
                                 redis_hash, hvals.get('status'))
-            return hvals.get('status')
+            job['status'] = hvals.get('status')
+            job['done'] = True
+            return job
 
         self.logger.debug('Found hash to process `%s` with status `%s`.',
                           redis_hash, hvals.get('status'))
 
+        # retried jobs already know the key of their result.
+        result_key = hvals.get('result_key')
+        if result_key and self._finish_from_cache(job, result_key):
+            return job
+
+        # retried jobs and children are admitted before the download.
+        shape = self.get_input_shape(hvals)
+        self.admit_job(redis_hash, shape, hvals.get('model_name'))
+
         self.update_key(redis_hash, {
             'status': 'started',
             'identity_started': self.name,
         })
 
-        # Overridden with LABEL_DETECT_ENABLED
-        model_name = hvals.get('model_name')
-        model_version = hvals.get('model_version')
-
         _ = timeit.default_timer()
 
-        with utils.get_tempdir() as tempdir:
-            fname = self.storage.download(hvals.get('input_file_name'), tempdir)
-            image = utils.get_image(fname)
+        input_file_name = hvals.get('input_file_name')
+        with self.get_download_workspace(input_file_name) as tempdir:
+            fname = self.storage.download(input_file_name, tempdir)
+            if settings.RESULT_CACHE_ENABLED and not result_key:
+                result_key = self.get_result_key(fname, hvals)
+                self.update_key(redis_hash, {'result_key': result_key})
+                if self._finish_from_cache(job, result_key):
+                    return job
+            if shape is None:
+                self.admit_input_file(redis_hash, fname, hvals.get('model_name'))
+            job['image'] = utils.get_image(fname)
+        job['fname'] = fname
 
-        # Pre-process data before sending to the model
         self.update_key(redis_hash, {
-            'status': 'pre-processing',
             'download_time': timeit.default_timer() - _,
         })
+        return job
+
+    def _preprocess(self, job):
+        self._use_job(job)
+        redis_hash = job['redis_hash']
+        hvals = job['hvals']
+        image = job['image']
+
+        # Overridden with LABEL_DETECT_ENABLED
+        model_name = hvals.get('model_name')
+        model_version = hvals.get('model_version')
 
         # Calculate scale of image and rescale
         scale = hvals.get('scale', '')
         scale = self.get_image_scale(scale, image, redis_hash)
 
-        original_shape = image.shape
+        job['original_shape'] = image.shape
 
         image = utils.rescale(image, scale)
 
         # Save shape value for postprocessing purposes
         # TODO this is a big janky
-        self._rawshape = image.shape
+        self._rawshape = job['rawshape'] = image.shape
         label = None
         if settings.LABEL_DETECT_ENABLED and model_name and model_version:
             self.logger.warning('Label Detection is enabled, but the model'
@@ -183,28 +256,39 @@ class ImageFileConsumer(TensorFlowServingConsumer):
             pre_funcs = hvals.get('preprocess_function', '').split(',')
 
         image = np.expand_dims(image, axis=0)  # add in the batch dim
-        image = self.preprocess(image, pre_funcs)
-
-        # Send data to the model
-        self.update_key(redis_hash, {'status': 'predicting'})
-
-        image = self.predict(image, model_name, model_version)
-
-        # Post-process model results
-        self.update_key(redis_hash, {'status': 'post-processing'})
-
+        job['image'] = self.preprocess(image, pre_funcs)
+        job['label'] = label
+        job['model_name'] = model_name
+        job['model_version'] = model_version
+        job['model'] = metrics.get_model_label(model_name, model_version)
+        return job
+
+    def _predict(self, job):
+        self._use_job(job)
+        job['image'] = self.predict(job['image'], job['model_name'],
+                                    job['model_version'])
+        return job
+
+    def _postprocess(self, job):
+        self._use_job(job)
+        label = job['label']
         if settings.LABEL_DETECT_ENABLED and label is not None:
             post_funcs = utils._pick_postprocess(label).split(',')
         else:
-            post_funcs = hvals.get('postprocess_function', '').split(',')
+            post_funcs = job['hvals'].get('postprocess_function', '').split(',')
+
+        job['image'] = self.postprocess(job['image'], post_funcs)
+        return job
 
-        image = self.postprocess(image, post_funcs)
+    def _upload(self, job):
+        self._use_job(job)
+        redis_hash = job['redis_hash']
+        image = job['image']
 
         # Save the post-processed results to a file
         _ = timeit.default_timer()
-        self.update_key(redis_hash, {'status': 'saving-results'})
 
-        save_name = hvals.get('original_name', fname)
+        save_name = job['hvals'].get('original_name', job['fname'])
 
         if isinstance(image, list):
             for i, img in enumerate(image):
@@ -213,10 +297,16 @@ class ImageFileConsumer(TensorFlowServingConsumer):
         elif image.shape[-1] != 1:
             image = np.expand_dims(image, axis=-1)
         dest, output_url = self.save_output(
-            image, redis_hash, save_name, original_shape[:-1])
+            image, redis_hash, save_name, job['original_shape'][:-1])
+
+        # identical jobs reuse the output.
+        self.cache_result(redis_hash, {
+            'output_url': output_url,
+            'output_file_name': dest,
+        })
 
         # Update redis with the final results
-        t = timeit.default_timer() - start
+        t = timeit.default_timer() - job['start']
         self.update_key(redis_hash, {
             'status': self.final_status,
             'output_url': output_url,
@@ -226,4 +316,16 @@ class ImageFileConsumer(TensorFlowServingConsumer):
             'total_time': t,
             'finished_at': self.get_current_timestamp()
         })
-        return self.final_status
+        job['status'] = self.final_status
+        del job['image']
+        return job
+
+    def _consume(self, redis_hash):
+        job = {'redis_hash': redis_hash, 'start': timeit.default_timer()}
+        for stage in self.get_stages():
+            if stage.status:
+                self.update_key(redis_hash, {'status': stage.status})
+            job = pipeline.run_stage(stage, job)
+            if job.get('done'):
+                break
+        return job['status']
@@ -36,8 +36,15 @@ import pytest
 
 from redis_consumer import consumers
 from redis_consumer import settings
+from redis_consumer.consumers import base_consumer
 from redis_consumer.testing_utils import DummyStorage, redis_client
+from redis_consumer.testing_utils import counting_redis_client
 from redis_consumer.testing_utils import _get_image, make_model_metadata_of_size
+from redis_consumer.testing_utils import make_predict_client
+
+
+# Redis round trips of each consumed image job.
+IMAGE_JOB_ROUND_TRIPS = 8
 
 
 class TestImageFileConsumer(object):
@@ -198,3 +205,108 @@ class TestImageFileConsumer(object):
             result = redis_client.hget(test_hash, 'status')
             assert result == consumer.final_status
             test_hash += 1
+
+    def test_consume_redis_budget(self, mocker, counting_redis_client):
+        redis_client = counting_redis_client
+        redis_client.counter.name_scripts(base_consumer)
+        queue = 'predict'
+        consumer = consumers.ImageFileConsumer(
+            redis_client, DummyStorage(), queue)
+
+        # only the model is stubbed, every stage of the job runs.
+        mocker.patch.object(settings, 'LABEL_DETECT_ENABLED', False)
+        mocker.patch.object(settings, 'SCALE_DETECT_ENABLED', False)
+        mocker.patch.object(consumer, '_get_predict_client',
+                            make_predict_client((-1, 300, 300, 1)))
+
+        for i in range(2):
+            redis_hash = '{}:{}:file.tiff'.format(queue, i)
+            redis_client.hmset(redis_hash, {
+                'input_file_name': 'file.tiff',
+                'model_name': 'model',
+                'model_version': '0',
+                'status': 'new',
+            })
+            redis_client.lpush(queue, redis_hash)
+
+        # the first job also loads the scripts and the model metadata.
+        consumer.consume()
+        redis_client.counter.reset_counts()
+
+        consumer.consume()
+        redis_client.counter.assert_round_trips(IMAGE_JOB_ROUND_TRIPS,
+                                                'An image job')
+        assert redis_client.hget(redis_hash, 'status') == consumer.final_status
+
+    def test_consume_result_cache(self, mocker, redis_client):
+        queue = 'predict'
+        consumer = consumers.ImageFileConsumer(
+            redis_client, DummyStorage(), queue)
+        other = consumers.ImageFileConsumer(
+            redis_client, DummyStorage(), queue)
+
+        mocker.patch.object(settings, 'RESULT_CACHE_ENABLED', True)
+        mocker.patch.object(settings, 'DO_NOTHING_TIMEOUT', 0)
+        mocker.patch.object(settings, 'LABEL_DETECT_ENABLED', False)
+        mocker.patch.object(settings, 'SCALE_DETECT_ENABLED', False)
+        # DummyStorage downloads random images.
+        mocker.patch('redis_consumer.utils.get_file_digest', lambda _: 'x')
+        mocker.patch('redis_consumer.utils.rescale', lambda x, *_: x)
+        mocker.patch.object(consumer, 'preprocess', lambda x, *_: x)
+        mocker.patch.object(consumer, 'postprocess', lambda x, *_: x)
+        predict = mocker.patch.object(consumer, 'predict',
+                                      side_effect=lambda x, *_: x)
+        outputs = iter(range(10))
+        mocker.patch.object(consumer, 'save_output', lambda *_: (
+            'output.zip', 'url{}'.format(next(outputs))))
+
+        def consume(redis_hash, model_version='0'):
+            hvals = {
+                'input_file_name': 'file.tiff',
+                'model_name': 'model',
+                'model_version': model_version,
+                'status': 'new',
+            }
+            redis_client.hmset(redis_hash, hvals)
+            redis_client.lpush(queue, redis_hash)
+            consumer.consume()
+            return redis_client.hgetall(redis_hash)
+
+        # the first job computes the result
+        hvals = consume('job1')
+        assert hvals['status'] == consumer.final_status
+        assert hvals['output_url'] == 'url0'
+        assert predict.call_count == 1
+
+        # identical jobs use the cached result
+        hvals = consume('job2')
+        assert hvals['status'] == consumer.final_status
+        assert hvals['output_url'] == 'url0'
+        assert hvals['cached'] == '1'
+        assert hvals['result_key'] == redis_client.hget('job1', 'result_key')
+        assert predict.call_count == 1
+
+        # jobs with other parameters do not
+        hvals = consume('job3', model_version='1')
+        assert hvals['output_url'] == 'url1'
+        assert predict.call_count == 2
+
+        # identical jobs wait for the job computing the result
+        job4 = consumer.get_result_key('file.tiff', {
+            'model_name': 'model',
+            'model_version': '2',
+        })
+        assert other.get_cached_result('other', job4) is None
+        hvals = consume('job4', model_version='2')
+        assert hvals['status'] == 'started'
+        assert hvals['result_key'] == job4
+        assert redis_client.lrange(queue, 0, -1) == ['job4']
+
+        other.cache_result('other', {'output_url': 'url', 'output_file_name': 'o'})
+        other._release_result_lock('other')
+        consumer.consume()
+        hvals = redis_client.hgetall('job4')
+        assert hvals['status'] == consumer.final_status
+        assert hvals['output_url'] == 'url'
+        assert predict.call_count == 2
+        assert not consumer._result_locks
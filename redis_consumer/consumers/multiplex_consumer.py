@@ -35,23 +35,23 @@ import numpy as np
 from redis_consumer.consumers import TensorFlowServingConsumer
 from redis_consumer import utils
 from redis_consumer import settings
-from redis_consumer import processing
 
 
 class MultiplexConsumer(TensorFlowServingConsumer):
     """Consumes image files and uploads the results"""
 
-    def is_valid_hash(self, redis_hash):
-        if redis_hash is None:
-            return False
+    invalid_file_extensions = ('.zip',)
 
-        fname = str(self.redis.hget(redis_hash, 'input_file_name'))
-        return not fname.lower().endswith('.zip')
+    def get_result_params(self, hvals):
+        """The result also depends on the MULTIPLEX_MODEL"""
+        params = super(MultiplexConsumer, self).get_result_params(hvals)
+        params.append(settings.MULTIPLEX_MODEL)
+        return params
 
     def _consume(self, redis_hash):
         start = timeit.default_timer()
         self._redis_hash = redis_hash  # workaround for logging.
-        hvals = self.redis.hgetall(redis_hash)
+        hvals = self.get_redis_values(redis_hash)
 
         if hvals.get('status') in self.finished_statuses:
             self.logger.warning('Found completed hash `%s` with status %s.',
@@ -61,19 +61,39 @@ class MultiplexConsumer(TensorFlowServingConsumer):
         self.logger.debug('Found hash to process `%s` with status `%s`.',
                           redis_hash, hvals.get('status'))
 
+        # Get model_name and version
+        model_name, model_version = settings.MULTIPLEX_MODEL.split(':')
+
+        # retried jobs already know the key of their result.
+        result_key = hvals.get('result_key')
+        if result_key:
+            result = self.get_cached_result(redis_hash, result_key)
+            if result is not None:
+                return self._use_cached_result(redis_hash, result, start)
+
+        # retried jobs are admitted before the download.
+        shape = self.get_input_shape(hvals)
+        self.admit_job(redis_hash, shape, model_name)
+
         self.update_key(redis_hash, {
             'status': 'started',
             'identity_started': self.name,
         })
 
-        # Get model_name and version
-        model_name, model_version = settings.MULTIPLEX_MODEL.split(':')
-
         _ = timeit.default_timer()
 
         # Load input image
-        with utils.get_tempdir() as tempdir:
-            fname = self.storage.download(hvals.get('input_file_name'), tempdir)
+        input_file_name = hvals.get('input_file_name')
+        with self.get_download_workspace(input_file_name) as tempdir:
+            fname = self.storage.download(input_file_name, tempdir)
+            if settings.RESULT_CACHE_ENABLED and not result_key:
+                result_key = self.get_result_key(fname, hvals)
+                self.update_key(redis_hash, {'result_key': result_key})
+                result = self.get_cached_result(redis_hash, result_key)
+                if result is not None:
+                    return self._use_cached_result(redis_hash, result, start)
+            if shape is None:
+                self.admit_input_file(redis_hash, fname, model_name)
             # TODO: tiffs expand the last axis, is that a problem here?
             image = utils.get_image(fname)
 
@@ -125,6 +145,7 @@ class MultiplexConsumer(TensorFlowServingConsumer):
 
         # Post-process model results
         self.update_key(redis_hash, {'status': 'post-processing'})
+        from redis_consumer import processing  # slow to import
         image = processing.format_output_multiplex(image)
         image = self.postprocess(image, ['multiplex_postprocess_consumer'])
 
@@ -136,6 +157,12 @@ class MultiplexConsumer(TensorFlowServingConsumer):
         dest, output_url = self.save_output(
             image, redis_hash, save_name, original_shape[:-1])
 
+        # identical jobs reuse the output.
+        self.cache_result(redis_hash, {
+            'output_url': output_url,
+            'output_file_name': dest,
+        })
+
         # Update redis with the final results
         t = timeit.default_timer() - start
         self.update_key(redis_hash, {
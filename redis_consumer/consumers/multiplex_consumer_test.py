@@ -29,14 +29,23 @@ from __future__ import division
 from __future__ import print_function
 
 import itertools
+import os
 
 import numpy as np
+from skimage.external import tifffile
 
 import pytest
 
 from redis_consumer import consumers
+from redis_consumer.consumers import base_consumer
 from redis_consumer.testing_utils import redis_client, DummyStorage
+from redis_consumer.testing_utils import counting_redis_client
 from redis_consumer.testing_utils import make_model_metadata_of_size
+from redis_consumer.testing_utils import make_predict_client
+
+
+# Redis round trips of each consumed multiplex job.
+MULTIPLEX_JOB_ROUND_TRIPS = 8
 
 
 class TestMultiplexConsumer(object):
@@ -156,3 +165,38 @@ class TestMultiplexConsumer(object):
             redis_client.hmset(test_hash, data)
             with pytest.raises(ValueError, match='Invalid image shape'):
                 _ = consumer._consume(test_hash)
+
+    def test_consume_redis_budget(self, mocker, counting_redis_client):
+        redis_client = counting_redis_client
+        redis_client.counter.name_scripts(base_consumer)
+        queue = 'multiplex'
+        storage = DummyStorage()
+        consumer = consumers.MultiplexConsumer(redis_client, storage, queue)
+
+        def download(path, dest):
+            tifffile.imsave(os.path.join(dest, path),
+                            np.random.random((300, 300, 2)))
+            return os.path.join(dest, path)
+
+        # only the model is stubbed, every step of the job runs.
+        mocker.patch.object(storage, 'download', download)
+        mocker.patch.object(consumer, '_get_predict_client',
+                            make_predict_client((-1, 300, 300, 2),
+                                                output_channels=(1, 3, 1, 3)))
+
+        for i in range(2):
+            redis_hash = '{}:{}:file.tiff'.format(queue, i)
+            redis_client.hmset(redis_hash, {
+                'input_file_name': 'file.tiff',
+                'status': 'new',
+            })
+            redis_client.lpush(queue, redis_hash)
+
+        # the first job also loads the scripts and the model metadata.
+        consumer.consume()
+        redis_client.counter.reset_counts()
+
+        consumer.consume()
+        redis_client.counter.assert_round_trips(MULTIPLEX_JOB_ROUND_TRIPS,
+                                                'A multiplex job')
+        assert redis_client.hget(redis_hash, 'status') == consumer.final_status
@@ -30,7 +30,6 @@ from __future__ import print_function
 
 import json
 import os
-import time
 import timeit
 import uuid
 
@@ -39,10 +38,10 @@ import numpy as np
 
 from redis_consumer.grpc_clients import TrackingClient
 from redis_consumer.consumers import TensorFlowServingConsumer
+from redis_consumer.redis import hash_tag
 from redis_consumer import utils
-from redis_consumer import tracking
 from redis_consumer import settings
-from redis_consumer import processing
+from redis_consumer import tracing
 
 
 class TrackingConsumer(TensorFlowServingConsumer):
@@ -50,20 +49,10 @@ class TrackingConsumer(TensorFlowServingConsumer):
        and uploads the results
     """
 
-    def is_valid_hash(self, redis_hash):
-        if redis_hash is None:
-            return False
+    valid_file_extensions = ('.trk', '.trks', '.tif', '.tiff')
 
-        fname = str(self.redis.hget(redis_hash, 'input_file_name')).lower()
-
-        valid_file = (fname.endswith('.trk') or
-                      fname.endswith('.trks') or
-                      fname.endswith('.tif') or
-                      fname.endswith('.tiff'))
-
-        self.logger.debug('Got key %s and decided %s', redis_hash, valid_file)
-
-        return valid_file
+    # the movie, its segmented frames and the features of the tracker.
+    memory_per_value = 64
 
     def _get_model(self, redis_hash, hvalues):
         hostname = '{}:{}'.format(settings.TF_HOST, settings.TF_PORT)
@@ -86,6 +75,10 @@ class TrackingConsumer(TensorFlowServingConsumer):
         return model
 
     def _get_tracker(self, redis_hash, hvalues, raw, segmented):
+        # deepcell_tracking and deepcell_toolbox are slow to import.
+        from redis_consumer import processing
+        from redis_consumer import tracking
+
         self.logger.debug('Creating tracker...')
         t = timeit.default_timer()
         tracking_model = self._get_model(redis_hash, hvalues)
@@ -167,12 +160,17 @@ class TrackingConsumer(TensorFlowServingConsumer):
         remaining_hashes = set()
         frames = {}
 
+        # each finished frame is pushed onto the event list of this key.
+        children_key = self.get_children_key(redis_hash)
+        events_key = self.get_events_key(redis_hash)
+        self.redis.delete(events_key)
+
         self.logger.debug('Got tiffstack shape %s.', tiff_stack.shape)
 
         uid = uuid.uuid4().hex
         for i, img in enumerate(tiff_stack):
 
-            with utils.get_tempdir() as tempdir:
+            with utils.get_tempdir(size=img.nbytes) as tempdir:
                 # Save and upload the frame.
                 segment_fname = '{}-{}-tracking-frame-{}.tif'.format(
                     uid, hvalues.get('original_name'), i)
@@ -195,30 +193,46 @@ class TrackingConsumer(TensorFlowServingConsumer):
                 'updated_at': current_timestamp,
                 'url': upload_file_url,
                 'scale': scale,
+                'parent': redis_hash,
+                'cost': self.get_job_cost(img.size, model_name),
+                'input_shape': ','.join(str(x) for x in img.shape),
                 # 'label': str(label)
             }
+            if hvalues.get('deadline'):
+                frame_hvalues['deadline'] = hvalues['deadline']
+            # the frame continues the trace of this job.
+            traceparent = tracing.get_traceparent()
+            if traceparent:
+                frame_hvalues['traceparent'] = traceparent
 
             # make a hash for this frame
             segment_hash = '{prefix}:{file}:{hash}'.format(
-                prefix=settings.SEGMENTATION_QUEUE,
+                prefix=hash_tag(settings.SEGMENTATION_QUEUE),
                 file=segment_fname,
                 hash=uuid.uuid4().hex)
 
             # push the hash to redis and the predict queue
             self.redis.hmset(segment_hash, frame_hvalues)
-            self.redis.lpush(settings.SEGMENTATION_QUEUE, segment_hash)
+            self.redis.sadd(children_key, segment_hash)
+            self.put_redis_hash(settings.SEGMENTATION_QUEUE, segment_hash,
+                                lane=redis_hash)
             self.logger.debug('Added new hash for segmentation `%s`: %s',
                               segment_hash, json.dumps(frame_hvalues, indent=4))
             hash_to_frame[segment_hash] = i
             remaining_hashes.add(segment_hash)
 
-        # pop hash, check it, and push it back if it's not done
-        # this checks the same hash over and over again, since set's
-        # pop is not random. This is fine, since we still need every
-        # hash to finish before doing anything.
+        # wait for each frame to be finished by the segmentation consumers.
+        # if no frame finishes within INTERVAL seconds, check all frames
+        # in case a notification was missed.
         while remaining_hashes:
             finished_hashes = set()
-            for segment_hash in remaining_hashes:
+            event = self.redis.blpop(events_key, timeout=max(settings.INTERVAL, 1))
+            if event is None:
+                finished_candidates = set(remaining_hashes)
+            else:
+                finished_candidates = {event[1]} & remaining_hashes
+
+            for segment_hash in finished_candidates:
                 status = self.redis.hget(segment_hash, 'status')
 
                 self.logger.debug('Hash %s has status %s',
@@ -234,8 +248,8 @@ class TrackingConsumer(TensorFlowServingConsumer):
 
                 if status == self.final_status:
                     # Segmentation is finished, save and load the frame.
-                    with utils.get_tempdir() as tempdir:
-                        out = self.redis.hget(segment_hash, 'output_file_name')
+                    out = self.redis.hget(segment_hash, 'output_file_name')
+                    with self.get_download_workspace(out) as tempdir:
                         frame_zip = self.storage.download(out, tempdir)
                         frame_files = list(utils.iter_image_archive(
                             frame_zip, tempdir))
@@ -251,7 +265,10 @@ class TrackingConsumer(TensorFlowServingConsumer):
                         finished_hashes.add(segment_hash)
 
             remaining_hashes -= finished_hashes
-            time.sleep(settings.INTERVAL)
+
+        self.redis.delete(children_key, events_key,
+                          self.get_children_key(redis_hash, 'done'),
+                          self.get_children_key(redis_hash, 'failed'))
 
         labels = [frames[i] for i in range(num_frames)]
 
@@ -261,7 +278,7 @@ class TrackingConsumer(TensorFlowServingConsumer):
 
     def _consume(self, redis_hash):
         start = timeit.default_timer()
-        hvalues = self.redis.hgetall(redis_hash)
+        hvalues = self.get_redis_values(redis_hash)
         self.logger.debug('Found `%s:*` hash to process "%s": %s',
                           self.queue, redis_hash, json.dumps(hvalues, indent=4))
 
@@ -270,6 +287,10 @@ class TrackingConsumer(TensorFlowServingConsumer):
                                 redis_hash, hvalues.get('status'))
             return hvalues.get('status')
 
+        # retried jobs are admitted before the download.
+        shape = self.get_input_shape(hvalues)
+        self.admit_job(redis_hash, shape)
+
         # Set status and initial progress
         self.update_key(redis_hash, {
             'status': 'started',
@@ -277,9 +298,11 @@ class TrackingConsumer(TensorFlowServingConsumer):
             'identity_started': self.name,
         })
 
-        with utils.get_tempdir() as tempdir:
-            fname = self.storage.download(hvalues.get('input_file_name'),
-                                          tempdir)
+        input_file_name = hvalues.get('input_file_name')
+        with self.get_download_workspace(input_file_name) as tempdir:
+            fname = self.storage.download(input_file_name, tempdir)
+            if shape is None:
+                self.admit_input_file(redis_hash, fname)
             data = self._load_data(redis_hash, tempdir, fname)
 
         self.logger.debug('Got contents tracking file contents.')
@@ -288,6 +311,7 @@ class TrackingConsumer(TensorFlowServingConsumer):
 
         # Correct for drift if enabled
         if settings.DRIFT_CORRECT_ENABLED:
+            from redis_consumer import processing  # slow to import
             t = timeit.default_timer()
             data['X'], data['y'] = processing.correct_drift(data['X'], data['y'])
             self.logger.debug('Drift correction complete in %s seconds.',
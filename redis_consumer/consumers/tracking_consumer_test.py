@@ -32,6 +32,7 @@ import os
 import random
 import string
 
+import fakeredis
 import pytest
 
 import numpy as np
@@ -40,7 +41,14 @@ from skimage.external import tifffile
 import redis_consumer
 from redis_consumer import consumers
 from redis_consumer import settings
+from redis_consumer.consumers import base_consumer
 from redis_consumer.testing_utils import DummyStorage, redis_client, _get_image
+from redis_consumer.testing_utils import CountingRedisClient
+
+
+# Redis round trips of each consumed tracking job, and of each of its frames.
+TRACKING_JOB_ROUND_TRIPS = 10
+TRACKING_FRAME_ROUND_TRIPS = 7
 
 
 class DummyTracker(object):
@@ -135,7 +143,11 @@ class TestTrackingConsumer(object):
             tifffile.imsave(path, _get_image(21, 21))
             return [path]
 
-        mocker.patch.object(settings, 'INTERVAL', 0)
+        # segmentation consumers notify the tracking job
+        def finish_child(queue, segment_hash, **_):
+            consumer._notify_parent(key, segment_hash, consumer.final_status)
+
+        mocker.patch.object(consumer, 'put_redis_hash', finish_child)
         mocker.patch.object(redis_client, 'hget', hget_successful_status)
         mocker.patch('redis_consumer.utils.iter_image_archive',
                      write_child_tiff)
@@ -209,3 +221,74 @@ class TestTrackingConsumer(object):
         result = consumer._consume(test_hash)
         assert result == consumer.final_status
         assert redis_client.hget(test_hash, 'status') == consumer.final_status
+
+    def test_consume_redis_budget(self, tmpdir, mocker):
+        # segmentation consumers use another connection to the same server.
+        server = fakeredis.FakeServer()
+        redis_client = CountingRedisClient(server)
+        redis_client.counter.name_scripts(base_consumer)
+        segmentation_client = fakeredis.FakeStrictRedis(
+            server=server, decode_responses='utf8')
+
+        queue = 'track'
+        frames = 3
+        tmpdir = str(tmpdir)
+        storage = DummyStorage()
+        consumer = consumers.TrackingConsumer(redis_client, storage, queue)
+        segmentation_consumer = consumers.ImageFileConsumer(
+            segmentation_client, storage, settings.SEGMENTATION_QUEUE)
+
+        # only the model is stubbed, the tracker runs.
+        def download(path, dest):
+            tifffile.imsave(os.path.join(dest, path),
+                            np.random.random((frames, 21, 21)))
+            return path
+
+        def write_child_tiff(*_, **__):
+            path = os.path.join(tmpdir, 'frame.tiff')
+            tifffile.imsave(path, _get_image(21, 21))
+            return [path]
+
+        put_redis_hash = consumer.put_redis_hash
+
+        def finish_child(queue, segment_hash, **kwargs):
+            put_redis_hash(queue, segment_hash, **kwargs)
+            segmentation_client.hmset(segment_hash, {
+                'status': consumer.final_status,
+                'output_file_name': 'frame.zip',
+            })
+            segmentation_consumer._notify_parent(
+                redis_hash, segment_hash, consumer.final_status)
+
+        def predict(_, request_data, *__, **___):
+            batch_size = request_data[0]['data'].shape[0]
+            return {'prediction': np.zeros((batch_size, 3))}
+
+        mocker.patch.object(settings, 'DRIFT_CORRECT_ENABLED', False)
+        mocker.patch('redis_consumer.grpc_clients.PredictClient.predict',
+                     predict)
+        mocker.patch.object(consumer, 'put_redis_hash', finish_child)
+        mocker.patch.object(storage, 'download', download)
+        mocker.patch('redis_consumer.utils.iter_image_archive',
+                     write_child_tiff)
+
+        for i in range(2):
+            redis_hash = '{}:{}:file.tiff'.format(queue, i)
+            redis_client.hmset(redis_hash, {
+                'input_file_name': 'file.tiff',
+                'status': 'new',
+            })
+            redis_client.lpush(queue, redis_hash)
+
+        # the first job also loads the scripts.
+        redis_hash = '{}:0:file.tiff'.format(queue)
+        consumer.consume()
+        redis_client.counter.reset_counts()
+
+        redis_hash = '{}:1:file.tiff'.format(queue)
+        consumer.consume()
+        budget = (TRACKING_JOB_ROUND_TRIPS +
+                  TRACKING_FRAME_ROUND_TRIPS * frames)
+        redis_client.counter.assert_round_trips(
+            budget, 'A tracking job with {} frames'.format(frames))
+        assert redis_client.hget(redis_hash, 'status') == consumer.final_status
@@ -0,0 +1,106 @@
+# Copyright 2016-2020 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-redis-consumer/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""asyncio engine running many jobs per process"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import asyncio
+import concurrent.futures
+import logging
+import os
+
+
+class AsyncEngine(object):
+    """Consume up to ``concurrency`` jobs at the same time in one process.
+
+    Each slot gets its own consumer from ``consumer_factory``, so existing
+    ``_consume`` implementations keep their per-job state. Every slot runs
+    ``consume()`` in a thread of the I/O executor, so that one job can wait
+    on Redis, storage or TensorFlow Serving while others make progress.
+    The pre- and post-processing functions of all slots share a smaller
+    CPU executor, so that I/O-bound jobs are not starved by CPU-bound ones.
+
+    Args:
+        consumer_factory (function): Returns a new consumer, given the
+            slot number.
+        concurrency (int): The number of jobs in flight at the same time.
+        cpu_workers (int): The number of processing functions running at
+            the same time. Defaults to the number of CPUs.
+    """
+
+    def __init__(self, consumer_factory, concurrency, cpu_workers=None):
+        self.logger = logging.getLogger(str(self.__class__.__name__))
+        self.consumer_factory = consumer_factory
+        self.concurrency = concurrency
+        self.cpu_workers = cpu_workers or os.cpu_count() or 1
+
+    async def _run_slot(self, slot, loop, io_executor, cpu_executor,
+                        stop_event):
+        consumer = self.consumer_factory(slot)
+        if hasattr(consumer, 'cpu_executor'):
+            consumer.cpu_executor = cpu_executor
+
+        while not stop_event.is_set():
+            await loop.run_in_executor(io_executor, consumer.consume)
+
+    def run(self, stop_event):
+        """Consume jobs until the stop event is set.
+
+        Every slot finishes its current job before returning. If any job
+        raises an error, the other slots are stopped and the error is
+        raised once they have finished.
+
+        Args:
+            stop_event (threading.Event): Stop consuming once set.
+        """
+        io_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.concurrency)
+        cpu_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.cpu_workers)
+        loop = asyncio.new_event_loop()
+        try:
+            tasks = [
+                loop.create_task(self._run_slot(
+                    slot, loop, io_executor, cpu_executor, stop_event))
+                for slot in range(self.concurrency)
+            ]
+            self.logger.info('Consuming up to %s jobs at the same time.',
+                             self.concurrency)
+
+            done, pending = loop.run_until_complete(asyncio.wait(
+                tasks, return_when=asyncio.FIRST_EXCEPTION))
+            if pending:
+                # drain the other slots before raising the error.
+                stop_event.set()
+                loop.run_until_complete(asyncio.wait(pending))
+
+            for task in done:
+                task.result()
+        finally:
+            loop.close()
+            io_executor.shutdown()
+            cpu_executor.shutdown()
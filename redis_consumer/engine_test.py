@@ -0,0 +1,120 @@
+# Copyright 2016-2020 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-redis-consumer/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tests for the asyncio consumer engine"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+
+import pytest
+
+from redis_consumer import consumers
+from redis_consumer.engine import AsyncEngine
+from redis_consumer.testing_utils import redis_client
+
+
+class SlowConsumer(object):
+    """Records how many jobs are consumed at the same time."""
+
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+    consumed = 0
+
+    def __init__(self, stop_event, num_jobs=20, fail=False):
+        self.stop_event = stop_event
+        self.num_jobs = num_jobs
+        self.fail = fail
+
+    def consume(self):
+        cls = self.__class__
+        with cls.lock:
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        time.sleep(0.02)
+        with cls.lock:
+            cls.in_flight -= 1
+            cls.consumed += 1
+            if cls.consumed >= self.num_jobs:
+                self.stop_event.set()
+        if self.fail:
+            raise ValueError('thrown on purpose')
+
+
+class TestAsyncEngine(object):
+    # pylint: disable=R0201,W0621
+
+    def test_run(self, mocker):
+        mocker.patch.multiple(SlowConsumer, in_flight=0, max_in_flight=0,
+                              consumed=0)
+        stop_event = threading.Event()
+        slots = []
+
+        def factory(slot):
+            slots.append(slot)
+            return SlowConsumer(stop_event)
+
+        engine = AsyncEngine(factory, concurrency=4)
+        engine.run(stop_event)
+
+        # each slot has its own consumer and jobs are consumed concurrently
+        assert sorted(slots) == [0, 1, 2, 3]
+        assert SlowConsumer.max_in_flight == 4
+        assert SlowConsumer.in_flight == 0
+        assert SlowConsumer.consumed >= 20
+
+    def test_run_error(self, mocker):
+        mocker.patch.multiple(SlowConsumer, in_flight=0, max_in_flight=0,
+                              consumed=0)
+        stop_event = threading.Event()
+
+        def factory(slot):
+            return SlowConsumer(stop_event, num_jobs=100, fail=slot == 0)
+
+        engine = AsyncEngine(factory, concurrency=3)
+        with pytest.raises(ValueError):
+            engine.run(stop_event)
+
+        # the other slots finished their jobs
+        assert stop_event.is_set()
+        assert SlowConsumer.in_flight == 0
+
+    def test_cpu_executor(self, redis_client):
+        engine = AsyncEngine(None, concurrency=2, cpu_workers=1)
+        stop_event = threading.Event()
+
+        def factory(_):
+            consumer = consumers.TensorFlowServingConsumer(
+                redis_client, None, 'q')
+            consumer.consume = stop_event.set
+            factory.consumer = consumer
+            return consumer
+
+        engine.consumer_factory = factory
+        engine.run(stop_event)
+        assert factory.consumer.cpu_executor is not None
@@ -44,7 +44,9 @@ import numpy as np
 
 from google.protobuf.json_format import MessageToJson
 
+from redis_consumer import metrics
 from redis_consumer import settings
+from redis_consumer import tracing
 from redis_consumer.pbs.prediction_service_pb2_grpc import PredictionServiceStub
 from redis_consumer.pbs.predict_pb2 import PredictRequest
 from redis_consumer.pbs.get_model_metadata_pb2 import GetModelMetadataRequest
@@ -108,25 +110,45 @@ class PredictClient(GrpcClient):
                          self.model_name, self.model_version)
 
         true_failures, count = 0, 0
+        api_endpoint_name = self.stub_lookup.get(request.__class__)
+        request_size = request.ByteSize()
 
         retrying = True
         while retrying:
-            with self.insecure_channel() as channel:
+            # each attempt is traced, and continued by TensorFlow Serving.
+            with self.insecure_channel() as channel, tracing.span(
+                    'grpc', method=api_endpoint_name, attempt=count) as span:
                 # pylint: disable=E1101
+                t = timeit.default_timer()
                 try:
-                    t = timeit.default_timer()
-
                     stub = PredictionServiceStub(channel)
 
-                    api_endpoint_name = self.stub_lookup.get(request.__class__)
                     api_call = getattr(stub, api_endpoint_name)
-                    response = api_call(request, timeout=request_timeout)
-
+                    metrics.GRPC_BYTES.labels(
+                        api_endpoint_name, 'sent').inc(request_size)
+                    metadata = None
+                    if span.traceparent:
+                        metadata = [('traceparent', span.traceparent)]
+                    response = api_call(request, timeout=request_timeout,
+                                        metadata=metadata)
+
+                    finished = timeit.default_timer() - t
+                    metrics.GRPC_SECONDS.labels(api_endpoint_name).observe(
+                        finished)
+                    metrics.GRPC_REQUESTS.labels(
+                        api_endpoint_name, grpc.StatusCode.OK.name).inc()
+                    metrics.GRPC_BYTES.labels(
+                        api_endpoint_name, 'received').inc(response.ByteSize())
                     self.logger.debug('%s finished in %s seconds.',
-                                      request_name, timeit.default_timer() - t)
+                                      request_name, finished)
                     return response
 
                 except grpc.RpcError as err:
+                    span.set_attribute('code', err.code().name)
+                    metrics.GRPC_SECONDS.labels(api_endpoint_name).observe(
+                        timeit.default_timer() - t)
+                    metrics.GRPC_REQUESTS.labels(
+                        api_endpoint_name, err.code().name).inc()
                     if true_failures > settings.MAX_RETRY > 0:
                         retrying = False
                         self.logger.error('%s has failed %s times due to err '
@@ -135,6 +157,8 @@ class PredictClient(GrpcClient):
 
                     if err.code() in settings.GRPC_RETRY_STATUSES:
                         count += 1
+                        metrics.GRPC_RETRIES.labels(
+                            api_endpoint_name, err.code().name).inc()
                         is_true_failure = err.code() != grpc.StatusCode.UNAVAILABLE
                         true_failures += int(is_true_failure)
 
@@ -239,15 +263,17 @@ class TrackingClient(PredictClient):
         batch_size = next(iter(data.values())).shape[0]
         self.logger.info('batch size: %s', batch_size)
         results = []
+        # read once, the live settings may change it during the loop.
+        max_batch_size = settings.TF_MAX_BATCH_SIZE
         #  from 0 to Num Cells (comparisons) in increments of TF batch size
-        for b in range(0, batch_size, settings.TF_MAX_BATCH_SIZE):
+        for b in range(0, batch_size, max_batch_size):
             request_data = []
             for f in features:
                 input_name1 = '{}_input1'.format(f)
                 d1 = {
                     'in_tensor_name': input_name1,
                     'in_tensor_dtype': 'DT_FLOAT',
-                    'data': data[input_name1][b:b + settings.TF_MAX_BATCH_SIZE]
+                    'data': data[input_name1][b:b + max_batch_size]
                 }
                 request_data.append(d1)
 
@@ -255,7 +281,7 @@ class TrackingClient(PredictClient):
                 d2 = {
                     'in_tensor_name': input_name2,
                     'in_tensor_dtype': 'DT_FLOAT',
-                    'data': data[input_name2][b:b + settings.TF_MAX_BATCH_SIZE]
+                    'data': data[input_name2][b:b + max_batch_size]
                 }
                 request_data.append(d2)
 
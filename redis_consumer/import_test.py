@@ -0,0 +1,66 @@
+# Copyright 2016-2020 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-redis-consumer/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tests that slow packages are only imported when they are used"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import subprocess
+import sys
+
+import pytest
+
+
+# packages that are slow to import, see benchmarks/import_time.py
+SLOW_PACKAGES = (
+    'boto3',
+    'google.cloud.storage',
+    'deepcell_toolbox',
+    'deepcell_tracking',
+    'keras_preprocessing',
+)
+
+
+def _get_imported_modules(statement):
+    """Returns the modules imported by the statement in a new process."""
+    script = 'import sys\n{}\nprint("\\n".join(sys.modules))'.format(statement)
+    output = subprocess.check_output([sys.executable, '-c', script])
+    return set(output.decode().split())
+
+
+@pytest.mark.parametrize('statement', [
+    'import redis_consumer',
+    'from redis_consumer import consumers, settings, storage, utils',
+])
+def test_lazy_imports(statement):
+    modules = _get_imported_modules(statement)
+    assert not [p for p in SLOW_PACKAGES if p in modules]
+
+
+def test_slow_imports():
+    # the packages are imported once they are used.
+    modules = _get_imported_modules('from redis_consumer import processing')
+    assert 'deepcell_toolbox' in modules
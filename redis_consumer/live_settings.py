@@ -0,0 +1,240 @@
+# Copyright 2016-2020 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-redis-consumer/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tuning parameters that can be changed without restarting the consumers.
+
+Values are read from the Redis hash LIVE_SETTINGS_KEY, whose "version"
+field is incremented after every change:
+
+    HSET consumer-settings TF_MAX_BATCH_SIZE 64 SCALE_DETECT_ENABLED true
+    HINCRBY consumer-settings version 1
+
+Consumers check the version at most every LIVE_SETTINGS_INTERVAL seconds,
+before claiming a job. Once it changes, each value is validated and set on
+the settings module. Settings missing from the hash or with an invalid
+value fall back to their value from the environment.
+
+The settings module is shared by every job of the process. A serial
+consumer only changes it between jobs, but with CONCURRENCY or
+STAGED_PIPELINE the other jobs in flight use the new values from their
+next step on, e.g. the next image sent to TensorFlow Serving. A step that
+must use one value throughout reads the setting once, as the batch size of
+TrackingClient.predict does.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import threading
+import time
+
+from redis_consumer import metrics
+from redis_consumer import settings
+
+
+# the type, minimum and maximum of each setting that can be changed.
+# each one is read from the settings module whenever it is used.
+TUNABLE_SETTINGS = {
+    'TF_MAX_BATCH_SIZE': (int, 1, None),
+    'TF_MIN_MODEL_SIZE': (int, 1, None),
+    'STRIDE_RATIO': (float, 0.01, 1),
+    'GRPC_TIMEOUT': (int, 1, None),
+    'GRPC_BACKOFF': (int, 0, None),
+    'MAX_RETRY': (int, 0, None),
+    'INTERVAL': (int, 0, None),
+    'EMPTY_QUEUE_TIMEOUT': (int, 0, None),
+    'DO_NOTHING_TIMEOUT': (float, 0, None),
+    'MAX_RETRY_DELAY': (float, 0, None),
+    'STATUS_UPDATE_INTERVAL': (float, 0, None),
+    'SCALE_DETECT_ENABLED': (bool, None, None),
+    'LABEL_DETECT_ENABLED': (bool, None, None),
+    'DRIFT_CORRECT_ENABLED': (bool, None, None),
+    'NORMALIZE_TRACKING': (bool, None, None),
+}
+
+_BOOLEANS = {
+    '1': True, 'yes': True, 'true': True, 'on': True,
+    '0': False, 'no': False, 'false': False, 'off': False,
+}
+
+logger = logging.getLogger('redis_consumer.live_settings')
+
+# the values from the environment, used if a setting is not in the hash.
+DEFAULTS = {name: getattr(settings, name) for name in TUNABLE_SETTINGS}
+
+# the version of the applied settings, and when it was last checked.
+_version = None
+_last_check = 0
+_lock = threading.Lock()
+
+
+def parse_value(name, value):
+    """Validate the value of a setting.
+
+    Args:
+        name (str): The name of the setting.
+        value (str): The value read from Redis.
+
+    Returns:
+        The value, cast to the type of the setting.
+
+    Raises:
+        ValueError: The setting cannot be changed or the value is invalid.
+    """
+    if name not in TUNABLE_SETTINGS:
+        raise ValueError('{} cannot be changed at runtime.'.format(name))
+
+    cast, minimum, maximum = TUNABLE_SETTINGS[name]
+    if cast is bool:
+        value = str(value).strip().lower()
+        if value not in _BOOLEANS:
+            raise ValueError('{} must be a boolean, got "{}".'.format(
+                name, value))
+        return _BOOLEANS[value]
+
+    value = cast(value)
+    if minimum is not None and value < minimum:
+        raise ValueError('{} must be at least {}, got {}.'.format(
+            name, minimum, value))
+    if maximum is not None and value > maximum:
+        raise ValueError('{} must be at most {}, got {}.'.format(
+            name, maximum, value))
+    return value
+
+
+def apply(values, version=None):
+    """Set the settings module to the values of the live settings hash.
+
+    Jobs in flight in other threads use the new values from then on.
+
+    Args:
+        values (dict): The values of the hash. Invalid values are ignored.
+        version (str): The version of the values.
+
+    Returns:
+        dict: The effective value of each setting that can be changed.
+    """
+    unknown = set(values) - set(TUNABLE_SETTINGS) - {'version'}
+    if unknown:
+        logger.warning('Ignoring live settings that cannot be changed: %s',
+                       ', '.join(sorted(unknown)))
+
+    effective = {}
+    for name, default in DEFAULTS.items():
+        value = default
+        if name in values:
+            try:
+                value = parse_value(name, values[name])
+            except ValueError as err:
+                logger.error('Ignoring invalid live setting %s: %s',
+                             name, err)
+
+        if getattr(settings, name) != value:
+            logger.info('Changed %s from %s to %s.',
+                        name, getattr(settings, name), value)
+        setattr(settings, name, value)
+        metrics.LIVE_SETTING.labels(name).set(float(value))
+        effective[name] = value
+
+    try:
+        metrics.LIVE_SETTINGS_VERSION.set(float(version or 0))
+    except ValueError:
+        logger.warning('Live settings version is not a number: %s', version)
+    return effective
+
+
+def refresh(redis_client):
+    """Apply the live settings if their version has changed.
+
+    The version is checked at most every LIVE_SETTINGS_INTERVAL seconds,
+    and only by one thread of the process at a time.
+
+    Args:
+        redis_client (redis.Redis): The Redis client.
+
+    Returns:
+        bool: Whether new settings were applied.
+    """
+    global _version, _last_check  # pylint: disable=global-statement
+    key = settings.LIVE_SETTINGS_KEY
+    if not key or not _lock.acquire(False):
+        return False
+
+    try:
+        if time.time() - _last_check < settings.LIVE_SETTINGS_INTERVAL:
+            return False
+        _last_check = time.time()
+
+        if redis_client.hget(key, 'version') == _version:
+            return False
+
+        values = redis_client.hgetall(key)
+        apply(values, values.get('version'))
+        logger.info('Applied version %s of the live settings in `%s`.',
+                    values.get('version'), key)
+        _version = values.get('version')
+        return True
+    except Exception as err:  # pylint: disable=broad-except
+        # keep the current settings until the next check.
+        logger.error('Could not refresh the live settings in `%s`: %s: %s',
+                     key, type(err).__name__, err)
+        return False
+    finally:
+        _lock.release()
+
+
+def publish(redis_client, values):
+    """Validate and publish new values of the live settings.
+
+    The values are written before the version is incremented, so that
+    consumers never apply a partial change.
+
+    Args:
+        redis_client (redis.Redis): The Redis client.
+        values (dict): The new value of each setting.
+
+    Returns:
+        int: The new version of the live settings.
+
+    Raises:
+        ValueError: A setting cannot be changed or its value is invalid.
+    """
+    key = settings.LIVE_SETTINGS_KEY
+    if not key:
+        raise ValueError('LIVE_SETTINGS_KEY is not set.')
+    for name, value in values.items():
+        parse_value(name, value)
+    if values:
+        redis_client.hmset(key, {k: str(v) for k, v in values.items()})
+    return redis_client.hincrby(key, 'version', 1)
+
+
+def _report_defaults():
+    for name, value in DEFAULTS.items():
+        metrics.LIVE_SETTING.labels(name).set(float(value))
+
+
+_report_defaults()
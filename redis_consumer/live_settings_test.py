@@ -0,0 +1,130 @@
+# Copyright 2016-2020 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-redis-consumer/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tests for the live settings"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+import prometheus_client
+import pytest
+
+from redis_consumer import consumers
+from redis_consumer import live_settings
+from redis_consumer import settings
+from redis_consumer.testing_utils import redis_client
+
+
+@pytest.fixture
+def live(mocker):
+    mocker.patch.object(settings, 'LIVE_SETTINGS_KEY', 'live')
+    mocker.patch.object(settings, 'LIVE_SETTINGS_INTERVAL', 0)
+    mocker.patch.object(live_settings, '_version', None)
+    mocker.patch.object(live_settings, '_last_check', 0)
+    # restore the settings changed by the tests.
+    for name in live_settings.TUNABLE_SETTINGS:
+        mocker.patch.object(settings, name, getattr(settings, name))
+
+
+def _get_metric(name):
+    return prometheus_client.REGISTRY.get_sample_value(
+        'consumer_live_setting', {'name': name})
+
+
+def test_parse_value():
+    assert live_settings.parse_value('TF_MAX_BATCH_SIZE', '64') == 64
+    assert live_settings.parse_value('STRIDE_RATIO', '0.5') == 0.5
+    assert live_settings.parse_value('SCALE_DETECT_ENABLED', 'On') is True
+    assert live_settings.parse_value('SCALE_DETECT_ENABLED', '0') is False
+
+    invalid = [
+        ('QUEUE', 'predict'),  # not tunable
+        ('TF_MAX_BATCH_SIZE', '1.5'),
+        ('TF_MAX_BATCH_SIZE', '0'),
+        ('STRIDE_RATIO', '2'),
+        ('SCALE_DETECT_ENABLED', 'maybe'),
+    ]
+    for name, value in invalid:
+        with pytest.raises(ValueError):
+            live_settings.parse_value(name, value)
+
+
+def test_refresh(live, redis_client):
+    default = live_settings.DEFAULTS['TF_MAX_BATCH_SIZE']
+
+    # nothing is applied until there is a version
+    assert not live_settings.refresh(redis_client)
+
+    with pytest.raises(ValueError):
+        live_settings.publish(redis_client, {'TF_MAX_BATCH_SIZE': 0})
+    assert live_settings.publish(redis_client, {
+        'TF_MAX_BATCH_SIZE': 64,
+        'SCALE_DETECT_ENABLED': True,
+    }) == 1
+    assert live_settings.refresh(redis_client)
+    assert settings.TF_MAX_BATCH_SIZE == 64
+    assert settings.SCALE_DETECT_ENABLED is True
+    assert _get_metric('TF_MAX_BATCH_SIZE') == 64
+    assert _get_metric('SCALE_DETECT_ENABLED') == 1
+
+    # the same version is only applied once
+    assert not live_settings.refresh(redis_client)
+
+    # invalid values fall back to the environment
+    redis_client.hset('live', 'TF_MAX_BATCH_SIZE', 'invalid')
+    redis_client.hincrby('live', 'version', 1)
+    assert live_settings.refresh(redis_client)
+    assert settings.TF_MAX_BATCH_SIZE == default
+    assert settings.SCALE_DETECT_ENABLED is True
+
+    # the version is only checked every LIVE_SETTINGS_INTERVAL seconds
+    settings.LIVE_SETTINGS_INTERVAL = 100
+    live_settings.publish(redis_client, {'TF_MAX_BATCH_SIZE': 32})
+    assert not live_settings.refresh(redis_client)
+    live_settings._last_check = time.time() - 100
+    assert live_settings.refresh(redis_client)
+    assert settings.TF_MAX_BATCH_SIZE == 32
+
+    # deleted settings fall back to the environment
+    redis_client.delete('live')
+    live_settings._last_check = 0
+    assert live_settings.refresh(redis_client)
+    assert settings.TF_MAX_BATCH_SIZE == default
+
+
+def test_refresh_error(live, mocker, redis_client):
+    mocker.patch.object(redis_client, 'hget', side_effect=OSError('down'))
+    assert not live_settings.refresh(redis_client)
+
+
+def test_consume(live, mocker, redis_client):
+    # live settings are applied before the next job is claimed
+    live_settings.publish(redis_client, {'EMPTY_QUEUE_TIMEOUT': 0})
+    consumer = consumers.Consumer(redis_client, None, 'q')
+    spy = mocker.spy(time, 'sleep')
+    consumer.consume()
+    spy.assert_called_once_with(0)
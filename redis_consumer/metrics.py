@@ -0,0 +1,188 @@
+# Copyright 2016-2020 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-redis-consumer/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Prometheus metrics of the consumer.
+
+Every metric is recorded in memory, and is only serialized when the
+metrics endpoint is scraped.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import os
+
+# prometheus-client 0.8.0 only reads the lowercase name, and only when it is
+# first imported. Accept the uppercase name of the newer releases too.
+if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    os.environ.setdefault('prometheus_multiproc_dir',
+                          os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+import prometheus_client  # pylint: disable=wrong-import-position
+from prometheus_client import multiprocess  # pylint: disable=wrong-import-position
+
+
+# buckets of the stages of a job, which take seconds to minutes.
+STAGE_BUCKETS = (.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# buckets of single Redis commands and claims, which take milliseconds.
+REDIS_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+
+STAGE_SECONDS = prometheus_client.Histogram(
+    'consumer_stage_seconds',
+    'Time spent in each stage of a job, by model.',
+    ['stage', 'model'], buckets=STAGE_BUCKETS)
+
+JOB_SECONDS = prometheus_client.Histogram(
+    'consumer_job_seconds',
+    'Time from claiming a job to releasing it, by queue and status.',
+    ['queue', 'status'], buckets=STAGE_BUCKETS)
+
+JOBS_IN_FLIGHT = prometheus_client.Gauge(
+    'consumer_jobs_in_flight',
+    'Claimed jobs that have not been released yet.',
+    ['queue'], multiprocess_mode='livesum')
+
+CLAIM_SECONDS = prometheus_client.Histogram(
+    'consumer_claim_seconds',
+    'Time to claim a job from the work queue, including empty claims.',
+    ['queue'], buckets=REDIS_BUCKETS)
+
+MEMORY_RESERVED = prometheus_client.Gauge(
+    'consumer_memory_reserved_bytes',
+    'Estimated peak memory reserved by the admitted jobs.',
+    multiprocess_mode='livesum')
+
+RESULT_CACHE_REQUESTS = prometheus_client.Counter(
+    'consumer_result_cache_requests',
+    'Result cache lookups, by result: "hit", "miss" or "wait" for an '
+    'identical job in progress.',
+    ['queue', 'result'])
+
+STAGE_BUSY = prometheus_client.Gauge(
+    'consumer_stage_busy',
+    'Jobs in each stage of a staged pipeline.',
+    ['stage'], multiprocess_mode='livesum')
+
+STAGE_QUEUED = prometheus_client.Gauge(
+    'consumer_stage_queued',
+    'Jobs waiting for each stage of a staged pipeline.',
+    ['stage'], multiprocess_mode='livesum')
+
+GRPC_REQUESTS = prometheus_client.Counter(
+    'consumer_grpc_requests',
+    'gRPC requests sent to TensorFlow Serving, by status code.',
+    ['method', 'code'])
+
+GRPC_RETRIES = prometheus_client.Counter(
+    'consumer_grpc_retries',
+    'gRPC requests retried, by status code.',
+    ['method', 'code'])
+
+GRPC_BYTES = prometheus_client.Counter(
+    'consumer_grpc_bytes',
+    'Bytes of the gRPC requests and responses.',
+    ['method', 'direction'])
+
+GRPC_SECONDS = prometheus_client.Histogram(
+    'consumer_grpc_seconds',
+    'Time of each gRPC request, including failed requests.',
+    ['method'], buckets=STAGE_BUCKETS)
+
+REDIS_COMMAND_SECONDS = prometheus_client.Histogram(
+    'consumer_redis_command_seconds',
+    'Time of each Redis command, by command.',
+    ['command'], buckets=REDIS_BUCKETS)
+
+STORAGE_BYTES = prometheus_client.Counter(
+    'consumer_storage_bytes',
+    'Bytes uploaded to and downloaded from cloud storage.',
+    ['operation'])
+
+STORAGE_SECONDS = prometheus_client.Histogram(
+    'consumer_storage_seconds',
+    'Time of each upload to or download from cloud storage.',
+    ['operation'], buckets=STAGE_BUCKETS)
+
+
+LIVE_SETTING = prometheus_client.Gauge(
+    'consumer_live_setting',
+    'Effective value of each setting that can be changed at runtime.',
+    ['name'], multiprocess_mode='liveall')
+
+LIVE_SETTINGS_VERSION = prometheus_client.Gauge(
+    'consumer_live_settings_version',
+    'Version of the live settings applied, or 0 if none were applied.',
+    multiprocess_mode='livemin')
+
+
+def get_model_label(model_name, model_version=None):
+    """Returns the model label of a metric.
+
+    Args:
+        model_name (str): The name of the model.
+        model_version (str): The version of the model.
+
+    Returns:
+        str: "model_name:model_version", or "" if there is no model.
+    """
+    if not model_name:
+        return ''
+    return '{}:{}'.format(model_name, model_version or '')
+
+
+def _is_multiprocess():
+    return bool(os.environ.get('prometheus_multiproc_dir'))
+
+
+def mark_process_dead(pid):
+    """Drop the live gauges of an exited worker process, if the metrics of
+    every worker are served together.
+
+    Args:
+        pid (int): The PID of the exited process.
+    """
+    if _is_multiprocess():
+        multiprocess.mark_process_dead(pid)
+
+
+def start_http_server(port):
+    """Serve the metrics on the given port in a background thread.
+
+    If prometheus_multiproc_dir is set, the metrics of every process
+    forked by the workers.Supervisor are served together.
+
+    Args:
+        port (int): The port of the metrics endpoint.
+    """
+    logger = logging.getLogger('redis_consumer.metrics')
+    registry = prometheus_client.REGISTRY
+    if _is_multiprocess():
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+
+    prometheus_client.start_http_server(port, registry=registry)
+    logger.info('Serving metrics on port %s.', port)
@@ -0,0 +1,109 @@
+# Copyright 2016-2020 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-redis-consumer/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tests for the Prometheus metrics"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import socket
+import subprocess
+import sys
+
+import prometheus_client
+from six.moves import urllib
+
+from redis_consumer import consumers
+from redis_consumer import metrics
+from redis_consumer import settings
+from redis_consumer.testing_utils import redis_client
+
+
+def _get_value(name, **labels):
+    return prometheus_client.REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_get_model_label():
+    assert metrics.get_model_label('model', 1) == 'model:1'
+    assert metrics.get_model_label('model') == 'model:'
+    assert metrics.get_model_label(None, 1) == ''
+
+
+def test_start_http_server():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    metrics.start_http_server(port)
+    url = 'http://localhost:{}/metrics'.format(port)
+    body = urllib.request.urlopen(url).read().decode('utf-8')
+    assert 'consumer_stage_seconds' in body
+    assert 'consumer_jobs_in_flight' in body
+
+
+def test_multiprocess_dir(tmpdir):
+    tmpdir = str(tmpdir)
+    script = '\n'.join([
+        'import os',
+        'from redis_consumer import metrics',
+        'assert metrics._is_multiprocess()',
+        'metrics.JOBS_IN_FLIGHT.labels("q").inc()',
+        'print(os.environ["prometheus_multiproc_dir"])',
+    ])
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=tmpdir)
+    env.pop('prometheus_multiproc_dir', None)
+    output = subprocess.check_output([sys.executable, '-c', script], env=env)
+
+    # the uppercase name is used by every version of prometheus-client
+    assert output.decode().strip() == tmpdir
+    assert [f for f in os.listdir(tmpdir) if f.endswith('.db')]
+
+
+def test_consume(mocker, redis_client):
+    mocker.patch.object(settings, 'EMPTY_QUEUE_TIMEOUT', 0)
+    queue = 'metrics-queue'
+    consumer = consumers.Consumer(redis_client, None, queue)
+
+    claims = _get_value('consumer_claim_seconds_count', queue=queue)
+    jobs = _get_value('consumer_job_seconds_count', queue=queue,
+                      status='done')
+
+    redis_client.lpush(queue, 'hash')
+    mocker.patch.object(consumer, '_consume',
+                        lambda *_: _get_value('consumer_jobs_in_flight',
+                                              queue=queue) and 'done')
+    consumer.consume()
+
+    # the job was in flight while it was consumed
+    assert _get_value('consumer_jobs_in_flight', queue=queue) == 0
+    assert _get_value('consumer_claim_seconds_count', queue=queue) == claims + 1
+    assert _get_value('consumer_job_seconds_count', queue=queue,
+                      status='done') == jobs + 1
+
+    # empty claims are recorded too
+    consumer.consume()
+    assert _get_value('consumer_claim_seconds_count', queue=queue) == claims + 2
@@ -0,0 +1,321 @@
+# Copyright 2016-2020 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-redis-consumer/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Staged pipeline running the phases of many jobs at the same time"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import concurrent.futures
+import logging
+import os
+import queue
+import threading
+import timeit
+
+from redis_consumer import metrics
+from redis_consumer import tracing
+
+
+# put on the queue of a stage once for each of its workers to stop them.
+_STOP = object()
+
+
+class Stage(object):
+    """A phase of a job, run by its own pool of worker threads.
+
+    Args:
+        name (str): The name of the stage.
+        func (function): Runs the stage given the job state, and returns
+            the job state for the next stage.
+        workers (int): The number of jobs in the stage at the same time.
+        status (str): The status of jobs entering the stage.
+    """
+
+    def __init__(self, name, func, workers=1, status=None):
+        self.name = name
+        self.func = func
+        self.workers = max(int(workers), 1)
+        self.status = status
+
+
+def run_stage(stage, job):
+    """Run the stage of the job and record how long it took.
+
+    The stage is labeled with ``job['model']`` in the metrics, and is traced
+    as a child of ``job['span']``.
+
+    Args:
+        stage (Stage): The stage to run.
+        job (dict): The state of the job.
+
+    Returns:
+        dict: The state of the job for the next stage.
+    """
+    start = timeit.default_timer()
+    with tracing.use_span(job.get('span')), tracing.span(stage.name):
+        job = stage.func(job)
+    metrics.STAGE_SECONDS.labels(stage.name, job.get('model', '')).observe(
+        timeit.default_timer() - start)
+    return job
+
+
+class StagedPipeline(object):
+    """Run each job through a list of stages.
+
+    Every stage has its own worker threads and a bounded queue of jobs
+    waiting for it. Once the queue of a stage is full, the stage before it
+    blocks, so throughput is limited by the slowest stage instead of the
+    sum of all stages, and the number of jobs in flight is bounded.
+
+    The state of a job is a dict passed from stage to stage. A stage can set
+    ``job['done']`` to skip the remaining stages.
+
+    Args:
+        stages (list): The Stages of a job, in order.
+        queue_size (int): The number of jobs waiting for each stage.
+        on_transition (function): Called with the job and the stage before
+            a job enters a stage with a status.
+        on_done (function): Called with the job after its last stage.
+        on_error (function): Called with the job and the error if a stage
+            raises an error. The job skips the remaining stages.
+    """
+
+    def __init__(self, stages, queue_size=1, on_transition=None,
+                 on_done=None, on_error=None):
+        self.logger = logging.getLogger(str(self.__class__.__name__))
+        self.stages = list(stages)
+        self.queues = [queue.Queue(maxsize=max(queue_size, 1))
+                       for _ in self.stages]
+        self.on_transition = on_transition
+        self.on_done = on_done
+        self.on_error = on_error
+        # the first error raised by a callback, which stops the pipeline.
+        self.error = None
+        self._busy = [0] * len(self.stages)
+        self._processed = [0] * len(self.stages)
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        """Start the worker threads of every stage."""
+        for i, stage in enumerate(self.stages):
+            threads = []
+            for n in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._run_worker, args=(i,),
+                    name='{}-{}'.format(stage.name, n))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            self._threads.append(threads)
+
+    def submit(self, job):
+        """Queue a job for the first stage.
+
+        Blocks while the queue of the first stage is full.
+
+        Args:
+            job (dict): The state of the job.
+        """
+        self._put(0, job)
+
+    def _put(self, index, job):
+        self.queues[index].put(job)
+        metrics.STAGE_QUEUED.labels(self.stages[index].name).inc()
+
+    def stop(self):
+        """Finish every job in the pipeline, then stop the workers."""
+        # every job is passed on before a stage is stopped.
+        for i, threads in enumerate(self._threads):
+            for _ in threads:
+                self.queues[i].put(_STOP)
+            for thread in threads:
+                thread.join()
+        self._threads = []
+
+    def get_stats(self):
+        """Returns the occupancy and queue depth of each stage.
+
+        Returns:
+            dict: The number of ``workers``, the number of ``busy`` workers,
+                the number of ``queued`` jobs and the number of
+                ``processed`` jobs of each stage, by stage name.
+        """
+        with self._lock:
+            return {
+                stage.name: {
+                    'workers': stage.workers,
+                    'busy': self._busy[i],
+                    'queued': self.queues[i].qsize(),
+                    'processed': self._processed[i],
+                }
+                for i, stage in enumerate(self.stages)
+            }
+
+    def _run_worker(self, index):
+        while True:
+            job = self.queues[index].get()
+            if job is _STOP:
+                return
+
+            name = self.stages[index].name
+            metrics.STAGE_QUEUED.labels(name).dec()
+            metrics.STAGE_BUSY.labels(name).inc()
+            with self._lock:
+                self._busy[index] += 1
+            try:
+                self._run_stage(index, job)
+            except Exception as err:  # pylint: disable=broad-except
+                self.logger.error('Error in stage `%s`: %s: %s',
+                                  self.stages[index].name,
+                                  type(err).__name__, err)
+                if self.error is None:
+                    self.error = err
+            finally:
+                metrics.STAGE_BUSY.labels(name).dec()
+                with self._lock:
+                    self._busy[index] -= 1
+                    self._processed[index] += 1
+
+    def _run_stage(self, index, job):
+        stage = self.stages[index]
+        try:
+            if stage.status and self.on_transition is not None:
+                self.on_transition(job, stage)
+            job = run_stage(stage, job)
+        except Exception as err:  # pylint: disable=broad-except
+            if self.on_error is None:
+                raise err
+            self.on_error(job, err)
+            return
+
+        if job.get('done') or index == len(self.stages) - 1:
+            if self.on_done is not None:
+                self.on_done(job)
+        else:
+            # blocks while the next stage is full.
+            self._put(index + 1, job)
+
+
+class StagedEngine(object):
+    """Consume many jobs at the same time with the stages of one consumer.
+
+    Jobs are claimed as long as the first stage has room for them, and are
+    finished by the consumer once they leave the last stage. The status of
+    a job is updated as it enters each stage. The pre- and post-processing
+    functions run in a pool of processes, so that CPU-bound stages do not
+    hold the GIL of the I/O-bound stages.
+
+    Args:
+        consumer (redis_consumer.consumers.Consumer): Consumer with stages.
+        queue_size (int): The number of jobs waiting for each stage.
+        cpu_workers (int): The number of processes running the processing
+            functions. Defaults to the number of CPUs.
+        stats_interval (float): Log the stats of every stage this often,
+            in seconds.
+    """
+
+    def __init__(self, consumer, queue_size=1, cpu_workers=None,
+                 stats_interval=60):
+        self.logger = logging.getLogger(str(self.__class__.__name__))
+        self.consumer = consumer
+        self.queue_size = queue_size
+        self.cpu_workers = cpu_workers or os.cpu_count() or 1
+        self.stats_interval = stats_interval
+        self.pipeline = None
+
+    def _on_transition(self, job, stage):
+        self.consumer.update_key(job['redis_hash'], {'status': stage.status})
+
+    def _on_done(self, job):
+        try:
+            self.consumer.finish_job(job, job['status'])
+        finally:
+            # only if finishing the job raised an error.
+            self.consumer._end_job(job, 'error')
+
+    def _on_error(self, job, err):
+        try:
+            self.consumer.fail_job(job, err)
+        finally:
+            # only if failing the job raised an error.
+            self.consumer._end_job(job, 'error')
+
+    def _log_stats(self):
+        stats = self.pipeline.get_stats()
+        self.logger.debug('Stages: %s.', ', '.join(
+            '{} {busy}/{workers} busy, {queued} queued'.format(name, **stat)
+            for name, stat in stats.items()))
+
+    def run(self, stop_event):
+        """Consume jobs until the stop event is set.
+
+        Every job in the pipeline is finished before returning. If finishing
+        a job raises an error, no more jobs are claimed and the error is
+        raised once the pipeline is empty.
+
+        Args:
+            stop_event (threading.Event): Stop claiming jobs once set.
+        """
+        stages = self.consumer.get_stages()
+        if not stages:
+            raise ValueError('`{}` does not support stages.'.format(
+                type(self.consumer).__name__))
+
+        cpu_executor = None
+        if hasattr(self.consumer, 'cpu_executor'):
+            cpu_executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.cpu_workers)
+            # fork the processes before any threads are started.
+            list(cpu_executor.map(abs, range(self.cpu_workers)))
+            self.consumer.cpu_executor = cpu_executor
+
+        self.pipeline = StagedPipeline(
+            stages, self.queue_size,
+            on_transition=self._on_transition,
+            on_done=self._on_done,
+            on_error=self._on_error)
+        self.pipeline.start()
+        self.logger.info('Consuming jobs with stages %s.',
+                         ', '.join(stage.name for stage in stages))
+
+        last_stats = timeit.default_timer()
+        try:
+            while not stop_event.is_set() and self.pipeline.error is None:
+                job = self.consumer.claim_job()
+                if job is not None:
+                    self.pipeline.submit(job)
+
+                if timeit.default_timer() - last_stats > self.stats_interval:
+                    self._log_stats()
+                    last_stats = timeit.default_timer()
+        finally:
+            self.pipeline.stop()
+            if cpu_executor is not None:
+                cpu_executor.shutdown()
+
+        if self.pipeline.error is not None:
+            raise self.pipeline.error
@@ -0,0 +1,225 @@
+# Copyright 2016-2020 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-redis-consumer/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tests for the staged pipeline"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+
+import pytest
+
+from redis_consumer import consumers
+from redis_consumer.pipeline import Stage, StagedEngine, StagedPipeline
+from redis_consumer.testing_utils import redis_client
+
+
+class StagedConsumer(consumers.Consumer):
+    """Adds the stages of each job to a list."""
+
+    def __init__(self, *args, **kwargs):
+        self.stop_event = threading.Event()
+        self.num_jobs = kwargs.pop('num_jobs')
+        self.history = []
+        super(StagedConsumer, self).__init__(*args, **kwargs)
+
+    def _stage(self, name):
+        def func(job):
+            self.history.append((job['redis_hash'], name))
+            time.sleep(0.01)
+            if name == 'last':
+                job['status'] = self.final_status
+                self.update_key(job['redis_hash'], {'status': job['status']})
+                if len(self.history) == 2 * self.num_jobs:
+                    self.stop_event.set()
+            return job
+        return func
+
+    def get_stages(self):
+        return [
+            Stage('first', self._stage('first'), 2, 'first-status'),
+            Stage('last', self._stage('last'), 1, 'last-status'),
+        ]
+
+
+class TestStagedPipeline(object):
+    # pylint: disable=R0201,W0621
+
+    def test_run(self):
+        lock = threading.Lock()
+        in_flight = {'slow': 0, 'max': 0}
+        done = []
+        transitions = []
+
+        def slow(job):
+            with lock:
+                in_flight['slow'] += 1
+                in_flight['max'] = max(in_flight['max'], in_flight['slow'])
+            time.sleep(0.02)
+            with lock:
+                in_flight['slow'] -= 1
+            job['path'].append('slow')
+            return job
+
+        def fast(job):
+            job['path'].append('fast')
+            return job
+
+        stages = [
+            Stage('fast', fast, status='fast-status'),
+            Stage('slow', slow, workers=3, status='slow-status'),
+            Stage('last', fast),
+        ]
+        pipeline = StagedPipeline(
+            stages, queue_size=2,
+            on_transition=lambda job, stage: transitions.append(stage.name),
+            on_done=done.append)
+        pipeline.start()
+        for i in range(12):
+            pipeline.submit({'id': i, 'path': []})
+
+        stats = pipeline.get_stats()
+        assert list(stats) == ['fast', 'slow', 'last']
+        assert stats['slow']['workers'] == 3
+        # the queues are bounded
+        for stat in stats.values():
+            assert stat['queued'] <= 2
+            assert stat['busy'] <= stat['workers']
+
+        pipeline.stop()
+
+        # every job went through every stage, several in the slow stage
+        assert sorted(job['id'] for job in done) == list(range(12))
+        for job in done:
+            assert job['path'] == ['fast', 'slow', 'fast']
+        assert in_flight['max'] == 3
+        assert transitions.count('fast') == 12
+        assert transitions.count('slow') == 12
+        assert 'last' not in transitions
+
+        stats = pipeline.get_stats()
+        for stat in stats.values():
+            assert stat == {'workers': stat['workers'], 'busy': 0,
+                            'queued': 0, 'processed': 12}
+
+    def test_done_and_errors(self):
+        done = []
+        errors = []
+
+        def first(job):
+            if job['id'] == 0:
+                job['done'] = True
+            elif job['id'] == 1:
+                raise ValueError('thrown on purpose')
+            return job
+
+        def second(job):
+            job['second'] = True
+            return job
+
+        pipeline = StagedPipeline(
+            [Stage('first', first), Stage('second', second)],
+            on_done=done.append,
+            on_error=lambda job, err: errors.append((job['id'], err)))
+        pipeline.start()
+        for i in range(3):
+            pipeline.submit({'id': i})
+        pipeline.stop()
+
+        # finished jobs skip the remaining stages
+        assert [(job['id'], 'second' in job) for job in done] == [
+            (0, False), (2, True)]
+        assert [job_id for job_id, _ in errors] == [1]
+        assert isinstance(errors[0][1], ValueError)
+        assert pipeline.error is None
+
+        # errors in the callbacks stop the pipeline
+        def on_done(job):
+            raise ValueError('thrown on purpose')
+
+        pipeline = StagedPipeline([Stage('second', second)], on_done=on_done)
+        pipeline.start()
+        pipeline.submit({'id': 0})
+        pipeline.stop()
+        assert isinstance(pipeline.error, ValueError)
+
+
+class TestStagedEngine(object):
+    # pylint: disable=R0201,W0621
+
+    def test_run(self, mocker, redis_client):
+        mocker.patch('redis_consumer.settings.EMPTY_QUEUE_TIMEOUT', 0.01)
+        num_jobs = 5
+        consumer = StagedConsumer(redis_client, None, 'q', num_jobs=num_jobs)
+        for i in range(num_jobs):
+            redis_hash = 'job-{}'.format(i)
+            redis_client.hmset(redis_hash, {'input_file_name': 'file.tif',
+                                            'status': 'new'})
+            redis_client.lpush('q', redis_hash)
+
+        engine = StagedEngine(consumer, queue_size=1)
+        engine.run(consumer.stop_event)
+
+        # every job went through every stage and was released
+        for i in range(num_jobs):
+            redis_hash = 'job-{}'.format(i)
+            assert consumer.history.count((redis_hash, 'first')) == 1
+            assert consumer.history.count((redis_hash, 'last')) == 1
+            assert redis_client.hget(redis_hash, 'status') == 'done'
+        assert redis_client.llen('q') == 0
+        assert redis_client.zcard(consumer.lease_queue) == 0
+
+        stats = engine.pipeline.get_stats()
+        assert stats['first']['processed'] == num_jobs
+        assert stats['last']['processed'] == num_jobs
+
+    def test_run_error(self, mocker, redis_client):
+        mocker.patch('redis_consumer.settings.EMPTY_QUEUE_TIMEOUT', 0.01)
+        consumer = StagedConsumer(redis_client, None, 'q', num_jobs=1)
+        redis_client.hmset('job', {'input_file_name': 'file.tif'})
+        redis_client.lpush('q', 'job')
+
+        def finish_job(job, status):
+            consumer.stop_event.set()
+            raise ValueError('thrown on purpose')
+
+        consumer.finish_job = finish_job
+        end_job = mocker.spy(consumer, '_end_job')
+        with pytest.raises(ValueError):
+            StagedEngine(consumer).run(threading.Event())
+
+        # the job still ended, and its heartbeat was stopped
+        job, status = end_job.call_args[0]
+        assert status == 'error'
+        assert job['stop_heartbeat'].is_set()
+        assert 'in_flight' not in job
+        assert consumer._claimed_values == {}
+
+        # consumers without stages are not supported
+        consumer = consumers.Consumer(redis_client, None, 'q')
+        with pytest.raises(ValueError):
+            StagedEngine(consumer).run(threading.Event())
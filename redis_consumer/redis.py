@@ -29,11 +29,15 @@ from __future__ import division
 from __future__ import print_function
 
 import logging
+import threading
 import time
+import timeit
 import random
 
 import redis
 
+from redis_consumer import metrics
+
 
 REDIS_READONLY_COMMANDS = {
     'publish',
@@ -121,18 +125,110 @@ REDIS_READONLY_COMMANDS = {
     'georadiusbymember',
 }
 
+# Errors returned by a Redis Cluster while its slots are being moved or
+# failed over. The command is retried after refreshing the slot map.
+REDIS_CLUSTER_ERRORS = {
+    'MOVED',
+    'ASK',
+    'TRYAGAIN',
+    'CLUSTERDOWN',
+}
+
+# The exceptions raised by redis-py-cluster for the errors above.
+REDIS_CLUSTER_EXCEPTIONS = {
+    'MovedError',
+    'AskError',
+    'TryAgainError',
+    'ClusterDownError',
+}
+
+
+def hash_tag(key):
+    """Get the hash tag of the key, as used by Redis Cluster.
+
+    Keys that contain the returned tag are stored in the same hash slot
+    as the given key, so they can be used together in scripts.
+
+    Args:
+        key (str): The Redis key, e.g. a queue name or a Job hash.
+
+    Returns:
+        str: The hash tag of the key, including the braces.
+    """
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            return key[start:end + 1]
+    return '{%s}' % key
+
 
 class RedisClient(object):
+    """Fault tolerant Redis client.
+
+    Writes are sent to the master. Reads are sent to a replica, chosen with
+    a weight inversely proportional to its recent latency and replication
+    lag. Replicas in the same zone as this client are preferred, and slow
+    or unreachable replicas are ejected for a while.
+
+    Args:
+        host (str): The hostname of Redis Sentinel or a Redis Cluster node.
+        port (int): The port of Redis Sentinel or a Redis Cluster node.
+        backoff (int): Seconds to wait before retrying a failed command.
+        cluster (bool): Whether to connect to a Redis Cluster.
+        zone (str): The zone of this client.
+        replica_zones (dict): The zone of each replica host.
+        eject_latency (float): Eject replicas whose average latency is
+            above this many seconds. 0 disables ejection.
+        eject_time (float): Seconds before an ejected replica is used again.
+    """
+
+    # weight of the latest latency in the moving average of each replica.
+    latency_alpha = 0.2
+
+    # seconds to cache the replication offsets reported by the master.
+    offset_ttl = 1
 
-    def __init__(self, host, port, backoff=1):
+    def __init__(self, host, port, backoff=1, cluster=False, zone=None,
+                 replica_zones=None, eject_latency=0, eject_time=30):
         self.logger = logging.getLogger(str(self.__class__.__name__))
         self.backoff = backoff
-        self._sentinel = self._get_redis_client(host=host, port=port)
+        self.is_cluster = cluster
+        self.zone = zone
+        self.replica_zones = replica_zones or {}
+        self.eject_latency = eject_latency
+        self.eject_time = eject_time
+        # (host, port) -> moving average of the read latency in seconds.
+        self._latency = {}
+        # (host, port) -> replication lag reported by the master in seconds.
+        self._lag = {}
+        # (host, port) -> time until which the replica is not used.
+        self._ejected = {}
+        if cluster:
+            self._sentinel = self._get_cluster_client(host=host, port=port)
+        else:
+            self._sentinel = self._get_redis_client(host=host, port=port)
         self._redis_master = self._sentinel
         self._redis_slaves = [self._sentinel]
+        # read-your-writes: after a write, each thread only reads from the
+        # replicas that have caught up with the write.
+        self._local = threading.local()
+        # (time of the INFO request, master offset, offset of each replica).
+        self._replication = None
+        self._replication_lock = threading.Lock()
         self._update_masters_and_slaves()
 
     def _update_masters_and_slaves(self):
+        if self.is_cluster:
+            # the cluster client routes each command to the master of its
+            # slot, so only the slot map needs to be refreshed.
+            try:
+                self._redis_master.connection_pool.nodes.initialize()
+            except Exception as err:  # pylint: disable=broad-except
+                self.logger.warning('Encountered %s: %s when refreshing the '
+                                    'cluster slots.', type(err).__name__, err)
+            return
+
         try:
             sentinel_masters = self._sentinel.sentinel_masters()
 
@@ -150,6 +246,8 @@ class RedisClient(object):
 
                 self._redis_slaves = redis_slaves
                 self._redis_master = redis_master
+                # the offsets of the old replicas are no longer valid.
+                self._replication = None
         except redis.exceptions.ResponseError as err:
             self.logger.warning('Encountered Error: %s. Using sentinel as '
                                 'primary redis client.', err)
@@ -160,21 +258,187 @@ class RedisClient(object):
                                  decode_responses=True,
                                  charset='utf-8')
 
+    @classmethod
+    def _get_cluster_client(cls, host, port):
+        # redis-py-cluster is only required in cluster mode.
+        from rediscluster import RedisCluster
+
+        return RedisCluster(startup_nodes=[{'host': host, 'port': port}],
+                            decode_responses=True,
+                            skip_full_coverage_check=True)
+
+    @classmethod
+    def _is_cluster_error(cls, err):
+        """Returns whether the error is a redirection by Redis Cluster."""
+        if type(err).__name__ in REDIS_CLUSTER_EXCEPTIONS:
+            return True
+        return str(err).split(' ')[0] in REDIS_CLUSTER_ERRORS
+
+    @classmethod
+    def _get_address(cls, redis_client):
+        """Returns the (host, port) tuple of the given client."""
+        kwargs = redis_client.connection_pool.connection_kwargs
+        return str(kwargs.get('host')), int(kwargs.get('port', 6379))
+
+    def _get_replication_info(self):
+        """Get the replication offsets of the master and its replicas.
+
+        The offsets are requested with ``INFO replication`` at most every
+        ``offset_ttl`` seconds and are shared by all threads.
+
+        Returns:
+            tuple: The time of the request, the master offset and a dict of
+                the offset of each replica address.
+        """
+        with self._replication_lock:
+            if (self._replication is None or
+                    time.time() - self._replication[0] >= self.offset_ttl):
+                requested_at = time.time()
+                info = self._redis_master.info('replication')
+                master_offset = int(info.get('master_repl_offset', 0))
+
+                offsets = {}
+                for key, value in info.items():
+                    if not key.startswith('slave') or not isinstance(value, dict):
+                        continue
+                    if value.get('state', 'online') != 'online':
+                        continue
+                    address = (str(value.get('ip')), int(value.get('port')))
+                    self._lag[address] = float(value.get('lag', 0))
+                    offsets[address] = int(value.get('offset', -1))
+
+                self._replication = (requested_at, master_offset, offsets)
+            return self._replication
+
+    def _get_synced_slaves(self):
+        """Get the replicas that have replicated the last write of this thread.
+
+        The offset of the write is bounded by the master offset of the first
+        ``INFO replication`` requested after it. Until then, or if the
+        offsets are not stale yet, no replica is known to have the write and
+        the master is read without waiting for a new ``INFO replication``.
+
+        Returns:
+            list: The replica clients that are safe to read from.
+        """
+        local = self._local
+        if getattr(local, 'write_time', None) is None:
+            return self._redis_slaves
+
+        if self._redis_master in self._redis_slaves:
+            # not running with replicas, the master is always consistent.
+            return [self._redis_master]
+
+        requested_at, master_offset, offsets = self._get_replication_info()
+        if local.write_offset is None:
+            if requested_at < local.write_time:
+                return []
+            local.write_offset = master_offset
+
+        synced = [s for s in self._redis_slaves
+                  if offsets.get(self._get_address(s), -1) >= local.write_offset]
+        if len(synced) == len(self._redis_slaves):
+            # every replica has the write.
+            local.write_time = None
+        return synced
+
+    def _record_write(self):
+        """Only read from replicas that have the write from now on."""
+        self._local.write_time = time.time()
+        self._local.write_offset = None
+
+    def _eject(self, redis_client, reason):
+        """Stop reading from the replica for ``eject_time`` seconds."""
+        address = self._get_address(redis_client)
+        self._ejected[address] = time.time() + self.eject_time
+        self._latency.pop(address, None)
+        self.logger.warning('Ejected replica %s:%s for %s seconds: %s.',
+                            address[0], address[1], self.eject_time, reason)
+
+    def _record_latency(self, redis_client, latency):
+        """Update the moving average of the latency of the replica.
+
+        Args:
+            redis_client (redis.StrictRedis): The replica client.
+            latency (float): The latency of the last read, in seconds.
+        """
+        address = self._get_address(redis_client)
+        average = self._latency.get(address, latency)
+        average += self.latency_alpha * (latency - average)
+        self._latency[address] = average
+
+        if self.eject_latency and average > self.eject_latency:
+            self._eject(redis_client, 'average latency of {:.3f} '
+                        'seconds'.format(average))
+
+    def _get_weight(self, redis_client):
+        """Get the relative probability of reading from the replica."""
+        address = self._get_address(redis_client)
+        delay = self._latency.get(address, 0) + self._lag.get(address, 0)
+        return 1 / (delay + 0.001)
+
+    def _get_read_client(self):
+        """Get a client for a read-only command.
+
+        Reads are sent to a replica. After a write, a thread only reads from
+        the replicas that have caught up with its write, or from the master
+        if no replica is known to have caught up yet.
+
+        Ejected replicas are skipped and replicas in the same zone are
+        preferred. Each remaining replica is chosen with a weight inversely
+        proportional to its average latency and replication lag.
+
+        Returns:
+            redis.StrictRedis: The client to send the read command.
+        """
+        synced_slaves = self._get_synced_slaves()
+
+        # not running with replicas, or no replicas have caught up.
+        if self._redis_master in synced_slaves or not synced_slaves:
+            return self._redis_master
+
+        now = time.time()
+        replicas = [s for s in synced_slaves
+                    if self._ejected.get(self._get_address(s), 0) <= now]
+
+        if self.zone:
+            local_replicas = [
+                s for s in replicas
+                if self.replica_zones.get(self._get_address(s)[0]) == self.zone
+            ]
+            replicas = local_replicas or replicas
+
+        if not replicas:
+            return self._redis_master
+        if len(replicas) == 1:
+            return replicas[0]
+        weights = [self._get_weight(s) for s in replicas]
+        return random.choices(replicas, weights=weights)[0]
+
     def __getattr__(self, name):
 
         def wrapper(*args, **kwargs):
             values = list(args) + list(kwargs.values())
             values = [str(v) for v in values]
             while True:
+                redis_client = self._redis_master
                 try:
                     if name in REDIS_READONLY_COMMANDS:
-                        redis_client = random.choice(self._redis_slaves)
-                    else:
-                        redis_client = self._redis_master
+                        redis_client = self._get_read_client()
 
                     redis_function = getattr(redis_client, name)
-                    return redis_function(*args, **kwargs)
+                    start = timeit.default_timer()
+                    response = redis_function(*args, **kwargs)
+                    latency = timeit.default_timer() - start
+                    if name not in REDIS_READONLY_COMMANDS:
+                        self._record_write()
+                    metrics.REDIS_COMMAND_SECONDS.labels(name).observe(latency)
+                    if redis_client is not self._redis_master:
+                        self._record_latency(redis_client, latency)
+                    return response
                 except redis.exceptions.ConnectionError as err:
+                    if redis_client is not self._redis_master:
+                        self._eject(redis_client, err)
                     self._update_masters_and_slaves()
                     self.logger.warning('Encountered %s: %s when calling '
                                         '`%s %s`. Retrying in %s seconds.',
@@ -191,6 +455,15 @@ class RedisClient(object):
                                             str(name).upper(),
                                             ' '.join(values), self.backoff)
                         time.sleep(self.backoff)
+                    # the slot was moved to another node of the cluster
+                    elif self._is_cluster_error(err):
+                        self._update_masters_and_slaves()
+                        self.logger.warning('Encountered %s: %s when calling '
+                                            '`%s %s`. Retrying in %s seconds.',
+                                            type(err).__name__, err,
+                                            str(name).upper(),
+                                            ' '.join(values), self.backoff)
+                        time.sleep(self.backoff)
                     else:
                         raise err
                 except Exception as err:
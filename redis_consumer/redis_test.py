@@ -29,6 +29,7 @@ from __future__ import division
 from __future__ import print_function
 
 import random
+import threading
 import time
 
 import fakeredis
@@ -36,6 +37,7 @@ import redis
 import pytest
 
 from redis_consumer.redis import RedisClient
+from redis_consumer.redis import hash_tag
 
 
 class WrappedFakeStrictRedis(fakeredis.FakeStrictRedis):
@@ -64,10 +66,22 @@ class WrappedFakeStrictRedis(fakeredis.FakeStrictRedis):
             raise redis.exceptions.ConnectionError('thrown on purpose')
         return True
 
+    def moved_error(self, *_, **__):
+        if self.should_fail:
+            self.should_fail = False
+            raise redis.exceptions.ResponseError('MOVED 3999 127.0.0.1:6381')
+        return True
+
     def fail(self, *_, **__):
         raise redis.exceptions.ResponseError('thrown on purpose')
 
 
+def test_hash_tag():
+    assert hash_tag('predict') == '{predict}'
+    assert hash_tag('{predict}:x.tif:abc') == '{predict}'
+    assert hash_tag('predict-zip:{x}.zip:{abc}') == '{x}'
+
+
 class TestRedis(object):
     # pylint: disable=R0201
 
@@ -141,3 +155,157 @@ class TestRedis(object):
         response = client.busy_error()
         assert response
         spy.assert_called_once_with(client.backoff)
+
+        # mocked up Redis Cluster redirection
+        client = RedisClient(host='host', port='port', backoff=0)
+        spy = mocker.spy(client, '_update_masters_and_slaves')
+        response = client.moved_error()
+        assert response
+        spy.assert_called_once_with()
+
+    def test_cluster(self, mocker):
+        mocker.patch('redis_consumer.redis.RedisClient._get_cluster_client',
+                     lambda *_, **__: WrappedFakeStrictRedis(should_fail=True))
+
+        client = RedisClient(host='host', port='port', backoff=0,
+                             cluster=True)
+        # all commands are routed by the cluster client.
+        assert client._redis_master is client._sentinel
+        assert client._redis_slaves == [client._sentinel]
+        client.hset('key', 'field', 'value')
+        assert client._get_read_client() is client._sentinel
+        assert client.hget('key', 'field') == 'value'
+
+        # the slot map is refreshed after a redirection
+        spy = mocker.spy(client, '_update_masters_and_slaves')
+        assert client.moved_error()
+        spy.assert_called_once_with()
+
+    def test_read_your_writes(self, mocker):
+        mocker.patch('redis.StrictRedis', WrappedFakeStrictRedis)
+        client = RedisClient(host='host', port='port', backoff=0)
+
+        master = client._redis_master
+        synced, lagging = WrappedFakeStrictRedis(), WrappedFakeStrictRedis()
+        client._redis_slaves = [synced, lagging]
+        addresses = {id(synced): ('synced', 6379), id(lagging): ('lag', 6379)}
+        mocker.patch.object(client, '_get_address',
+                            lambda x: addresses[id(x)])
+
+        replication = {
+            'master_repl_offset': 100,
+            'slave0': {'ip': 'synced', 'port': 6379,
+                       'state': 'online', 'offset': 100},
+            'slave1': {'ip': 'lag', 'port': 6379,
+                       'state': 'online', 'offset': 50},
+        }
+        mocker.patch.object(master, 'info', return_value=replication)
+
+        # without a write, every replica is used
+        assert client._get_read_client() in {synced, lagging}
+        assert not master.info.called
+
+        # after a write, only the replicas with the write are used
+        client.hset('key', 'field', 'value')
+        for _ in range(10):
+            assert client._get_read_client() is synced
+        # the replication offsets are cached
+        master.info.assert_called_once_with('replication')
+
+        # other threads still read from every replica
+        reads = []
+        thread = threading.Thread(
+            target=lambda: reads.append(client._get_read_client()))
+        thread.start()
+        thread.join()
+        assert reads[0] in {synced, lagging}
+
+        # the cached offsets predate the next write, read from the master
+        # without another round trip
+        client.hset('key', 'field', 'value')
+        assert client._get_read_client() is master
+        assert master.info.call_count == 1
+
+        # the offsets are requested again once they are stale
+        mocker.patch.object(client, 'offset_ttl', 0)
+        replication['master_repl_offset'] = 150
+        assert client._get_read_client() is master
+        assert master.info.call_count == 2
+
+        # every replica caught up, the offsets are no longer needed
+        replication['slave0']['offset'] = 200
+        replication['slave1']['offset'] = 200
+        assert client._get_read_client() in {synced, lagging}
+        assert client._get_read_client() in {synced, lagging}
+        assert master.info.call_count == 3
+
+        # not running with replicas, the master is always used
+        client._redis_slaves = [master]
+        client.hset('key', 'field', 'value')
+        assert client._get_read_client() is master
+
+    def test_replica_selection(self, mocker):
+        mocker.patch('redis.StrictRedis', WrappedFakeStrictRedis)
+        client = RedisClient(host='host', port='port', backoff=0,
+                             zone='a', replica_zones={'near': 'a'},
+                             eject_latency=0.1, eject_time=30)
+
+        near, far, slow = [WrappedFakeStrictRedis() for _ in range(3)]
+        addresses = {
+            id(client._redis_master): ('master', 6379),
+            id(near): ('near', 6379),
+            id(far): ('far', 6379),
+            id(slow): ('slow', 6379),
+        }
+        mocker.patch.object(client, '_get_address',
+                            lambda x: addresses[id(x)])
+        client._redis_slaves = [near, far, slow]
+
+        # replicas in the same zone are preferred
+        for _ in range(10):
+            assert client._get_read_client() is near
+
+        # other replicas are used if there are none in the same zone
+        client.zone = 'b'
+        for _ in range(10):
+            assert client._get_read_client() in {near, far, slow}
+
+        # replicas are weighted by their latency and replication lag
+        client._latency[('near', 6379)] = 0.001
+        client._latency[('far', 6379)] = 0.05
+        client._lag[('slow', 6379)] = 1
+        random.seed(0)
+        choices = [client._get_read_client() for _ in range(200)]
+        assert choices.count(near) > choices.count(far) > choices.count(slow)
+
+        # a slow replica is ejected
+        mocker.patch.object(client, '_get_read_client', return_value=slow)
+        timer = iter([0, 0.5])
+        mocker.patch('timeit.default_timer', lambda: next(timer))
+        client.hget('key', 'field')
+        assert ('slow', 6379) not in client._latency
+        mocker.stopall()
+        mocker.patch.object(client, '_get_address',
+                            lambda x: addresses[id(x)])
+        for _ in range(10):
+            assert client._get_read_client() in {near, far}
+
+        # ejected replicas are used again after eject_time
+        client._ejected[('slow', 6379)] = time.time() - 1
+        choices = [client._get_read_client() for _ in range(200)]
+        assert slow in choices
+
+        # unreachable replicas are ejected
+        mocker.patch.object(client, '_update_masters_and_slaves')
+        mocker.patch.object(client, '_get_read_client', return_value=far)
+        mocker.patch.object(far, 'hget', side_effect=[
+            redis.exceptions.ConnectionError('thrown on purpose'), None])
+        client.hget('key', 'field')
+        assert client._ejected[('far', 6379)] > time.time()
+
+        # all replicas are ejected, read from the master
+        mocker.stopall()
+        mocker.patch.object(client, '_get_address',
+                            lambda x: addresses[id(x)])
+        client._ejected = {a: time.time() + 30 for a in addresses.values()}
+        assert client._get_read_client() is client._redis_master
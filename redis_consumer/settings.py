@@ -31,9 +31,7 @@ from __future__ import print_function
 import os
 
 import grpc
-from decouple import config
-
-from redis_consumer import processing
+from decouple import config, Csv
 
 
 # remove leading/trailing '/'s from cloud bucket folder names
@@ -41,6 +39,11 @@ def _strip(x):
     return '/'.join(y for y in x.split('/') if y)
 
 
+# the "none" processing function, which can be run in another process.
+def _identity(x):
+    return x
+
+
 # Debug Mode
 DEBUG = config('DEBUG', cast=bool, default=False)
 
@@ -54,6 +57,18 @@ MAX_IMAGE_WIDTH = config('MAX_IMAGE_WIDTH', default=2048, cast=int)
 # Redis client connection
 REDIS_HOST = config('REDIS_HOST', default='redis-master')
 REDIS_PORT = config('REDIS_PORT', default=6379, cast=int)
+REDIS_CLUSTER = config('REDIS_CLUSTER', default=False, cast=bool)
+# Prefer reading from replicas in the same zone as this consumer.
+# The zone of each replica host is given as "host:zone,host:zone".
+REDIS_ZONE = config('REDIS_ZONE', default='')
+REDIS_REPLICA_ZONES = {
+    host.strip(): zone.strip() for host, zone in (
+        x.rsplit(':', 1) for x in config(
+            'REDIS_REPLICA_ZONES', default='', cast=Csv()))
+}
+# Stop reading from replicas that are slower than this, in seconds.
+REDIS_EJECT_LATENCY = config('REDIS_EJECT_LATENCY', default=0.1, cast=float)
+REDIS_EJECT_TIME = config('REDIS_EJECT_TIME', default=30, cast=float)
 
 # TensorFlow Serving client connection
 TF_HOST = config('TF_HOST', default='tf-serving')
@@ -62,6 +77,8 @@ TF_PORT = config('TF_PORT', default=8500, cast=int)
 TF_MAX_BATCH_SIZE = config('TF_MAX_BATCH_SIZE', default=128, cast=int)
 # minimum expected model size, dynamically change batches proportionately.
 TF_MIN_MODEL_SIZE = config('TF_MIN_MODEL_SIZE', default=128, cast=int)
+# amount to overlap between the tiles of large images, (0, 1].
+STRIDE_RATIO = config('STRIDE_RATIO', default=0.75, cast=float)
 
 # gRPC API timeout in seconds
 GRPC_TIMEOUT = config('GRPC_TIMEOUT', default=30, cast=int)
@@ -78,6 +95,9 @@ GRPC_RETRY_STATUSES = {
 REDIS_TIMEOUT = config('REDIS_TIMEOUT', default=3, cast=int)
 EMPTY_QUEUE_TIMEOUT = config('EMPTY_QUEUE_TIMEOUT', default=5, cast=int)
 DO_NOTHING_TIMEOUT = config('DO_NOTHING_TIMEOUT', default=0.5, cast=float)
+MAX_RETRY_DELAY = config('MAX_RETRY_DELAY', default=60, cast=float)
+CHILDREN_RECOUNT_SIZE = config('CHILDREN_RECOUNT_SIZE', default=100,
+                               cast=int)
 STORAGE_MAX_BACKOFF = config('STORAGE_MAX_BACKOFF', default=60, cast=float)
 
 # Cloud storage
@@ -107,10 +127,112 @@ GCLOUD_STORAGE_BUCKET = config('GKE_BUCKET', default='default-bucket')
 # Pod Meteadta
 HOSTNAME = config('HOSTNAME', default='host-unkonwn')
 
+# Number of worker processes forked by consume-redis-events.py.
+WORKERS = config('WORKERS', default=1, cast=int)
+# Number of jobs consumed at the same time by each worker, and the number
+# of pre- and post-processing functions they run at the same time.
+CONCURRENCY = config('CONCURRENCY', default=1, cast=int)
+CPU_WORKERS = config('CPU_WORKERS', default=0, cast=int)
+# Run the stages of each job in their own worker threads, so that each
+# worker consumes many jobs at the same time. Only used by consumers with
+# stages. Processing functions run in CPU_WORKERS processes.
+STAGED_PIPELINE = config('STAGED_PIPELINE', default=False, cast=bool)
+# Number of jobs waiting for each stage.
+STAGE_QUEUE_SIZE = config('STAGE_QUEUE_SIZE', default=1, cast=int)
+# Worker threads of each stage, as "stage:workers,stage:workers".
+STAGE_WORKERS = {
+    name.strip(): int(workers) for name, workers in (
+        x.rsplit(':', 1) for x in config(
+            'STAGE_WORKERS', default='', cast=Csv()))
+}
+
+# Export trace spans of each job to "memory", "json" (to TRACE_FILE) or any
+# class with an export(span) method, as "package.module.Class".
+TRACE_EXPORTER = config('TRACE_EXPORTER', default='')
+TRACE_FILE = config('TRACE_FILE', default=os.path.join(LOG_DIR, 'traces.jsonl'))
+
+# Serve Prometheus metrics on this port, or 0 to disable the endpoint.
+METRICS_PORT = config('METRICS_PORT', default=8000, cast=int)
+
 # Redis queue
 QUEUE = config('QUEUE', default='predict')
 SEGMENTATION_QUEUE = config('SEGMENTATION_QUEUE', default='predict')
 
+# Queue implementation, either "list" or "stream" (Redis Streams)
+QUEUE_BACKEND = config('QUEUE_BACKEND', default='list', cast=str).lower()
+# Consumer group shared by all consumers of a stream
+STREAM_GROUP = config('STREAM_GROUP', default='redis-consumer', cast=str)
+
+# Push child jobs onto a lane per parent, claimed round-robin with other jobs.
+FAIR_SHARE_ENABLED = config('FAIR_SHARE_ENABLED', default=False, cast=bool)
+
+# Order jobs by "fifo", "sjf" (shortest job first, with aging)
+# or "edf" (earliest deadline first).
+QUEUE_POLICY = config('QUEUE_POLICY', default='fifo', cast=str).lower()
+# Number of jobs ordered at a time by the "sjf" and "edf" policies.
+SCHEDULE_WINDOW = config('SCHEDULE_WINDOW', default=100, cast=int)
+# Cost a job is allowed to catch up for every second it has waited.
+AGING_RATE = config('AGING_RATE', default=100000, cast=float)
+# Seconds until the deadline of jobs without a deadline.
+DEFAULT_DEADLINE = config('DEFAULT_DEADLINE', default=600, cast=float)
+# Cost per pixel of each model, as "ModelName:factor,OtherModel:factor".
+MODEL_COST_FACTORS = {
+    name.strip(): float(factor) for name, factor in (
+        x.rsplit(':', 1) for x in config(
+            'MODEL_COST_FACTORS', default='', cast=Csv()))
+}
+
+# Prefer jobs for the AFFINITY_MODELS most recently claimed models among the
+# oldest AFFINITY_WINDOW jobs of a queue, skipping the oldest job at most
+# AFFINITY_MAX_SKIPS times. Only used by the "fifo" policy.
+AFFINITY_WINDOW = config('AFFINITY_WINDOW', default=0, cast=int)
+AFFINITY_MODELS = config('AFFINITY_MODELS', default=2, cast=int)
+AFFINITY_MAX_SKIPS = config('AFFINITY_MAX_SKIPS', default=10, cast=int)
+
+# Merge status updates of a claimed job and write them at most this often.
+STATUS_UPDATE_INTERVAL = config('STATUS_UPDATE_INTERVAL', default=1, cast=float)
+
+# Publish status and progress changes to the channel "<job hash>:status"
+# and add them to a stream of bounded length.
+STATUS_EVENTS_ENABLED = config('STATUS_EVENTS_ENABLED', default=False, cast=bool)
+STATUS_STREAM = config('STATUS_STREAM', default='status-events')
+STATUS_STREAM_MAXLEN = config('STATUS_STREAM_MAXLEN', default=10000, cast=int)
+
+# Claimed jobs are leased for this many seconds, renewed by a heartbeat.
+# Jobs whose lease has expired are put back into the queue.
+LEASE_TIME = config('LEASE_TIME', default=180, cast=int)
+
+# Create job workspaces in this directory on a RAM-backed tmpfs, as long as
+# they use less than WORKSPACE_TMPFS_BUDGET megabytes. Otherwise, if their
+# size is unknown, or if no directory is set, workspaces are created on disk.
+WORKSPACE_TMPFS = config('WORKSPACE_TMPFS', default='')
+WORKSPACE_TMPFS_BUDGET = config('WORKSPACE_TMPFS_BUDGET', default=1024, cast=int)
+
+# Only consume jobs whose estimated peak memory fits in MEMORY_BUDGET
+# megabytes, together with the other jobs of this process. Jobs that never
+# fit are moved to LARGE_MEMORY_QUEUE, or failed if it is not set.
+# 0 disables admission.
+MEMORY_BUDGET = config('MEMORY_BUDGET', default=0, cast=int)
+LARGE_MEMORY_QUEUE = config('LARGE_MEMORY_QUEUE', default='').lower()
+# Peak bytes per input value of each model, as "ModelName:bytes,...".
+MODEL_MEMORY_FACTORS = {
+    name.strip(): float(factor) for name, factor in (
+        x.rsplit(':', 1) for x in config(
+            'MODEL_MEMORY_FACTORS', default='', cast=Csv()))
+}
+
+# Apply the tuning parameters in this Redis hash before claiming a job, once
+# its "version" field changes. Checked every LIVE_SETTINGS_INTERVAL seconds.
+LIVE_SETTINGS_KEY = config('LIVE_SETTINGS_KEY', default='')
+LIVE_SETTINGS_INTERVAL = config('LIVE_SETTINGS_INTERVAL', default=10, cast=float)
+
+# Reuse the result of a finished job for jobs with the same input file, model
+# and processing. Results are kept for RESULT_CACHE_TTL seconds after they were
+# last used, and at most RESULT_CACHE_SIZE results are kept.
+RESULT_CACHE_ENABLED = config('RESULT_CACHE_ENABLED', default=False, cast=bool)
+RESULT_CACHE_TTL = config('RESULT_CACHE_TTL', default=86400, cast=int)
+RESULT_CACHE_SIZE = config('RESULT_CACHE_SIZE', default=10000, cast=int)
+
 # Configure expiration time for child keys
 EXPIRE_TIME = config('EXPIRE_TIME', default=3600, cast=int)
 
@@ -118,22 +240,27 @@ EXPIRE_TIME = config('EXPIRE_TIME', default=3600, cast=int)
 METADATA_EXPIRE_TIME = config('METADATA_EXPIRE_TIME', default=30, cast=int)
 
 # Pre- and Post-processing settings
+# Functions are imported by their dotted path when they are first used,
+# as importing deepcell_toolbox slows down the start of every consumer.
 PROCESSING_FUNCTIONS = {
     'pre': {
-        'normalize': processing.normalize,
-        'histogram_normalization': processing.phase_preprocess,
-        'multiplex_preprocess': processing.multiplex_preprocess,
-        'none': lambda x: x
+        'normalize': 'redis_consumer.processing.normalize',
+        'histogram_normalization': 'redis_consumer.processing.phase_preprocess',
+        'multiplex_preprocess': 'redis_consumer.processing.multiplex_preprocess',
+        'none': _identity
     },
     'post': {
-        'deepcell': processing.pixelwise,  # TODO: this is deprecated.
-        'pixelwise': processing.pixelwise,
-        'watershed': processing.watershed,
-        'retinanet': processing.retinanet_to_label_image,
-        'retinanet-semantic': processing.retinanet_semantic_to_label_image,
-        'deep_watershed': processing.deep_watershed,
-        'multiplex_postprocess_consumer': processing.multiplex_postprocess_consumer,
-        'none': lambda x: x
+        # TODO: this is deprecated.
+        'deepcell': 'redis_consumer.processing.pixelwise',
+        'pixelwise': 'redis_consumer.processing.pixelwise',
+        'watershed': 'redis_consumer.processing.watershed',
+        'retinanet': 'redis_consumer.processing.retinanet_to_label_image',
+        'retinanet-semantic':
+            'redis_consumer.processing.retinanet_semantic_to_label_image',
+        'deep_watershed': 'redis_consumer.processing.deep_watershed',
+        'multiplex_postprocess_consumer':
+            'redis_consumer.processing.multiplex_postprocess_consumer',
+        'none': _identity
     },
 }
 
@@ -37,13 +37,11 @@ import random
 import socket
 import urllib3
 
-import boto3
-import google.auth.exceptions
-import google.cloud.exceptions
-import google.cloud.storage
 import requests
 
+from redis_consumer import metrics
 from redis_consumer import settings
+from redis_consumer import tracing
 
 
 class StorageException(Exception):
@@ -100,6 +98,23 @@ class Storage(object):
         """Returns the storage API client"""
         raise NotImplementedError
 
+    def _record_transfer(self, operation, filepath, start):
+        """Record the size and time of an upload or download.
+
+        Args:
+            operation (str): "upload" or "download".
+            filepath (str): The local path of the transferred file.
+            start (float): When the transfer started.
+        """
+        duration = timeit.default_timer() - start
+        metrics.STORAGE_SECONDS.labels(operation).observe(duration)
+        try:
+            size = os.path.getsize(filepath)
+        except OSError:
+            size = 0
+        metrics.STORAGE_BYTES.labels(operation).inc(size)
+        tracing.record_span(operation, duration, file=filepath, size=size)
+
     def get_download_path(self, filepath, download_dir=None):
         """Get local filepath for soon-to-be downloaded file.
 
@@ -118,6 +133,17 @@ class Storage(object):
             os.makedirs(os.path.dirname(dest))
         return dest
 
+    def get_size(self, filepath):
+        """Get the size of a file in the cloud storage bucket.
+
+        Args:
+            filepath: key of file in cloud storage
+
+        Returns:
+            int: The size of the file in bytes, or None if it is unknown.
+        """
+        raise NotImplementedError
+
     def download(self, filepath, download_dir):
         """Download a  file from the cloud storage bucket.
 
@@ -153,6 +179,10 @@ class GoogleStorage(Storage):
     def __init__(self, bucket,
                  download_dir=settings.DOWNLOAD_DIR,
                  max_backoff=settings.STORAGE_MAX_BACKOFF):
+        # the cloud SDKs are slow to import, only import the one in use.
+        import google.auth.exceptions
+        import google.cloud.exceptions
+
         super(GoogleStorage, self).__init__(bucket, download_dir, max_backoff)
         self.bucket_url = 'www.googleapis.com/storage/v1/b/{}/o'.format(bucket)
         self._network_errors = (
@@ -171,6 +201,8 @@ class GoogleStorage(Storage):
 
     def get_storage_client(self):
         """Returns the storage API client"""
+        import google.cloud.storage
+
         attempts = 0
         while True:
             try:
@@ -211,6 +243,9 @@ class GoogleStorage(Storage):
                                     'seconds...', type(err).__name__, err,
                                     backoff)
                 time.sleep(backoff)
+                tracing.record_span('retry', backoff, error=err,
+                                    operation='get_public_url',
+                                    attempt=attempts)
                 attempts += 1
                 retrying = True  # Unneccessary but explicit
 
@@ -245,6 +280,7 @@ class GoogleStorage(Storage):
                 bucket = client.get_bucket(self.bucket)
                 blob = bucket.blob(dest)
                 blob.upload_from_filename(filepath, predefined_acl='publicRead')
+                self._record_transfer('upload', filepath, start)
                 self.logger.debug('Uploaded %s to bucket %s in %s seconds.',
                                   filepath, self.bucket,
                                   timeit.default_timer() - start)
@@ -256,6 +292,8 @@ class GoogleStorage(Storage):
                                     'seconds...', type(err).__name__, err,
                                     backoff)
                 time.sleep(backoff)
+                tracing.record_span('retry', backoff, error=err,
+                                    operation='upload', attempt=attempts)
                 attempts += 1
                 retrying = True  # Unneccessary but explicit
 
@@ -265,6 +303,24 @@ class GoogleStorage(Storage):
                                   type(err).__name__, err, filepath)
                 raise err
 
+    def get_size(self, filepath):
+        """Get the size of a file in the cloud storage bucket.
+
+        Args:
+            filepath: key of file in cloud storage
+
+        Returns:
+            int: The size of the file in bytes, or None if it is unknown.
+        """
+        try:
+            client = self.get_storage_client()
+            blob = client.get_bucket(self.bucket).get_blob(filepath)
+            return None if blob is None else blob.size
+        except Exception as err:  # pylint: disable=broad-except
+            self.logger.warning('Encountered %s: %s while getting the size '
+                                'of %s.', type(err).__name__, err, filepath)
+            return None
+
     def download(self, filepath, download_dir=None):
         """Download a  file from the cloud storage bucket.
 
@@ -285,6 +341,7 @@ class GoogleStorage(Storage):
                 start = timeit.default_timer()
                 blob = client.get_bucket(self.bucket).blob(filepath)
                 blob.download_to_filename(dest)
+                self._record_transfer('download', dest, start)
                 self.logger.debug('Downloaded %s from bucket %s in %s seconds.',
                                   dest, self.bucket,
                                   timeit.default_timer() - start)
@@ -296,6 +353,8 @@ class GoogleStorage(Storage):
                                     'seconds and...', type(err).__name__, err,
                                     backoff)
                 time.sleep(backoff)
+                tracing.record_span('retry', backoff, error=err,
+                                    operation='download', attempt=attempts)
                 attempts += 1
                 retrying = True  # Unneccessary but explicit
 
@@ -322,6 +381,8 @@ class S3Storage(Storage):
 
     def get_storage_client(self):
         """Returns the storage API client"""
+        import boto3
+
         return boto3.client(
             's3',
             region_name=settings.AWS_REGION,
@@ -359,6 +420,7 @@ class S3Storage(Storage):
         self.logger.debug('Uploading %s to bucket %s.', filepath, self.bucket)
         try:
             client.upload_file(filepath, self.bucket, dest)
+            self._record_transfer('upload', filepath, start)
             self.logger.debug('Uploaded %s to bucket %s in %s seconds.',
                               filepath, self.bucket,
                               timeit.default_timer() - start)
@@ -368,6 +430,27 @@ class S3Storage(Storage):
                               type(err).__name__, err, filepath)
             raise err
 
+    def get_size(self, filepath):
+        """Get the size of a file in the cloud storage bucket.
+
+        Args:
+            filepath: key of file in cloud storage
+
+        Returns:
+            int: The size of the file in bytes, or None if it is unknown.
+        """
+        # Bucket keys shouldn't start with "/"
+        if filepath.startswith('/'):
+            filepath = filepath[1:]
+        try:
+            client = self.get_storage_client()
+            response = client.head_object(Bucket=self.bucket, Key=filepath)
+            return response['ContentLength']
+        except Exception as err:  # pylint: disable=broad-except
+            self.logger.warning('Encountered %s: %s while getting the size '
+                                'of %s.', type(err).__name__, err, filepath)
+            return None
+
     def download(self, filepath, download_dir=None):
         """Download a  file from the cloud storage bucket.
 
@@ -388,6 +471,7 @@ class S3Storage(Storage):
         self.logger.debug('Downloading %s to %s.', filepath, dest)
         try:
             client.download_file(self.bucket, filepath, dest)
+            self._record_transfer('download', dest, start)
             self.logger.debug('Downloaded %s from bucket %s in %s seconds.',
                               dest, self.bucket, timeit.default_timer() - start)
             return dest
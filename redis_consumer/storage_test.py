@@ -66,6 +66,7 @@ class Singleton(_Singleton('SingletonMeta', (object,), {})):
 
 class DummyGoogleClient(Singleton):
     public_url = 'public-url'
+    size = 1024
 
     def __call__(self, *args, **kwargs):
         return self
@@ -104,6 +105,11 @@ class DummyS3Client(object):
     def download_file(self, bucket, path, dest, **_):
         assert path.startswith('test')
 
+    def head_object(self, Bucket, Key, **_):  # pylint: disable=invalid-name
+        if not Key.startswith('test'):
+            raise OSError('Thrown on purpose')
+        return {'ContentLength': 1024}
+
     def upload_file(self, path, bucket, dest, **_):
         assert os.path.exists(path)
 
@@ -204,6 +210,16 @@ class TestGoogleStorage(object):
                 # self._client raises, but so does storage.upload
                 dest, url = stg.upload('file-does-not-exist')
 
+    def test_get_size(self, tmpdir, mocker):
+        mocker.patch('google.cloud.storage.Client', DummyGoogleClient)
+        stg = storage.GoogleStorage('test-bucket', str(tmpdir))
+        assert stg.get_size('test/file.txt') == 1024
+
+        # the size is unknown if it cannot be requested
+        mocker.patch.object(DummyGoogleClient, 'get_blob',
+                            throw_critical_error, create=True)
+        assert stg.get_size('test/file.txt') is None
+
     def test_download(self, tmpdir, mocker):
         remote_file = '/test/file.txt'
         tmpdir = str(tmpdir)
@@ -256,6 +272,14 @@ class TestS3Storage(object):
                 # self._client raises, but so does storage.upload
                 dest, url = stg.upload('file-does-not-exist')
 
+    def test_get_size(self, tmpdir, mocker):
+        mocker.patch('boto3.client', DummyS3Client)
+        stg = storage.S3Storage('test-bucket', str(tmpdir))
+        assert stg.get_size('/test/file.txt') == 1024
+
+        # the size is unknown if it cannot be requested
+        assert stg.get_size('bad/file.txt') is None
+
     def test_download(self, tmpdir, mocker):
         tmpdir = str(tmpdir)
         mocker.patch('boto3.client', DummyS3Client)
@@ -28,6 +28,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import hashlib
 import os
 
 import numpy as np
@@ -37,6 +39,7 @@ import pytest
 import fakeredis
 
 from redis_consumer import utils
+from redis_consumer.redis import RedisClient
 
 
 @pytest.fixture
@@ -48,6 +51,137 @@ def redis_client():
     yield client
 
 
+class RoundTripCounter(object):
+    """Counts the Redis commands and round trips sent by connections.
+
+    Every command is one round trip, and so is every executed pipeline.
+    Scripts in ``script_names`` are counted by name instead of by SHA.
+    """
+
+    def __init__(self):
+        self.script_names = {}
+        self.reset_counts()
+
+    def reset_counts(self):
+        self.commands = collections.Counter()
+        self.round_trips = 0
+
+    def name_scripts(self, module):
+        """Name the Lua scripts defined as ``*_SCRIPT`` in the module."""
+        for name, value in vars(module).items():
+            if name.endswith('_SCRIPT'):
+                sha = hashlib.sha1(value.encode('utf-8')).hexdigest()
+                self.script_names[sha] = name
+
+    def _get_command_name(self, args):
+        name = str(args[0]).upper()
+        if name == 'EVALSHA':
+            name = 'EVALSHA {}'.format(self.script_names.get(args[1], args[1]))
+        return name
+
+    def count(self, args):
+        self.round_trips += 1
+        self.commands[self._get_command_name(args)] += 1
+
+    def count_pipeline(self, command_stack):
+        self.round_trips += 1
+        for command_args, _ in command_stack:
+            name = self._get_command_name(command_args)
+            self.commands['{} (pipelined)'.format(name)] += 1
+
+    def get_breakdown(self):
+        """Returns a table of the number of times each command was sent."""
+        lines = ['{:>6}  {}'.format(count, name)
+                 for name, count in self.commands.most_common()]
+        return '\n'.join(lines)
+
+    def assert_round_trips(self, budget, description):
+        """Fail with a breakdown of the commands if over the budget."""
+        assert self.round_trips <= budget, (
+            '{} made {} Redis round trips, over the budget of {}:\n{}'.format(
+                description, self.round_trips, budget, self.get_breakdown()))
+
+
+class CountingRedis(fakeredis.FakeStrictRedis):
+    """FakeStrictRedis that counts its commands with a RoundTripCounter.
+
+    fakeredis does not support ``INFO``, so ``INFO replication`` reports
+    ``replicas``, which share the server and are always in sync.
+    """
+
+    def __init__(self, counter, *args, **kwargs):
+        super(CountingRedis, self).__init__(*args, **kwargs)
+        self.counter = counter
+        self.replicas = []
+
+    def execute_command(self, *args, **options):
+        self.counter.count(args)
+        return super(CountingRedis, self).execute_command(*args, **options)
+
+    def info(self, section=None):
+        self.counter.count(['INFO', section])
+        offset = self.counter.round_trips
+        info = {'role': 'master', 'master_repl_offset': offset}
+        for i, replica in enumerate(self.replicas):
+            address = replica.connection_pool.connection_kwargs
+            info['slave{}'.format(i)] = {
+                'ip': address['host'],
+                'port': address['port'],
+                'state': 'online',
+                'offset': offset,
+                'lag': 0,
+            }
+        return info
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super(CountingRedis, self).pipeline(transaction, shard_hint)
+        execute = pipe.execute
+
+        def counted_execute(*args, **kwargs):
+            if pipe.command_stack:
+                self.counter.count_pipeline(pipe.command_stack)
+            return execute(*args, **kwargs)
+
+        pipe.execute = counted_execute
+        return pipe
+
+
+class CountingRedisClient(RedisClient):
+    """RedisClient of a master and a replica that count their commands.
+
+    The commands sent by the client, including its own ``INFO`` requests,
+    are counted in ``counter``.
+
+    Args:
+        server (fakeredis.FakeServer): The server shared with other
+            connections, e.g. of child jobs that should not be counted.
+    """
+
+    # count the worst case, an INFO for the first read after every write.
+    offset_ttl = 0
+
+    def __init__(self, server=None):
+        self.counter = RoundTripCounter()
+        self._server = server or fakeredis.FakeServer()
+        super(CountingRedisClient, self).__init__('master', 6379, backoff=0)
+
+    def _get_redis_client(self, host, port):
+        return CountingRedis(self.counter, server=self._server,
+                             host=host, port=port, decode_responses='utf8')
+
+    def _update_masters_and_slaves(self):
+        if self._redis_master.replicas:
+            return
+        replica = self._get_redis_client('replica', 6379)
+        self._redis_master.replicas.append(replica)
+        self._redis_slaves = [replica]
+
+
+@pytest.fixture
+def counting_redis_client():
+    yield CountingRedisClient()
+
+
 def _get_image(img_h=300, img_w=300):
     bias = np.random.rand(img_w, img_h) * 64
     variance = np.random.rand(img_w, img_h) * (255 - 64)
@@ -71,13 +205,14 @@ class DummyStorage(object):
             for i in range(self.num):
                 img = _get_image()
                 base, ext = os.path.splitext(path)
-                _path = '{}{}{}'.format(base, i, ext)
-                tiff.imsave(os.path.join(dest, _path), img)
+                _path = os.path.join(dest, '{}{}{}'.format(base, i, ext))
+                tiff.imsave(_path, img)
                 paths.append(_path)
             return utils.zip_files(paths, dest)
         img = _get_image()
-        tiff.imsave(os.path.join(dest, path), img)
-        return path
+        _path = os.path.join(dest, path)
+        tiff.imsave(_path, img)
+        return _path
 
     def upload(self, zip_path, subdir=None):
         return 'zip_path.zip', 'blob.public_url'
@@ -95,3 +230,34 @@ def make_model_metadata_of_size(model_shape=(-1, 256, 256, 2)):
             'in_tensor_shape': ','.join(str(s) for s in model_shape),
         }]
     return get_model_metadata
+
+
+def make_predict_client(model_shape=(-1, 256, 256, 2), output_channels=None):
+    """Stub of the TensorFlow Serving gRPC client.
+
+    Args:
+        model_shape (tuple): The input shape reported in the model metadata.
+        output_channels (list): The number of channels of each output of
+            the model, which are all zeros. The input is echoed if None.
+    """
+    def predict(req_data, _):
+        data = req_data[0]['data']
+        if output_channels is None:
+            return {'prediction': data}
+        return {'prediction_{}'.format(i): np.zeros(data.shape[:-1] + (c,))
+                for i, c in enumerate(output_channels)}
+
+    metadata = {
+        'image': {
+            'dtype': 'DT_FLOAT',
+            'tensorShape': {'dim': [{'size': str(s)} for s in model_shape]},
+        }
+    }
+
+    def _get_predict_client(model_name, model_version):  # pylint: disable=unused-argument
+        return Bunch(
+            predict=predict,
+            get_model_metadata=lambda: {'metadata': {'signature_def': {
+                'signatureDef': {'serving_default': {'inputs': metadata}}
+            }}})
+    return _get_predict_client
@@ -0,0 +1,335 @@
+# Copyright 2016-2020 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-redis-consumer/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Trace spans of jobs across Redis, storage, gRPC and processing.
+
+Spans use W3C Trace Context IDs, so a span can be continued in another
+process from its ``traceparent``, e.g. in gRPC metadata or in the hash of
+a child job. Finished spans are exported to the exporter chosen by
+TRACE_EXPORTER. Tracing is disabled if there is no exporter, in which case
+spans are cheap no-ops.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import importlib
+import json
+import os
+import threading
+import time
+
+from redis_consumer import settings
+
+
+# the active spans of each thread, innermost last.
+_local = threading.local()
+
+# the exporter of finished spans, configured by TRACE_EXPORTER.
+_exporter = None
+_exporter_configured = False
+_exporter_lock = threading.Lock()
+
+
+def _new_id(num_bytes):
+    return os.urandom(num_bytes).hex()
+
+
+def parse_traceparent(traceparent):
+    """Parse a W3C ``traceparent`` header.
+
+    Args:
+        traceparent (str): The traceparent, "00-trace_id-span_id-flags".
+
+    Returns:
+        tuple: The trace ID and span ID, or (None, None) if invalid.
+    """
+    parts = str(traceparent or '').split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None
+    return parts[1], parts[2]
+
+
+class Span(object):
+    """A timed operation of a trace.
+
+    Args:
+        name (str): The name of the operation.
+        trace_id (str): The 32 hex digit ID of the trace.
+        parent_id (str): The 16 hex digit ID of the parent span.
+        start_time (float): The start of the span, in seconds since epoch.
+        attributes (dict): Attributes of the span.
+        exporter: Exports the span once it ends.
+    """
+
+    def __init__(self, name, trace_id=None, parent_id=None, start_time=None,
+                 attributes=None, exporter=None):
+        self.name = name
+        self.trace_id = trace_id or _new_id(16)
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.start_time = time.time() if start_time is None else start_time
+        self.end_time = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+        self.exporter = exporter
+
+    @property
+    def traceparent(self):
+        """The W3C ``traceparent`` of the span, to continue its trace."""
+        return '00-{}-{}-01'.format(self.trace_id, self.span_id)
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self, end_time=None, error=None):
+        """End the span and export it. Only the first call has an effect.
+
+        Args:
+            end_time (float): The end of the span, in seconds since epoch.
+            error (Exception): The error that ended the span, if any.
+        """
+        if self.end_time is not None:
+            return
+        self.end_time = time.time() if end_time is None else end_time
+        if error is not None:
+            self.error = '{}: {}'.format(type(error).__name__, error)
+        if self.exporter is not None:
+            self.exporter.export(self)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'duration': (self.end_time or time.time()) - self.start_time,
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+class _NoopSpan(object):
+    """Returned instead of a Span while tracing is disabled."""
+
+    name = trace_id = span_id = parent_id = traceparent = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def end(self, end_time=None, error=None):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class InMemoryExporter(object):
+    """Keeps finished spans in memory, e.g. for tests."""
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def get_spans(self, trace_id=None):
+        """Returns the finished spans, optionally only those of a trace."""
+        with self._lock:
+            return [s for s in self.spans
+                    if trace_id is None or s.trace_id == trace_id]
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+
+
+class JsonFileExporter(object):
+    """Appends each finished span to a file, as one JSON object per line.
+
+    Args:
+        path (str): The path of the file. Defaults to TRACE_FILE.
+    """
+
+    def __init__(self, path=None):
+        self.path = settings.TRACE_FILE if path is None else path
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+EXPORTERS = {
+    'memory': InMemoryExporter,
+    'json': JsonFileExporter,
+}
+
+
+def _create_exporter(name):
+    if not name:
+        return None
+    if name in EXPORTERS:
+        return EXPORTERS[name]()
+    # any class with an export(span) method, as "package.module.Class".
+    module_name, class_name = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+def get_exporter():
+    """Returns the exporter of finished spans, or None if disabled."""
+    global _exporter, _exporter_configured  # pylint: disable=global-statement
+    if not _exporter_configured:
+        with _exporter_lock:
+            if not _exporter_configured:
+                _exporter = _create_exporter(settings.TRACE_EXPORTER)
+                _exporter_configured = True
+    return _exporter
+
+
+def set_exporter(exporter):
+    """Export finished spans to the exporter, or disable tracing if None.
+
+    Args:
+        exporter: Any object with an ``export(span)`` method.
+    """
+    global _exporter, _exporter_configured  # pylint: disable=global-statement
+    with _exporter_lock:
+        _exporter = exporter
+        _exporter_configured = True
+
+
+def _get_stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def get_current_span():
+    """Returns the innermost active span of this thread, or None."""
+    stack = _get_stack()
+    return stack[-1] if stack else None
+
+
+def get_traceparent():
+    """Returns the ``traceparent`` of the current span, or None."""
+    span = get_current_span()
+    return None if span is None else span.traceparent
+
+
+def start_span(name, parent=None, traceparent=None, start_time=None,
+               **attributes):
+    """Start a span, which must be ended with ``span.end()``.
+
+    Args:
+        name (str): The name of the operation.
+        parent (Span): The parent span. Defaults to the current span.
+        traceparent (str): Continue the trace of this ``traceparent``
+            instead, e.g. from the hash of a child job.
+        start_time (float): The start of the span, in seconds since epoch.
+        attributes: Attributes of the span.
+
+    Returns:
+        Span: The started span, or NOOP_SPAN if tracing is disabled.
+    """
+    exporter = get_exporter()
+    if exporter is None:
+        return NOOP_SPAN
+
+    trace_id, parent_id = parse_traceparent(traceparent)
+    if trace_id is None:
+        parent = get_current_span() if parent is None else parent
+        if parent is not None and parent is not NOOP_SPAN:
+            trace_id, parent_id = parent.trace_id, parent.span_id
+
+    return Span(name, trace_id, parent_id, start_time, attributes, exporter)
+
+
+@contextlib.contextmanager
+def use_span(span):
+    """Make the span the current span of this thread, without ending it.
+
+    Args:
+        span (Span): The span, e.g. of a job handed over by another thread.
+    """
+    if span is None or span is NOOP_SPAN:
+        yield span
+        return
+
+    stack = _get_stack()
+    stack.append(span)
+    try:
+        yield span
+    finally:
+        stack.pop()
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Trace the enclosed code as a child of the current span.
+
+    Args:
+        name (str): The name of the operation.
+        attributes: Attributes of the span.
+
+    Yields:
+        Span: The span, or NOOP_SPAN if tracing is disabled.
+    """
+    new_span = start_span(name, **attributes)
+    if new_span is NOOP_SPAN:
+        yield new_span
+        return
+
+    with use_span(new_span):
+        try:
+            yield new_span
+        except BaseException as err:
+            new_span.end(error=err)
+            raise
+        new_span.end()
+
+
+def record_span(name, duration, parent=None, error=None, **attributes):
+    """Record a span that just finished after the given duration.
+
+    Args:
+        name (str): The name of the operation.
+        duration (float): The duration of the operation, in seconds.
+        parent (Span): The parent span. Defaults to the current span.
+        error (Exception): The error that ended the operation, if any.
+        attributes: Attributes of the span.
+    """
+    end_time = time.time()
+    new_span = start_span(name, parent=parent,
+                          start_time=end_time - duration, **attributes)
+    new_span.end(end_time=end_time, error=error)
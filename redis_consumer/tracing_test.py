@@ -0,0 +1,159 @@
+# Copyright 2016-2020 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-redis-consumer/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tests for the tracing of jobs"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import threading
+
+import pytest
+
+from redis_consumer import consumers
+from redis_consumer import pipeline
+from redis_consumer import settings
+from redis_consumer import tracing
+from redis_consumer.testing_utils import redis_client
+
+
+@pytest.fixture
+def exporter():
+    exporter = tracing.InMemoryExporter()
+    tracing.set_exporter(exporter)
+    yield exporter
+    tracing.set_exporter(None)
+
+
+def test_parse_traceparent():
+    span = tracing.Span('name')
+    assert tracing.parse_traceparent(span.traceparent) == (
+        span.trace_id, span.span_id)
+    assert tracing.parse_traceparent(None) == (None, None)
+    assert tracing.parse_traceparent('invalid') == (None, None)
+
+
+def test_disabled():
+    tracing.set_exporter(None)
+    with tracing.span('name') as span:
+        assert span is tracing.NOOP_SPAN
+        assert tracing.get_traceparent() is None
+    tracing.record_span('name', 1)
+
+
+def test_span(exporter):
+    with tracing.span('parent', key='value') as parent:
+        assert tracing.get_current_span() is parent
+        with tracing.span('child') as child:
+            assert tracing.get_traceparent() == child.traceparent
+        tracing.record_span('recorded', 2)
+
+        # spans are not shared between threads
+        thread = threading.Thread(
+            target=lambda: tracing.record_span('other', 0))
+        thread.start()
+        thread.join()
+
+    with pytest.raises(ValueError):
+        with tracing.span('error'):
+            raise ValueError('thrown on purpose')
+
+    spans = {span.name: span for span in exporter.get_spans()}
+    assert list(spans) == ['child', 'recorded', 'other', 'parent', 'error']
+    assert spans['parent'].attributes == {'key': 'value'}
+    assert spans['parent'].parent_id is None
+    for name in ('child', 'recorded'):
+        assert spans[name].trace_id == parent.trace_id
+        assert spans[name].parent_id == parent.span_id
+    assert spans['recorded'].end_time - spans['recorded'].start_time == \
+        pytest.approx(2)
+    assert spans['other'].trace_id != parent.trace_id
+    assert spans['error'].error == 'ValueError: thrown on purpose'
+    assert len(exporter.get_spans(parent.trace_id)) == 3
+
+    # continue a trace from its traceparent
+    span = tracing.start_span('continued', traceparent=parent.traceparent)
+    assert span.trace_id == parent.trace_id
+    assert span.parent_id == parent.span_id
+
+
+def test_json_file_exporter(tmpdir):
+    path = str(tmpdir.join('traces.jsonl'))
+    tracing.set_exporter(tracing.JsonFileExporter(path))
+    try:
+        with tracing.span('parent'):
+            tracing.record_span('child', 1, key='value')
+    finally:
+        tracing.set_exporter(None)
+
+    with open(path) as f:
+        spans = [json.loads(line) for line in f]
+    assert [span['name'] for span in spans] == ['child', 'parent']
+    assert spans[0]['attributes'] == {'key': 'value'}
+    assert spans[0]['parent_id'] == spans[1]['span_id']
+
+
+def test_consume(mocker, redis_client, exporter):
+    mocker.patch.object(settings, 'EMPTY_QUEUE_TIMEOUT', 0)
+    consumer = consumers.Consumer(redis_client, None, 'q')
+    parent = tracing.Span('parent')
+    redis_client.hmset('hash', {'traceparent': parent.traceparent})
+    redis_client.lpush('q', 'hash')
+
+    def _consume(redis_hash):
+        consumer.update_key(redis_hash, {'status': 'done'})
+        # child jobs can continue the trace of the job
+        _consume.traceparent = tracing.get_traceparent()
+        return 'done'
+
+    mocker.patch.object(consumer, '_consume', _consume)
+    consumer.consume()
+
+    spans = {span.name: span for span in exporter.get_spans()}
+    assert set(spans) == {'claim', 'release', 'job'}
+    job = spans['job']
+    assert job.trace_id == parent.trace_id
+    assert job.parent_id == parent.span_id
+    assert job.attributes['status'] == 'done'
+    assert spans['claim'].parent_id == job.span_id
+    assert spans['release'].parent_id == job.span_id
+    assert _consume.traceparent == job.traceparent
+    assert redis_client.hget('hash', 'trace_id') == job.trace_id
+
+
+def test_run_stage(exporter):
+    job_span = tracing.start_span('job')
+    stage = pipeline.Stage('stage', lambda job: job)
+
+    # stages run in other threads are children of the job span
+    thread = threading.Thread(target=pipeline.run_stage,
+                              args=(stage, {'span': job_span}))
+    thread.start()
+    thread.join()
+
+    spans = exporter.get_spans()
+    assert [span.name for span in spans] == ['stage']
+    assert spans[0].parent_id == job_span.span_id
@@ -32,12 +32,14 @@ import io
 import os
 import time
 import timeit
-import contextlib
 import hashlib
+import importlib
 import logging
 import shutil
 import tarfile
 import tempfile
+import threading
+import weakref
 import zipfile
 import six
 
@@ -45,7 +47,6 @@ import skimage
 from skimage.external import tifffile
 
 import numpy as np
-import keras_preprocessing.image
 import dict_to_protobuf
 import PIL
 
@@ -132,27 +133,124 @@ def make_tensor_proto(data, dtype):
     return tensor_proto
 
 
-# Workaround for python2 not supporting `with tempfile.TemporaryDirectory() as`
-# These are unnecessary if not supporting python2
-@contextlib.contextmanager
-def cd(newdir, cleanup=lambda: True):
-    prevdir = os.getcwd()
-    os.chdir(os.path.expanduser(newdir))
-    try:
-        yield
-    finally:
-        os.chdir(prevdir)
-        cleanup()
+def import_string(dotted_path):
+    """Import an attribute of a module by its dotted path.
+
+    Args:
+        dotted_path (str): The path, e.g. "redis_consumer.processing.normalize".
+
+    Returns:
+        The imported attribute.
+    """
+    module_name, name = str(dotted_path).rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), name)
 
 
-@contextlib.contextmanager
-def get_tempdir():
-    dirpath = tempfile.mkdtemp()
+class Workspace(object):
+    """A job-scoped temporary directory, removed once the job is done.
 
-    def cleanup():
-        return shutil.rmtree(dirpath)
-    with cd(dirpath, cleanup):
-        yield dirpath
+    The working directory of the process is never changed, so workspaces
+    are safe to use from many threads at the same time.
+
+    If ``tmpfs`` is set, the workspace is created on that RAM-backed
+    filesystem as long as it stays within ``budget`` bytes, counting both
+    the bytes used on the tmpfs and the expected size of the workspaces
+    of this process. Otherwise, or if the expected size is unknown, the
+    workspace is created on disk.
+
+    Use the workspace as a context manager, which returns its path and
+    removes it on exit, or call ``cleanup()`` once done.
+
+    Args:
+        size (int): The expected size of the workspace, in bytes, or None
+            if it is unknown.
+        tmpfs (str): A directory on a tmpfs. Defaults to WORKSPACE_TMPFS.
+        budget (int): The number of bytes workspaces may use on the tmpfs.
+            Defaults to WORKSPACE_TMPFS_BUDGET megabytes.
+    """
+
+    _lock = threading.Lock()
+    # bytes reserved on the tmpfs by the workspaces of this process.
+    _reserved = 0
+
+    def __init__(self, size=None, tmpfs=None, budget=None):
+        if tmpfs is None:
+            tmpfs = settings.WORKSPACE_TMPFS
+        if budget is None:
+            budget = settings.WORKSPACE_TMPFS_BUDGET * 1024 * 1024
+
+        self.path = None
+        self.on_tmpfs = False
+        reserved = 0
+        if tmpfs and size is not None and self._reserve(tmpfs, size, budget):
+            reserved = size
+            try:
+                self.path = tempfile.mkdtemp(prefix='workspace-', dir=tmpfs)
+                self.on_tmpfs = True
+            except OSError as err:
+                logger.warning('Could not create a workspace in `%s`: %s',
+                               tmpfs, err)
+                self._release(reserved)
+                reserved = 0
+
+        if self.path is None:
+            self.path = tempfile.mkdtemp(prefix='workspace-')
+
+        # removes the workspace even if cleanup() is never called.
+        self._finalizer = weakref.finalize(
+            self, self._remove, self.path, reserved)
+
+    @classmethod
+    def _reserve(cls, tmpfs, size, budget):
+        """Reserve size bytes on the tmpfs, if it is within the budget."""
+        try:
+            used = shutil.disk_usage(tmpfs).used
+        except OSError:
+            return False
+
+        with cls._lock:
+            if used >= budget or max(used, cls._reserved) + size > budget:
+                logger.debug('Workspace of %s bytes does not fit in `%s`, '
+                             'using the disk instead.', size, tmpfs)
+                return False
+            cls._reserved += size
+        return True
+
+    @classmethod
+    def _release(cls, size):
+        with cls._lock:
+            cls._reserved -= size
+
+    @classmethod
+    def _remove(cls, path, reserved):
+        try:
+            shutil.rmtree(path, ignore_errors=True)
+        finally:
+            cls._release(reserved)
+
+    def cleanup(self):
+        """Remove the workspace and all of its files."""
+        self._finalizer()
+
+    def __enter__(self):
+        return self.path
+
+    def __exit__(self, *exc):
+        self.cleanup()
+
+
+def get_tempdir(size=None):
+    """Returns a new job-scoped Workspace, which is also a context manager
+    that returns the path of the workspace.
+
+    Args:
+        size (int): The expected size of the workspace, in bytes, or None
+            if it is unknown.
+
+    Returns:
+        Workspace: The temporary workspace.
+    """
+    return Workspace(size=size)
 
 
 def iter_image_archive(zip_path, destination):
@@ -209,6 +307,7 @@ def get_image(filepath):
         # tiff files should not have a channel dim
         img = np.expand_dims(img, axis=-1)
     else:
+        import keras_preprocessing.image  # slow to import, only load if used
         img = keras_preprocessing.image.img_to_array(PIL.Image.open(filepath))
 
     logger.debug('Loaded %s into numpy array with shape %s',
@@ -216,6 +315,43 @@ def get_image(filepath):
     return img.astype('float32')
 
 
+def get_image_shape(filepath):
+    """Get the shape of an image file from its header, without loading it.
+
+    Args:
+        filepath: full filepath of image file
+
+    Returns:
+        tuple: the shape of the image
+    """
+    if os.path.splitext(filepath)[-1].lower() in {'.tif', '.tiff'}:
+        with tifffile.TiffFile(filepath) as tif:
+            return tuple(tif.series[0].shape)
+
+    img = PIL.Image.open(filepath)
+    shape = (img.height, img.width)
+    if len(img.getbands()) > 1:
+        shape += (len(img.getbands()),)
+    return shape
+
+
+def get_file_digest(filepath, chunk_size=1024 * 1024):
+    """Get the SHA-256 digest of the contents of a file.
+
+    Args:
+        filepath: full filepath of the file
+        chunk_size: number of bytes read at a time
+
+    Returns:
+        str: the hex digest of the file
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def pad_image(image, field):
     """Pad each the input image for proper dimensions when stitiching.
 
@@ -150,6 +150,57 @@ def test_get_image_files_from_dir():
         assert len(imfiles) == num_files
 
 
+def test_get_tempdir(tmpdir, mocker):
+    tmpfs = str(tmpdir)
+    cwd = os.getcwd()
+
+    # workspaces are on disk by default, and never change the cwd.
+    with utils.get_tempdir() as tempdir:
+        assert os.path.isdir(tempdir)
+        assert not tempdir.startswith(tmpfs)
+        assert os.getcwd() == cwd
+    assert not os.path.exists(tempdir)
+
+    # workspaces are on the tmpfs while they fit in the budget.
+    mocker.patch('redis_consumer.settings.WORKSPACE_TMPFS', tmpfs)
+    mocker.patch('shutil.disk_usage', lambda _: mocker.Mock(used=0))
+    budget = 100
+    first = utils.Workspace(size=60, budget=budget)
+    assert first.on_tmpfs
+    assert first.path.startswith(tmpfs)
+
+    second = utils.Workspace(size=60, budget=budget)
+    assert not second.on_tmpfs
+    assert not second.path.startswith(tmpfs)
+
+    # cleanup releases the reserved bytes and is deterministic.
+    with open(os.path.join(first.path, 'file.txt'), 'w') as f:
+        f.write('data')
+    first.cleanup()
+    first.cleanup()
+    assert not os.path.exists(first.path)
+    with utils.Workspace(size=60, budget=budget) as tempdir:
+        assert tempdir.startswith(tmpfs)
+    second.cleanup()
+    assert utils.Workspace._reserved == 0
+
+    # workspaces that are never cleaned up are removed once collected.
+    workspace = utils.Workspace(size=10, budget=budget)
+    path = workspace.path
+    del workspace
+    assert not os.path.exists(path)
+    assert utils.Workspace._reserved == 0
+
+    # workspaces of unknown size are on disk.
+    with utils.Workspace(budget=budget) as tempdir:
+        assert not tempdir.startswith(tmpfs)
+
+    # the bytes used on the tmpfs count against the budget.
+    mocker.patch('shutil.disk_usage', lambda _: mocker.Mock(used=budget))
+    with utils.Workspace(size=0, budget=budget) as tempdir:
+        assert not tempdir.startswith(tmpfs)
+
+
 def test_get_image(tmpdir):
     tmpdir = str(tmpdir)
     # test tiff files
@@ -165,6 +216,31 @@ def test_get_image(tmpdir):
     np.testing.assert_equal(test_img.shape, (400, 400, 1))
 
 
+def test_get_image_shape(tmpdir):
+    tmpdir = str(tmpdir)
+    # test tiff files
+    test_img_path = os.path.join(tmpdir, 'phase.tif')
+    _write_image(test_img_path, 300, 200)
+    assert utils.get_image_shape(test_img_path) == (300, 200)
+    # test png files
+    test_img_path = os.path.join(tmpdir, 'feature_0.png')
+    _write_image(test_img_path, 400, 100)
+    assert utils.get_image_shape(test_img_path) == (400, 100)
+
+
+def test_get_file_digest(tmpdir):
+    tmpdir = str(tmpdir)
+    paths = [os.path.join(tmpdir, name) for name in 'abc']
+    for path, content in zip(paths, [b'same', b'same', b'other']):
+        with open(path, 'wb') as f:
+            f.write(content)
+
+    digests = [utils.get_file_digest(p, chunk_size=3) for p in paths]
+    assert digests[0] == digests[1]
+    assert digests[0] != digests[2]
+    assert len(digests[0]) == 64
+
+
 def test_pad_image():
     # 2D images
     h, w = 300, 300
@@ -0,0 +1,134 @@
+# Copyright 2016-2020 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-redis-consumer/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Pre-fork supervisor of worker processes"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import gc
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+
+from redis_consumer import metrics
+
+
+STOP_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+def get_stop_event():
+    """Get an event that is set when the process is asked to stop.
+
+    The current job can then be finished before the process exits.
+
+    Returns:
+        threading.Event: The event set by SIGTERM or SIGINT.
+    """
+    stop_event = threading.Event()
+    for signum in STOP_SIGNALS:
+        signal.signal(signum, lambda *_: stop_event.set())
+    return stop_event
+
+
+class Supervisor(object):
+    """Fork worker processes and restart them if they crash.
+
+    The workers are forked from this process after all modules have been
+    imported, so they share the imported code copy-on-write. Each worker
+    must create its own connections. On SIGTERM or SIGINT, every worker is
+    asked to stop and the supervisor waits for them to finish their jobs.
+
+    Args:
+        target (function): Runs a worker, called with the worker ID and a
+            threading.Event that is set when the worker should stop.
+        num_workers (int): The number of worker processes.
+        backoff (float): Seconds to wait before restarting a worker, and
+            between checks of the workers.
+    """
+
+    def __init__(self, target, num_workers, backoff=1):
+        self.logger = logging.getLogger(str(self.__class__.__name__))
+        self.target = target
+        self.num_workers = num_workers
+        self.backoff = backoff
+        self.workers = {}
+        self._draining = False
+
+    def _run_worker(self, worker_id):
+        """Run the target in the worker process."""
+        self.target(worker_id, get_stop_event())
+
+    def _start_worker(self, worker_id):
+        worker = multiprocessing.get_context('fork').Process(
+            target=self._run_worker,
+            args=(worker_id,),
+            name='worker-{}'.format(worker_id))
+        worker.start()
+        self.workers[worker_id] = worker
+        self.logger.info('Started worker %s with PID %s.',
+                         worker_id, worker.pid)
+
+    def stop(self, *_):
+        """Ask every worker to stop after its current job."""
+        self._draining = True
+        for worker in self.workers.values():
+            if worker.is_alive():
+                worker.terminate()  # sends SIGTERM
+        self.logger.info('Stopping %s workers.', len(self.workers))
+
+    def run(self):
+        """Start the workers and supervise them until they are stopped."""
+        for signum in STOP_SIGNALS:
+            signal.signal(signum, self.stop)
+
+        # keep the imported objects out of the garbage collector,
+        # so that collecting in a worker does not copy their pages.
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+
+        for worker_id in range(self.num_workers):
+            if not self._draining:
+                self._start_worker(worker_id)
+
+        while self.workers:
+            time.sleep(self.backoff)
+            for worker_id, worker in list(self.workers.items()):
+                if worker.exitcode is None:
+                    continue
+
+                worker.join()
+                del self.workers[worker_id]
+                metrics.mark_process_dead(worker.pid)
+                if self._draining:
+                    self.logger.info('Worker %s stopped.', worker_id)
+                    continue
+
+                self.logger.error('Worker %s exited with code %s. '
+                                  'Restarting.', worker_id, worker.exitcode)
+                self._start_worker(worker_id)
@@ -0,0 +1,94 @@
+# Copyright 2016-2020 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-redis-consumer/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tests for the worker process supervisor"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import signal
+import sys
+import threading
+
+from redis_consumer import workers
+
+
+def test_get_stop_event():
+    handlers = {s: signal.getsignal(s) for s in workers.STOP_SIGNALS}
+    try:
+        stop_event = workers.get_stop_event()
+        assert not stop_event.is_set()
+        os.kill(os.getpid(), signal.SIGTERM)
+        assert stop_event.wait(1)
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+
+class TestSupervisor(object):
+    # pylint: disable=R0201
+
+    def test_run(self, tmpdir):
+        tmpdir = str(tmpdir)
+        handlers = {s: signal.getsignal(s) for s in workers.STOP_SIGNALS}
+
+        def target(worker_id, stop_event):
+            path = os.path.join(tmpdir, str(worker_id))
+            with open(path, 'a') as f:
+                f.write('started\n')
+                f.flush()
+                # the first worker crashes the first time it is started.
+                if worker_id == 0 and f.tell() == len('started\n'):
+                    sys.exit(1)
+            stop_event.wait()
+            with open(path, 'a') as f:
+                f.write('stopped\n')
+
+        supervisor = workers.Supervisor(target, 2, backoff=0.01)
+
+        def stop_when_started():
+            while not all(os.path.exists(os.path.join(tmpdir, str(i)))
+                          for i in range(2)):
+                threading.Event().wait(0.01)
+            while open(os.path.join(tmpdir, '0')).read().count('started') < 2:
+                threading.Event().wait(0.01)
+            supervisor.stop()
+
+        stopper = threading.Thread(target=stop_when_started)
+        stopper.start()
+        try:
+            supervisor.run()
+        finally:
+            stopper.join()
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+        # the crashed worker is restarted and all workers are drained
+        assert not supervisor.workers
+        with open(os.path.join(tmpdir, '0')) as f:
+            assert f.read() == 'started\nstarted\nstopped\n'
+        with open(os.path.join(tmpdir, '1')) as f:
+            assert f.read() == 'started\nstopped\n'